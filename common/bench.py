@@ -0,0 +1,486 @@
+"""
+Load generator and benchmark suite for the HTTP and UDP servers
+
+Drives a running server at a fixed concurrency (closed loop) or a target
+request rate (open loop) from a single asyncio event loop, records every
+latency in an HDR-style histogram and reports requests/sec with
+p50/p90/p99/p99.9 latency. Results can be saved as JSON and compared across
+engines, worker counts and commits with `bench compare`.
+
+In open-loop mode latency is measured from the time a request was scheduled
+to be sent, not from when a free worker actually sent it, so a stalled
+server shows up in the percentiles instead of silently lowering the rate.
+"""
+
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from common.cli import fail, pop_value
+from common.codec import available_codecs, get_codec
+from common.histogram import LatencyHistogram
+
+LAUNCHER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'simple-server.py')
+STARTUP_TARGETS = ('http', 'udp', 'both')
+
+class Schedule:
+    """Hands out send times to workers until the request or time budget is used up"""
+
+    def __init__(self, rate=0.0, duration=10.0, requests=0):
+        self.rate = rate
+        self.duration = duration
+        self.requests = requests
+        self.issued = 0
+        self.start = time.perf_counter()
+
+    def next(self):
+        """Planned send time of the next request, or None when the run is over"""
+        if self.requests and self.issued >= self.requests:
+            return None
+        if self.rate > 0:
+            planned = self.start + self.issued / self.rate
+        else:
+            planned = time.perf_counter()
+        if not self.requests and planned - self.start >= self.duration:
+            return None
+        self.issued += 1
+        return planned
+
+class Results:
+    """Latency histogram plus outcome counters shared by all workers of a run"""
+
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        self.errors = 0
+        self.status_codes = {}
+
+    def success(self, started, status=None):
+        self.histogram.record((time.perf_counter() - started) * 1e6)
+        if status is not None:
+            self.status_codes[status] = self.status_codes.get(status, 0) + 1
+
+    def error(self, kind):
+        self.errors += 1
+        self.status_codes[kind] = self.status_codes.get(kind, 0) + 1
+
+async def _wait_until(planned):
+    delay = planned - time.perf_counter()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+async def read_http_response(reader):
+    """Read one HTTP response, returning (status_code, keep_alive)"""
+    status_line = await reader.readline()
+    if not status_line:
+        raise asyncio.IncompleteReadError(b'', None)
+    version, status = status_line.split(None, 2)[:2]
+    status = int(status)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.partition(b':')
+        headers[name.strip().lower()] = value.strip().lower()
+
+    connection = headers.get(b'connection', b'')
+    keep_alive = connection != b'close' and (version == b'HTTP/1.1' or connection == b'keep-alive')
+
+    if headers.get(b'transfer-encoding') == b'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif b'content-length' in headers:
+        await reader.readexactly(int(headers[b'content-length']))
+    else:
+        # Body delimited by the end of the connection
+        await reader.read()
+        keep_alive = False
+    return status, keep_alive
+
+async def _http_worker(options, request, schedule, results):
+    reader = writer = None
+    while True:
+        planned = schedule.next()
+        if planned is None:
+            break
+        await _wait_until(planned)
+        started = planned if schedule.rate > 0 else time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(options['host'], options['port'])
+            writer.write(request)
+            status, keep_alive = await asyncio.wait_for(read_http_response(reader), options['timeout'])
+        except asyncio.TimeoutError:
+            results.error('timeout')
+            keep_alive = False
+        except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+            results.error(type(e).__name__)
+            keep_alive = False
+        else:
+            results.success(started, status)
+        if writer is not None and (options['mode'] == 'connect' or not keep_alive):
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+def build_http_request(options):
+    """Raw request bytes sent for every iteration of an HTTP benchmark"""
+    lines = [
+        f"{options['method']} {options['path']} HTTP/1.1",
+        f"Host: {options['host']}:{options['port']}",
+        f"Connection: {'close' if options['mode'] == 'connect' else 'keep-alive'}",
+    ]
+    body = b''
+    if options['method'] == 'POST':
+        # Valid JSON of the requested size so the validating server path is exercised
+        padding = max(options['body_size'] - len('{"data":""}'), 0)
+        body = ('{"data":"%s"}' % ('x' * padding)).encode('ascii')
+        lines.append('Content-Type: application/json')
+        lines.append(f'Content-Length: {len(body)}')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+class _UDPClient(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.waiter = None
+
+    def datagram_received(self, data, addr):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(data)
+
+    def error_received(self, exc):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_exception(exc)
+
+async def _udp_worker(options, payload, schedule, results):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        _UDPClient, remote_addr=(options['host'], options['port']))
+    try:
+        while True:
+            planned = schedule.next()
+            if planned is None:
+                break
+            await _wait_until(planned)
+            started = planned if schedule.rate > 0 else time.perf_counter()
+            protocol.waiter = loop.create_future()
+            transport.sendto(payload)
+            try:
+                await asyncio.wait_for(protocol.waiter, options['timeout'])
+            except asyncio.TimeoutError:
+                results.error('timeout')
+            except OSError as e:
+                results.error(type(e).__name__)
+            else:
+                results.success(started, 'ok')
+    finally:
+        transport.close()
+
+async def _run(options):
+    schedule = Schedule(options['rate'], options['duration'], options['requests'])
+    results = Results()
+    if options['protocol'] == 'http':
+        request = build_http_request(options)
+        workers = [_http_worker(options, request, schedule, results) for _ in range(options['concurrency'])]
+    else:
+        payload = b'x' * options['body_size']
+        workers = [_udp_worker(options, payload, schedule, results) for _ in range(options['concurrency'])]
+    started = time.perf_counter()
+    await asyncio.gather(*workers)
+    return results, time.perf_counter() - started
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(options):
+    """Run one benchmark and return its result dictionary"""
+    results, elapsed = asyncio.run(_run(options))
+    completed = results.histogram.count
+    return {
+        "label": options['label'],
+        "protocol": options['protocol'],
+        "target": f"{options['host']}:{options['port']}",
+        "mode": options['mode'] if options['protocol'] == 'http' else None,
+        "method": options['method'] if options['protocol'] == 'http' else None,
+        "path": options['path'] if options['protocol'] == 'http' else None,
+        "body_size": options['body_size'],
+        "concurrency": options['concurrency'],
+        "target_rate": options['rate'] or None,
+        "elapsed_sec": round(elapsed, 3),
+        "completed": completed,
+        "errors": results.errors,
+        "status_codes": {str(k): v for k, v in sorted(results.status_codes.items(), key=str)},
+        "requests_per_sec": round(completed / elapsed, 1) if elapsed else 0.0,
+        "latency_us": results.histogram.summary(),
+        "commit": _git_commit(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def _ms(us):
+    return f"{us / 1000.0:.2f}ms"
+
+def print_result(result):
+    latency = result['latency_us']
+    print('=' * 60)
+    title = f"{result['protocol'].upper()} benchmark against {result['target']}"
+    if result['label']:
+        title += f" [{result['label']}]"
+    print(title)
+    if result['protocol'] == 'http':
+        print(f"Mode: {result['mode']}, {result['method']} {result['path']}, body {result['body_size']} bytes")
+    else:
+        print(f"Payload: {result['body_size']} bytes")
+    rate = f", target rate {result['target_rate']}/s" if result['target_rate'] else ''
+    print(f"Concurrency: {result['concurrency']}{rate}")
+    print('-' * 60)
+    print(f"Completed: {result['completed']} in {result['elapsed_sec']}s, errors: {result['errors']}")
+    print(f"Status codes: {result['status_codes']}")
+    print(f"Requests/sec: {result['requests_per_sec']}")
+    print(f"Latency: min {_ms(latency['min'])}, mean {_ms(latency['mean'])}, max {_ms(latency['max'])}")
+    print(f"  p50 {_ms(latency['p50'])}  p90 {_ms(latency['p90'])}  "
+          f"p99 {_ms(latency['p99'])}  p99.9 {_ms(latency['p999'])}")
+    print('=' * 60)
+
+def compare(paths):
+    """Print saved benchmark results side by side"""
+    print(f"{'Result':<28}{'Commit':<10}{'Req/s':>10}{'p50':>10}{'p99':>10}{'p99.9':>10}{'Errors':>8}")
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            result = json.load(f)
+        latency = result['latency_us']
+        name = result.get('label') or os.path.basename(path)
+        print(f"{name[:27]:<28}{(result.get('commit') or '-'):<10}{result['requests_per_sec']:>10}"
+              f"{_ms(latency['p50']):>10}{_ms(latency['p99']):>10}{_ms(latency['p999']):>10}{result['errors']:>8}")
+
+def _sample_json(size):
+    """A JSON document of roughly `size` bytes with a typical mix of strings, numbers and nesting"""
+    items = []
+    length = 2
+    while length < size:
+        item = {"id": len(items), "name": f"item-{len(items)}", "price": len(items) * 1.25, "active": True,
+                "tags": ["alpha", "beta", "gamma"], "owner": {"user": "tester", "email": "tester@example.com"}}
+        items.append(item)
+        length += len(json.dumps(item)) + 2
+    return json.dumps({"items": items}).encode('utf-8')
+
+def _time_per_call(function, budget=0.3):
+    """Mean seconds per call of function(), measured for about `budget` seconds"""
+    calls = 0
+    started = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < budget:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - started
+    return elapsed / calls
+
+def benchmark_codecs(sizes):
+    """Time the POST handling work per JSON codec: full parse+serialize vs validate-only splice"""
+    prefix = b'{"status":"success","message":"POST request processed successfully","received_data":'
+    tail = b',"client_ip":"127.0.0.1","client_port":54321,"time":"Mon Jan  1 12:00:00 2022"}'
+    print(f"{'Codec':<8}{'Body':>10}{'Full (us)':>12}{'Validate-only (us)':>20}{'Speedup':>9}{'Full MB/s':>11}")
+    for name in available_codecs():
+        codec = get_codec(name)
+        for size in sizes:
+            body = _sample_json(size)
+
+            def full():
+                data = codec.loads(body)
+                codec.dumps({"status": "success", "message": "POST request processed successfully",
+                             "received_data": data, "client_ip": "127.0.0.1", "client_port": 54321,
+                             "time": "Mon Jan  1 12:00:00 2022"})
+
+            def validate_only():
+                codec.loads(body)
+                b''.join((prefix, body.strip(), tail))
+
+            full_sec = _time_per_call(full)
+            validate_sec = _time_per_call(validate_only)
+            print(f"{name:<8}{len(body):>10}{full_sec * 1e6:>12.1f}{validate_sec * 1e6:>20.1f}"
+                  f"{full_sec / validate_sec:>8.1f}x{len(body) / full_sec / 1e6:>11.1f}")
+
+def _free_port(kind):
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _http_answers(port):
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=1.0) as s:
+            s.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+            return s.recv(12).startswith(b'HTTP/1.')
+    except OSError:
+        return False
+
+def _udp_answers(s, port):
+    try:
+        s.sendto(b'0 startup probe', ('127.0.0.1', port))
+        s.recv(65536)
+        return True
+    except OSError:
+        return False
+
+def measure_startup(target, runs, launcher=LAUNCHER):
+    """Launch `simple-server.py target` runs times, timing each launch until every server has answered once"""
+    times = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.settimeout(0.002)
+        for _ in range(runs):
+            http_port, udp_port = _free_port(socket.SOCK_STREAM), _free_port(socket.SOCK_DGRAM)
+            checks, ports = [], []
+            if target in ('http', 'both'):
+                checks.append(lambda: _http_answers(http_port))
+                ports.append(http_port)
+            if target in ('udp', 'both'):
+                checks.append(lambda: _udp_answers(probe, udp_port))
+                ports.append(udp_port)
+            cmd = [sys.executable, launcher, target] + [str(port) for port in ports] + ['--log-level', 'warning']
+            started = time.perf_counter()
+            process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                while checks:
+                    if process.poll() is not None:
+                        fail(f"{' '.join(cmd)} exited with code {process.returncode} before answering")
+                    if time.perf_counter() - started > 10:
+                        fail(f"{' '.join(cmd)} did not answer within 10 seconds")
+                    checks = [check for check in checks if not check()]
+                    if checks:
+                        time.sleep(0.001)
+                times.append(time.perf_counter() - started)
+            finally:
+                process.send_signal(signal.SIGINT)
+                try:
+                    process.wait(5)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+    return times
+
+def _interpreter_startup(runs):
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        times.append(time.perf_counter() - started)
+    return times
+
+def benchmark_startup(targets, runs):
+    """Report launch-to-first-response time per server type, next to bare interpreter startup"""
+    print(f"Startup time over {runs} runs (launch until the server answers its first request)")
+    print(f"{'Command':<36}{'Min (ms)':>10}{'Median (ms)':>13}{'Max (ms)':>10}")
+    rows = [('python -c pass (interpreter only)', _interpreter_startup(runs))]
+    rows += [(f'simple-server.py {target}', measure_startup(target, runs)) for target in targets]
+    for label, times in rows:
+        times = sorted(times)
+        print(f"{label:<36}{times[0] * 1000:>10.1f}{times[len(times) // 2] * 1000:>13.1f}{times[-1] * 1000:>10.1f}")
+
+def show_help():
+    print("Benchmark - Load generator for the HTTP and UDP servers")
+    print()
+    print("Usage: python simple-server.py bench <http|udp> [options]")
+    print("       python simple-server.py bench compare <result.json>...")
+    print("       python simple-server.py bench codec [--sizes 1024,65536,1048576]")
+    print("       python simple-server.py bench startup [http|udp|both] [--runs N]")
+    print()
+    print("Options:")
+    print("  --host host       Server address (default: 127.0.0.1)")
+    print("  --port port       Server port (default: 8000 for HTTP, 9000 for UDP)")
+    print("  --concurrency N   Concurrent connections / in-flight datagrams (default: 16)")
+    print("  --rate R          Target requests per second; 0 = as fast as possible (default: 0)")
+    print("  --duration S      Run time in seconds (default: 10)")
+    print("  --requests N      Stop after N requests instead of a fixed duration")
+    print("  --timeout S       Per-request timeout in seconds (default: 5 HTTP, 1 UDP)")
+    print("  --body-size N     POST body / datagram size in bytes (default: 128)")
+    print("  --label name      Name stored with the result, e.g. threads, asyncio, workers4")
+    print("  --output file     Save the result as JSON")
+    print()
+    print("HTTP options:")
+    print("  --mode mode       keepalive (reuse connections) or connect (new connection per request)")
+    print("  --method method   GET or POST (default: GET)")
+    print("  --path path       Request path (default: /)")
+    print()
+    print("Examples:")
+    print("  python simple-server.py bench http --concurrency 64 --duration 30 --label threads --output threads.json")
+    print("  python simple-server.py bench http --mode connect --method POST --body-size 4096")
+    print("  python simple-server.py bench udp --port 9000 --rate 20000 --duration 10")
+    print("  python simple-server.py bench compare threads.json asyncio.json workers4.json")
+    print()
+    print("bench codec times JSON POST handling in-process for each installed codec (stdlib, orjson,")
+    print("ujson): full parse and re-serialize versus the --validate-only parse and splice.")
+    print()
+    print("bench startup launches the servers on free ports (default: all three server types, 10 runs")
+    print("each) and times each launch until the first response, next to bare interpreter startup.")
+
+def main(args):
+    if not args or args[0] in ['-h', '--help']:
+        show_help()
+        sys.exit(0)
+
+    protocol = args[0].lower()
+    args = args[1:]
+    if protocol == 'compare':
+        if not args:
+            fail("compare requires at least one result file!")
+        compare(args)
+        return
+    if protocol == 'codec':
+        sizes, args = pop_value(args, '--sizes', lambda value: [int(size) for size in value.split(',')],
+                                [1024, 64 * 1024, 1024 * 1024])
+        if args:
+            fail(f"Unknown arguments: {' '.join(args)}")
+        benchmark_codecs(sizes)
+        return
+    if protocol == 'startup':
+        runs, args = pop_value(args, '--runs', int, 10)
+        if runs < 1:
+            fail("--runs must be at least 1!")
+        if any(target not in STARTUP_TARGETS for target in args):
+            fail(f"Unknown startup targets: {' '.join(args)}! Valid targets: {', '.join(STARTUP_TARGETS)}")
+        benchmark_startup(args or list(STARTUP_TARGETS), runs)
+        return
+    if protocol not in ('http', 'udp'):
+        fail(f"Unknown benchmark target '{protocol}'! Valid targets: http, udp, compare, codec, startup")
+
+    options = {'protocol': protocol}
+    options['host'], args = pop_value(args, '--host', str, '127.0.0.1')
+    options['port'], args = pop_value(args, '--port', int, 8000 if protocol == 'http' else 9000)
+    options['concurrency'], args = pop_value(args, '--concurrency', int, 16)
+    options['rate'], args = pop_value(args, '--rate', float, 0.0)
+    options['duration'], args = pop_value(args, '--duration', float, 10.0)
+    options['requests'], args = pop_value(args, '--requests', int, 0)
+    options['timeout'], args = pop_value(args, '--timeout', float, 5.0 if protocol == 'http' else 1.0)
+    options['body_size'], args = pop_value(args, '--body-size', int, 128)
+    options['label'], args = pop_value(args, '--label', str, '')
+    output, args = pop_value(args, '--output')
+    options['mode'], args = pop_value(args, '--mode', str.lower, 'keepalive')
+    options['method'], args = pop_value(args, '--method', str.upper, 'GET')
+    options['path'], args = pop_value(args, '--path', str, '/')
+    if args:
+        fail(f"Unknown arguments: {' '.join(args)}")
+    if options['mode'] not in ('keepalive', 'connect'):
+        fail("--mode must be keepalive or connect!")
+    if options['method'] not in ('GET', 'POST'):
+        fail("--method must be GET or POST!")
+    if options['concurrency'] < 1:
+        fail("--concurrency must be at least 1!")
+
+    result = run_benchmark(options)
+    print_result(result)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+            f.write('\n')
+        print(f"Result saved to {output}")
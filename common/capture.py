@@ -0,0 +1,186 @@
+"""
+Traffic capture to a compact binary log
+
+--record FILE appends every request the servers receive to FILE, for
+`python simple-server.py replay FILE` to send again later. Handlers only put
+a tuple of references on a queue; a background writer thread packs the
+records and appends them to the file in large batches, so recording can be
+left on during load tests.
+
+File layout: an 8 byte MAGIC, then records of
+
+    uint32 length of the rest of the record, float64 timestamp, uint8 kind
+
+followed by, for HTTP (kind 1), uint8/uint32/uint32/uint32 lengths and the
+method, path, raw header lines and body; for UDP (kind 2), the uint16 peer
+port, uint8 peer host length, the host and the payload. All integers are
+little-endian. Each batch is written with a single append, so forked workers
+can record to the same file without interleaving partial records.
+"""
+
+import os
+import queue
+import struct
+import threading
+import time
+
+from common.cli import fail, pop_value
+
+MAGIC = b'SSREC1\n\x00'
+HTTP, UDP = 1, 2
+RECORD = struct.Struct('<IdB')  # length of the rest, timestamp, kind
+HTTP_FIELDS = struct.Struct('<BIII')  # method, path, headers and body lengths
+UDP_FIELDS = struct.Struct('<HB')  # peer port, peer host length
+
+BUFFER_SIZE = 256 * 1024  # Bytes packed before they are written out
+FLUSH_INTERVAL = 0.1  # Seconds a record may wait in a partly filled buffer before it is written
+_STOP = object()
+
+class TrafficRecorder:
+    """Queue requests from any thread and append them to a capture file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        if os.fstat(self._fd).st_size == 0:
+            os.write(self._fd, MAGIC)
+        self.records = 0
+        self.bytes_written = 0
+        self.write_errors = 0
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._run, name='record-writer', daemon=True)
+        self._writer.start()
+
+    def http(self, method, path, headers, body=b''):
+        """Queue one HTTP request; headers is the parsed message, formatted on the writer thread"""
+        self._queue.put((time.time(), HTTP, method, path, headers, body))
+
+    def udp(self, payload, addr):
+        """Queue one datagram; payload must not be a view of a reused receive buffer"""
+        self._queue.put((time.time(), UDP, payload, addr))
+
+    def close(self):
+        """Write everything that is queued and close the file"""
+        if self._writer.is_alive():
+            self._queue.put(_STOP)
+            self._writer.join()
+            os.close(self._fd)
+
+    def report(self):
+        print(f"Recorded {self.records} requests ({self.bytes_written} bytes) to {self.path}"
+              + (f", {self.write_errors} failed writes" if self.write_errors else ''))
+
+    def _pack(self, buffer, record):
+        if record[1] == HTTP:
+            timestamp, kind, method, path, headers, body = record
+            method = method.encode('latin-1')
+            path = path.encode('latin-1', 'replace')
+            # raw_items() skips the per-header policy parsing that items() does
+            headers = ''.join([f'{name}: {value}\r\n' for name, value in headers.raw_items()])
+            headers = headers.encode('latin-1', 'replace')
+            buffer += RECORD.pack(RECORD.size - 4 + HTTP_FIELDS.size + len(method) + len(path) + len(headers)
+                                  + len(body), timestamp, kind)
+            buffer += HTTP_FIELDS.pack(len(method), len(path), len(headers), len(body))
+            buffer += method
+            buffer += path
+            buffer += headers
+            buffer += body
+        else:
+            timestamp, kind, payload, addr = record
+            host = addr[0].encode('ascii')
+            buffer += RECORD.pack(RECORD.size - 4 + UDP_FIELDS.size + len(host) + len(payload), timestamp, kind)
+            buffer += UDP_FIELDS.pack(addr[1], len(host))
+            buffer += host
+            buffer += payload
+        self.records += 1
+
+    def _flush(self, buffer):
+        view = memoryview(buffer)
+        try:
+            while view:
+                view = view[os.write(self._fd, view):]
+        except OSError:
+            self.write_errors += 1
+        self.bytes_written += len(buffer) - len(view)
+        view.release()
+        del buffer[:]
+
+    def _run(self):
+        buffer = bytearray()
+        deadline = 0.0  # When the oldest record in buffer has waited FLUSH_INTERVAL
+        while True:
+            if buffer:
+                # Wait only for what is left of the oldest record's interval, so steady traffic
+                # cannot keep postponing the write
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    self._flush(buffer)
+                    continue
+            try:
+                record = self._queue.get(timeout=timeout) if buffer else self._queue.get()
+            except queue.Empty:
+                self._flush(buffer)
+                continue
+            if record is _STOP:
+                self._flush(buffer)
+                return
+            if not buffer:
+                deadline = time.monotonic() + FLUSH_INTERVAL
+            self._pack(buffer, record)
+            if len(buffer) >= BUFFER_SIZE:
+                self._flush(buffer)
+
+class CaptureError(Exception):
+    """The file is not a capture written by --record"""
+
+def iter_records(data):
+    """Yield (timestamp, kind, fields) for each record in a capture's bytes
+
+    fields is (method, path, headers, body) for HTTP and (host, port,
+    payload) for UDP; the byte fields are memoryview slices of data. A
+    record cut short at the end of the file (writer killed mid-batch) ends
+    the iteration.
+    """
+    view = memoryview(data)
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        raise CaptureError("missing capture file header")
+    position = len(MAGIC)
+    end = len(view)
+    while position + RECORD.size <= end:
+        if view[position:position + len(MAGIC)] == MAGIC:
+            # Header written by a second process that opened the empty file at the same time
+            position += len(MAGIC)
+            continue
+        length, timestamp, kind = RECORD.unpack_from(view, position)
+        record_end = position + 4 + length
+        if record_end > end:
+            break
+        offset = position + RECORD.size
+        if kind == HTTP:
+            method_length, path_length, headers_length, body_length = HTTP_FIELDS.unpack_from(view, offset)
+            offset += HTTP_FIELDS.size
+            fields = []
+            for size in (method_length, path_length, headers_length, body_length):
+                fields.append(view[offset:offset + size])
+                offset += size
+            yield timestamp, kind, tuple(fields)
+        elif kind == UDP:
+            port, host_length = UDP_FIELDS.unpack_from(view, offset)
+            offset += UDP_FIELDS.size
+            host = str(view[offset:offset + host_length], 'ascii')
+            yield timestamp, kind, (host, port, view[offset + host_length:record_end])
+        else:
+            raise CaptureError(f"unknown record kind {kind} at offset {position}")
+        position = record_end
+
+def pop_record_args(args):
+    """Parse --record FILE, returning (TrafficRecorder or None, remaining_args)"""
+    path, args = pop_value(args, '--record')
+    if path is None:
+        return None, args
+    try:
+        return TrafficRecorder(path), args
+    except OSError as e:
+        fail(f"cannot open --record file '{path}': {e}")
+
+RECORD_HELP = "  --record FILE     Append every request to a binary capture for `simple-server.py replay`"
@@ -0,0 +1,30 @@
+"""
+Small helpers for the hand-written command line parsing in the server scripts
+"""
+
+import sys
+
+def fail(message):
+    """Print an argument error and exit"""
+    print(f"Error: {message}")
+    print("Use -h or --help for usage information")
+    sys.exit(1)
+
+def pop_flag(args, flag):
+    """Remove a boolean flag from args, returning (present, remaining_args)"""
+    if flag not in args:
+        return False, args
+    return True, [arg for arg in args if arg != flag]
+
+def pop_value(args, flag, convert=str, default=None):
+    """Remove `flag value` from args, returning (converted_value, remaining_args)"""
+    if flag not in args:
+        return default, args
+    index = args.index(flag)
+    if index + 1 >= len(args):
+        fail(f"{flag} requires a value!")
+    try:
+        value = convert(args[index + 1])
+    except ValueError as e:
+        fail(f"Invalid value for {flag}: {args[index + 1]} ({e})")
+    return value, [arg for i, arg in enumerate(args) if i not in [index, index + 1]]
@@ -0,0 +1,89 @@
+"""
+Pluggable JSON codecs
+
+The servers parse and build JSON through a codec chosen at startup: the
+standard library by default, or orjson/ujson when installed. Every codec
+produces UTF-8 bytes in the same compact or indented layout, so responses
+only differ in edge cases (float formatting, NaN handling).
+"""
+
+import json
+
+COMPACT_SEPARATORS = (',', ':')
+
+# Tried in this order by --json-codec auto
+PREFERRED = ('orjson', 'ujson', 'stdlib')
+
+class JSONCodec:
+    """loads/dumps for one JSON library, plus the exceptions its parser raises"""
+
+    def __init__(self, name, loads, dumps_compact, dumps_pretty, errors):
+        self.name = name
+        self.loads = loads
+        self._dumps_compact = dumps_compact
+        self._dumps_pretty = dumps_pretty
+        self.errors = errors
+
+    def dumps(self, data, pretty=False):
+        """Serialize to UTF-8 bytes, compact unless pretty"""
+        return self._dumps_pretty(data) if pretty else self._dumps_compact(data)
+
+    def __repr__(self):
+        return f'JSONCodec({self.name!r})'
+
+def _stdlib():
+    return JSONCodec(
+        'stdlib',
+        json.loads,
+        lambda data: json.dumps(data, ensure_ascii=False, separators=COMPACT_SEPARATORS).encode('utf-8'),
+        lambda data: json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8'),
+        (json.JSONDecodeError,),
+    )
+
+def _orjson():
+    import orjson
+    return JSONCodec(
+        'orjson',
+        orjson.loads,
+        orjson.dumps,
+        lambda data: orjson.dumps(data, option=orjson.OPT_INDENT_2),
+        (orjson.JSONDecodeError,),
+    )
+
+def _ujson():
+    import ujson
+    return JSONCodec(
+        'ujson',
+        lambda data: ujson.loads(bytes(data) if isinstance(data, bytearray) else data),
+        lambda data: ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8'),
+        lambda data: ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False, indent=2).encode('utf-8'),
+        (ValueError,),
+    )
+
+_FACTORIES = {'stdlib': _stdlib, 'orjson': _orjson, 'ujson': _ujson}
+_codecs = {}
+CODECS = tuple(_FACTORIES) + ('auto',)
+
+def available_codecs():
+    """Codecs importable in this environment, in PREFERRED order"""
+    names = []
+    for name in PREFERRED:
+        try:
+            get_codec(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+def get_codec(name='stdlib'):
+    """Return the named codec; 'auto' picks the fastest one installed. Raises ImportError if missing."""
+    if name == 'auto':
+        name = available_codecs()[0]
+    codec = _codecs.get(name)
+    if codec is None:
+        codec = _codecs[name] = _FACTORIES[name]()
+    return codec
+
+def is_spliceable(body):
+    """True if a JSON body is UTF-8 and can be copied into a UTF-8 response unchanged"""
+    return json.detect_encoding(body) == 'utf-8'
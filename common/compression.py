@@ -0,0 +1,125 @@
+"""
+Negotiated HTTP response compression
+
+Responses at or above a size threshold are compressed with gzip or deflate,
+whichever the client prefers in Accept-Encoding. Compression is skipped when
+it saves too little to be worth the CPU. Input/output bytes and CPU time are
+tracked so the cost of compression can be weighed against the bandwidth it
+saves.
+
+Compressed bodies are not cached: every JSON response carries the client
+port and time, so no two are alike, and fixture files are sent uncompressed.
+"""
+
+import threading
+import time
+import zlib
+
+from common.cli import fail, pop_flag, pop_value
+
+# Server preference when the client accepts several encodings with the same q-value
+ENCODINGS = ('gzip', 'deflate')
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_LEVEL = 6
+
+# Send the body uncompressed unless compression saves at least this fraction
+MIN_SAVING = 0.1
+
+def negotiate(accept_encoding):
+    """Pick gzip or deflate from an Accept-Encoding header value, or None"""
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            qualities[name] = quality
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def compress(body, encoding, level=DEFAULT_LEVEL):
+    """Compress body as a gzip member (mtime 0) or a zlib stream (HTTP "deflate")"""
+    if encoding == 'deflate':
+        return zlib.compress(body, level)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+class ResponseCompressor:
+    """Compress response bodies and account for the bytes and CPU spent"""
+
+    def __init__(self, min_size=DEFAULT_MIN_SIZE, level=DEFAULT_LEVEL):
+        self.min_size = min_size
+        self.level = level
+        self._lock = threading.Lock()
+        self.compressed = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+    def compress(self, body, encoding):
+        """Return (compressed_body or None, cpu_seconds)
+
+        None means the body should be sent as is because compression saved
+        less than MIN_SAVING.
+        """
+        started = time.thread_time()
+        compressed = compress(body, encoding, self.level)
+        cpu_seconds = time.thread_time() - started
+        if len(compressed) > len(body) * (1.0 - MIN_SAVING):
+            compressed = None
+
+        with self._lock:
+            self.cpu_seconds += cpu_seconds
+            if compressed is None:
+                self.skipped += 1
+            else:
+                self.compressed += 1
+                self.bytes_in += len(body)
+                self.bytes_out += len(compressed)
+        return compressed, cpu_seconds
+
+    def report(self):
+        """Print the overall compression ratio and CPU cost per compressed response"""
+        print(f'Compression: gzip/deflate level {self.level}, bodies of {self.min_size} bytes or more')
+        print(f'  Compressed: {self.compressed} responses, '
+              f'skipped (saving under {MIN_SAVING:.0%}): {self.skipped}')
+        if self.compressed:
+            ratio = self.bytes_in / max(self.bytes_out, 1)
+            computed = self.compressed + self.skipped
+            print(f'  Bytes: {self.bytes_in} -> {self.bytes_out} (ratio {ratio:.2f}x)')
+            print(f'  CPU: {self.cpu_seconds * 1000:.1f}ms total, '
+                  f'{self.cpu_seconds * 1e6 / computed:.1f}us per compression')
+
+def pop_compression_args(args):
+    """Parse the compression options, returning (ResponseCompressor or None, remaining_args)"""
+    enabled, args = pop_flag(args, '--compress')
+    level, args = pop_value(args, '--compress-level', int)
+    min_size, args = pop_value(args, '--compress-min-size', int)
+    if level is None and min_size is None and not enabled:
+        return None, args
+    level = DEFAULT_LEVEL if level is None else level
+    min_size = DEFAULT_MIN_SIZE if min_size is None else min_size
+    if not 1 <= level <= 9:
+        fail("--compress-level must be between 1-9!")
+    if min_size < 0:
+        fail("--compress-min-size must be non-negative!")
+    return ResponseCompressor(min_size, level), args
+
+COMPRESSION_HELP = [
+    "  --compress        Compress responses with gzip or deflate when the client accepts it",
+    f"  --compress-level N  Compression level 1-9 (default: {DEFAULT_LEVEL}, implies --compress)",
+    f"  --compress-min-size bytes  Only compress larger bodies (default: {DEFAULT_MIN_SIZE}, implies --compress)",
+]
@@ -0,0 +1,227 @@
+"""
+Static fixture files for mock backends
+
+--fixtures DIR answers GET requests with files from DIR: /api/users is
+served from DIR/api/users, or DIR/api/users.json when there is no file of
+that exact name, and a directory from its index.json or index.html.
+
+Each request costs one stat() of the file. Files up to a size threshold are
+kept in memory in an LRU bounded by total bytes; larger files are sent from
+disk with sendfile so their contents never pass through Python. Responses
+carry ETag and Last-Modified, conditional requests are answered with 304
+and single byte ranges with 206 (416 when unsatisfiable).
+"""
+
+import mimetypes
+import os
+import stat
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import unquote
+
+from common.cli import fail, pop_value
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_CACHE_FILE = 256 * 1024  # Larger files are always sent with sendfile
+INDEX_FILES = ('index.json', 'index.html')
+RESOLVED_ENTRIES = 4096  # Request paths remembered with the file they resolved to
+
+class RangeNotSatisfiable(Exception):
+    """The Range header asks only for bytes beyond the end of the file"""
+
+class Fixture:
+    """One file: its validators and, when small enough, its contents"""
+    __slots__ = ('path', 'size', 'mtime_ns', 'content_type', 'etag', 'last_modified', 'headers', 'data')
+
+    def __init__(self, path, st, data=None):
+        self.path = path
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        content_type, encoding = mimetypes.guess_type(path)
+        if content_type is None or encoding is not None:
+            content_type = 'application/octet-stream'
+        elif content_type.startswith('text/') or content_type == 'application/json':
+            content_type += '; charset=utf-8'
+        self.content_type = content_type
+        self.etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+        # Validator headers sent with every response for this file
+        self.headers = ('ETag: %s\r\nLast-Modified: %s\r\nAccept-Ranges: bytes\r\n' % (
+            self.etag, self.last_modified)).encode('latin-1')
+        self.data = data
+
+class FixtureStore:
+    """Map request paths to files under root, caching small files in memory"""
+
+    def __init__(self, root, cache_bytes=DEFAULT_CACHE_BYTES, cache_max_file=DEFAULT_CACHE_FILE):
+        self.root = os.path.realpath(root)
+        self.cache_bytes = cache_bytes
+        self.cache_max_file = min(cache_max_file, cache_bytes)
+        self._cache = OrderedDict()  # file path -> Fixture with data
+        self._resolved = {}  # request path -> file path, so a repeated request costs a single stat()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.partial = 0
+        self.sendfile_bytes = 0
+        self.memory_bytes = 0
+
+    def lookup(self, url_path):
+        """Return the Fixture for a request path, or None if no file matches"""
+        path = url_path.split('?', 1)[0].split('#', 1)[0]
+        resolved = self._resolved.get(path)
+        if resolved is not None:
+            try:
+                st = os.stat(resolved)
+            except OSError:
+                st = None
+            if st is not None and stat.S_ISREG(st.st_mode):
+                return self._fixture(resolved, st)
+        
+        # Resolve against the root and refuse anything that escapes it (.., symlinks out)
+        try:
+            full = os.path.realpath(os.path.join(self.root, unquote(path).lstrip('/')))
+        except ValueError:
+            # An escaped NUL byte (%00) cannot name a file
+            return None
+        if full != self.root and not full.startswith(self.root + os.sep):
+            return None
+        for candidate in (full, full + '.json') + tuple(os.path.join(full, name) for name in INDEX_FILES):
+            try:
+                st = os.stat(candidate)
+            except (OSError, ValueError):
+                continue
+            if stat.S_ISREG(st.st_mode):
+                if len(self._resolved) >= RESOLVED_ENTRIES:
+                    self._resolved.clear()
+                self._resolved[path] = candidate
+                return self._fixture(candidate, st)
+        return None
+
+    def _fixture(self, path, st):
+        with self._lock:
+            fixture = self._cache.get(path)
+            if fixture is not None and fixture.mtime_ns == st.st_mtime_ns and fixture.size == st.st_size:
+                self._cache.move_to_end(path)
+                self.hits += 1
+                return fixture
+            self.misses += 1
+        if st.st_size > self.cache_max_file:
+            return Fixture(path, st)
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+                st = os.fstat(f.fileno())
+        except OSError:
+            return None
+        if len(data) != st.st_size:
+            # Changed while being read: send it from disk this time and cache it on a later request
+            return Fixture(path, st)
+        fixture = Fixture(path, st, data)
+        with self._lock:
+            previous = self._cache.pop(path, None)
+            if previous is not None:
+                self._cached_bytes -= previous.size
+            self._cache[path] = fixture
+            self._cached_bytes += fixture.size
+            while self._cached_bytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= evicted.size
+        return fixture
+
+    def count(self, fixture, status, sent):
+        """Account for one response: sent body bytes, split by memory or sendfile"""
+        with self._lock:
+            if status == 304:
+                self.not_modified += 1
+            elif status == 206:
+                self.partial += 1
+            if fixture.data is None:
+                self.sendfile_bytes += sent
+            else:
+                self.memory_bytes += sent
+
+    def report(self):
+        print(f'Fixtures: {self.root}')
+        print(f'  Lookups: {self.hits} cache hits, {self.misses} misses; '
+              f'{len(self._cache)} files ({self._cached_bytes} bytes) cached')
+        print(f'  Responses: {self.not_modified} not modified (304), {self.partial} partial (206)')
+        print(f'  Body bytes: {self.memory_bytes} from memory, {self.sendfile_bytes} from disk (sendfile)')
+
+def _etag_matches(header, etag):
+    """Weak comparison of an If-None-Match list against an ETag"""
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or (candidate[2:] if candidate.startswith('W/') else candidate) == etag:
+            return True
+    return False
+
+def not_modified(fixture, headers):
+    """True if the conditional request headers say the client's copy is current"""
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, fixture.etag)
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return False
+    return fixture.mtime_ns // 1_000_000_000 <= since
+
+def byte_range(fixture, headers):
+    """Return (start, end) of the requested single byte range, or None to send the whole file
+
+    Multiple ranges, malformed headers and a stale If-Range are answered
+    with the whole file, as RFC 9110 allows.
+    """
+    value = headers.get('Range')
+    if value is None or not value.startswith('bytes=') or ',' in value:
+        return None
+    if_range = headers.get('If-Range')
+    if if_range is not None and if_range not in (fixture.etag, fixture.last_modified):
+        return None
+    first, sep, last = value[6:].strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = int(last) + 1 if last else max(fixture.size, start + 1)
+            if start < 0 or end <= start:
+                return None
+        else:
+            # Suffix range: the last N bytes
+            suffix = int(last)
+            if suffix < 0:
+                return None
+            start, end = max(fixture.size - suffix, 0), fixture.size
+    except ValueError:
+        return None
+    if start >= fixture.size or start == end:
+        raise RangeNotSatisfiable()
+    return start, min(end, fixture.size)
+
+def pop_fixture_args(args):
+    """Parse --fixtures DIR and its cache limits, returning (FixtureStore or None, remaining_args)"""
+    root, args = pop_value(args, '--fixtures')
+    cache_bytes, args = pop_value(args, '--fixture-cache', int, DEFAULT_CACHE_BYTES)
+    cache_max_file, args = pop_value(args, '--fixture-cache-file', int, DEFAULT_CACHE_FILE)
+    if root is None:
+        return None, args
+    if not os.path.isdir(root):
+        fail(f"--fixtures directory '{root}' does not exist!")
+    if cache_bytes < 0 or cache_max_file < 0:
+        fail("--fixture-cache and --fixture-cache-file must be non-negative!")
+    return FixtureStore(root, cache_bytes, cache_max_file), args
+
+FIXTURES_HELP = [
+    "  --fixtures DIR    Serve GET requests from files in DIR (mock backend); unknown paths get 404",
+    f"  --fixture-cache bytes  Memory for cached small fixture files (default: {DEFAULT_CACHE_BYTES})",
+    f"  --fixture-cache-file bytes  Largest file kept in memory, larger ones use sendfile (default: {DEFAULT_CACHE_FILE})",
+]
@@ -0,0 +1,83 @@
+"""
+HDR-style latency histogram
+
+Values are bucketed log-linearly: every power-of-two range is split into 64
+equal sub-buckets, so any recorded value is reported with less than 1.6%
+relative error while the histogram stays a few KB regardless of how many
+values are recorded or how wide their range is.
+"""
+
+SUB_BUCKET_BITS = 7
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS  # 128
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1  # 64
+
+def _index(value):
+    bucket = max(value.bit_length() - SUB_BUCKET_BITS, 0)
+    return bucket * SUB_BUCKET_HALF + (value >> bucket)
+
+def _highest_equivalent(index):
+    """Largest value that maps to the same bucket as index"""
+    if index < SUB_BUCKET_COUNT:
+        return index
+    bucket = index // SUB_BUCKET_HALF - 1
+    sub_bucket = index - bucket * SUB_BUCKET_HALF
+    return ((sub_bucket + 1) << bucket) - 1
+
+class LatencyHistogram:
+    """Record non-negative integer values (e.g. microseconds) and report percentiles"""
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value):
+        value = max(int(value), 0)
+        index = _index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add all values recorded in another histogram"""
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """Value below which `percent` percent of the recorded values fall"""
+        if not self.count:
+            return 0
+        target = max(int(round(self.count * percent / 100.0)), 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(_highest_equivalent(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        """Dictionary of the usual latency statistics"""
+        return {
+            "count": self.count,
+            "min": self.min or 0,
+            "mean": round(self.mean(), 1),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "p999": self.percentile(99.9),
+            "max": self.max,
+        }
@@ -0,0 +1,160 @@
+"""
+Asynchronous request logging
+
+Request handlers put one record per request on a queue and return; a
+background writer thread formats the records and writes them in batches to
+stdout or a log file. Message formatting, timestamps and pretty-printing of
+request bodies all happen on the writer thread, off the request path.
+
+The queue holds at most QUEUE_SIZE records. When the output cannot keep up,
+new records are dropped and counted instead of queueing without limit; the
+count is printed when the logger is closed.
+"""
+
+import json
+import queue
+import random
+import sys
+import threading
+import time
+
+from common.cli import fail, pop_flag, pop_value
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+
+BATCH_SIZE = 512
+QUEUE_SIZE = 100000  # Records waiting for the writer before new ones are dropped
+_STOP = object()
+
+class PrettyJSON:
+    """Defer json.dumps(..., indent=2) of a logged value to the writer thread"""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return json.dumps(self.data, ensure_ascii=False, indent=2)
+
+class RawText:
+    """Defer decoding a logged request body to the writer thread"""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return bytes(self.data).decode('utf-8', errors='replace')
+
+class RequestLogger:
+    """Queue-backed logger with levels, request sampling and optional body logging"""
+
+    def __init__(self, level='info', sample_rate=1.0, log_body=True, output=None):
+        self.level = LEVELS[level]
+        self.sample_rate = sample_rate
+        self.log_body = log_body
+        self._stream = open(output, 'a', encoding='utf-8') if output else sys.stdout
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self.dropped = 0  # Records not logged because the queue was full
+        self._dropped_lock = threading.Lock()
+        self._writer = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._writer.start()
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, message, *args):
+        """Queue a message; it is %-formatted with args on the writer thread"""
+        if level >= self.level:
+            self._put((time.time(), message, args))
+
+    def debug(self, message, *args):
+        self.log(DEBUG, message, *args)
+
+    def info(self, message, *args):
+        self.log(INFO, message, *args)
+
+    def warning(self, message, *args):
+        self.log(WARNING, message, *args)
+
+    def error(self, message, *args):
+        self.log(ERROR, message, *args)
+
+    def request(self, message, *args):
+        """Queue an info-level per-request record, honoring --log-sample-rate"""
+        if INFO < self.level:
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        self._put((time.time(), message, args))
+
+    def close(self):
+        """Flush everything that is queued and stop the writer thread"""
+        # Blocks while the queue is full; the writer keeps draining it, so the stop marker gets in
+        self._queue.put(_STOP)
+        self._writer.join()
+        if self._stream is not sys.stdout:
+            self._stream.close()
+        if self.dropped:
+            print(f"Log writer: {self.dropped} records dropped because the log output fell behind")
+
+    def _put(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def _format(self, record):
+        timestamp, message, args = record
+        if args:
+            try:
+                message = message % args
+            except Exception as e:
+                message = f"{message!r} {args!r} (log formatting failed: {e})"
+        return f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))}] {message}"
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < BATCH_SIZE:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            stop = False
+            lines = []
+            for record in batch:
+                if record is _STOP:
+                    stop = True
+                else:
+                    lines.append(self._format(record))
+            if lines:
+                try:
+                    self._stream.write('\n'.join(lines) + '\n')
+                    self._stream.flush()
+                except (OSError, ValueError):
+                    pass
+            if stop:
+                return
+
+def pop_logger_args(args):
+    """Parse the shared logging options, returning (RequestLogger, remaining_args)"""
+    level, args = pop_value(args, '--log-level', str.lower, 'info')
+    if level not in LEVELS:
+        fail(f"Unknown log level '{level}'! Valid levels: {', '.join(LEVELS)}")
+    sample_rate, args = pop_value(args, '--log-sample-rate', float, 1.0)
+    if not 0.0 <= sample_rate <= 1.0:
+        fail("Log sample rate must be between 0 and 1!")
+    no_body, args = pop_flag(args, '--log-no-body')
+    output, args = pop_value(args, '--log-file')
+    return RequestLogger(level, sample_rate, not no_body, output), args
+
+LOGGER_HELP = [
+    "  --log-level name  Log level: debug, info, warning or error (default: info)",
+    "  --log-sample-rate r  Fraction of requests to log, 0-1 (default: 1)",
+    "  --log-no-body     Do not log request bodies",
+    "  --log-file path   Append logs to a file instead of stdout",
+]
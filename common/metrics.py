@@ -0,0 +1,278 @@
+"""
+Low-overhead metrics registry
+
+Counters and histograms are recorded into a per-thread shard, so the hot
+path is a dictionary update with no locking. Shards are merged only when the
+metrics are scraped, and shards of finished threads are folded into a
+retired total so thread-per-connection servers do not accumulate them.
+
+Metrics are exported in the Prometheus text format or as JSON. Servers only
+record anything when started with --metrics.
+"""
+
+import bisect
+import json
+import threading
+
+# Upper bounds in seconds for request latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Distinct label values kept per label name; the rest are reported as "other"
+MAX_LABEL_VALUES = 1000
+
+# Fold finished threads' shards into the retired totals every this many new shards
+FOLD_INTERVAL = 256
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class _Shard:
+    __slots__ = ('thread', 'counters', 'histograms')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+
+class MetricsRegistry:
+    """Counters, histograms and gauges with per-thread recording"""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._new_shards = 0
+        self._retired = _Shard(None)
+        self._meta = {}  # name -> (type, help, buckets)
+        self._gauges = {}  # name -> callable returning the current value
+        self._label_values = {}  # label name -> set of values seen
+
+    # Definitions
+
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ('histogram', help_text, tuple(buckets))
+
+    def gauge(self, name, help_text, function):
+        """Register a gauge whose value is read from function() at scrape time"""
+        self._meta[name] = ('gauge', help_text, None)
+        self._gauges[name] = function
+
+    def label(self, name, value):
+        """Bound the cardinality of a label fed from client input (e.g. the request path)"""
+        seen = self._label_values.setdefault(name, set())
+        if value in seen:
+            return value
+        if len(seen) >= MAX_LABEL_VALUES:
+            return 'other'
+        seen.add(value)
+        return value
+
+    # Recording (hot path)
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = _Shard(threading.current_thread())
+            self._local.shard = shard
+            with self._lock:
+                self._shards.append(shard)
+                self._new_shards += 1
+                if self._new_shards >= FOLD_INTERVAL:
+                    self._fold_finished()
+        return shard
+
+    def inc(self, name, labels=(), amount=1):
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        histograms = self._shard().histograms
+        key = (name, labels)
+        buckets = self._meta[name][2]
+        counts = histograms.get(key)
+        if counts is None:
+            counts = histograms[key] = [0] * (len(buckets) + 2)
+        counts[bisect.bisect_left(buckets, value)] += 1
+        counts[-1] += value
+
+    # Merging
+
+    @staticmethod
+    def _add(target, shard):
+        for key, value in shard.counters.copy().items():
+            target.counters[key] = target.counters.get(key, 0) + value
+        for key, counts in shard.histograms.copy().items():
+            merged = target.histograms.get(key)
+            if merged is None:
+                target.histograms[key] = list(counts)
+            else:
+                for i, count in enumerate(counts):
+                    merged[i] += count
+
+    def _fold_finished(self):
+        """Move shards of finished threads into the retired totals (lock held)"""
+        alive = []
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                alive.append(shard)
+            else:
+                self._add(self._retired, shard)
+        self._shards = alive
+        self._new_shards = 0
+
+    def collect(self):
+        """Merge all shards into one snapshot"""
+        snapshot = _Shard(None)
+        with self._lock:
+            self._fold_finished()
+            self._add(snapshot, self._retired)
+            for shard in self._shards:
+                self._add(snapshot, shard)
+        return snapshot
+
+    # Export
+
+    def to_prometheus(self):
+        snapshot = self.collect()
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'gauge':
+                lines.append(f'{name} {self._gauges[name]()}')
+            elif kind == 'counter':
+                for (metric, labels), value in sorted(snapshot.counters.items()):
+                    if metric == name:
+                        lines.append(f'{name}{_format_labels(labels)} {value}')
+            else:
+                for (metric, labels), counts in sorted(snapshot.histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',), counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {counts[-1]:.6f}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        snapshot = self.collect()
+        result = {}
+        for name, (kind, help_text, buckets) in self._meta.items():
+            if kind == 'gauge':
+                result[name] = self._gauges[name]()
+            elif kind == 'counter':
+                result[name] = [{"labels": dict(labels), "value": value}
+                                for (metric, labels), value in sorted(snapshot.counters.items()) if metric == name]
+            else:
+                series = []
+                for (metric, labels), counts in sorted(snapshot.histograms.items()):
+                    if metric == name:
+                        series.append({
+                            "labels": dict(labels),
+                            "buckets": {str(bound): count for bound, count in zip(buckets + ('+Inf',), counts)},
+                            "sum": round(counts[-1], 6),
+                            "count": sum(counts[:-1]),
+                        })
+                result[name] = series
+        return json.dumps(result, ensure_ascii=False, separators=(',', ':'))
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry():
+    """Process-wide registry shared by every server running in this process"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = MetricsRegistry()
+            _registry.gauge('process_threads', 'Live threads in the server process', threading.active_count)
+        return _registry
+
+def define_http_metrics(registry, active_connections):
+    registry.counter('http_requests_total', 'HTTP requests by method, path and status')
+    registry.histogram('http_request_duration_seconds', 'HTTP request latency by method and path')
+    registry.counter('http_received_bytes_total', 'Bytes received in HTTP requests')
+    registry.counter('http_sent_bytes_total', 'Bytes sent in HTTP responses')
+    registry.gauge('http_active_connections', 'Open HTTP connections', active_connections)
+
+# Upper bounds in seconds for the CPU time of compressing one response
+COMPRESSION_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05)
+
+def define_compression_metrics(registry):
+    registry.counter('http_compressed_responses_total', 'HTTP responses sent compressed, by encoding')
+    registry.counter('http_compression_skipped_total', 'HTTP responses sent uncompressed because compression did not pay off')
+    registry.counter('http_compression_input_bytes_total', 'Bytes before compression')
+    registry.counter('http_compression_output_bytes_total', 'Bytes after compression')
+    registry.histogram('http_compression_cpu_seconds', 'CPU time spent compressing one response', COMPRESSION_BUCKETS)
+
+def define_tls_metrics(registry):
+    registry.counter('tls_handshakes_total', 'Completed TLS handshakes by type (full or resumed) and protocol version')
+    registry.counter('tls_handshake_failures_total', 'TLS handshakes that failed or timed out')
+    registry.histogram('tls_handshake_duration_seconds', 'Time to complete one TLS handshake, by type')
+
+def define_stream_metrics(registry, subscribers):
+    registry.gauge('http_stream_subscribers', 'Open GET /stream connections', subscribers)
+    registry.counter('http_stream_events_total', 'Events broadcast to /stream subscribers')
+    registry.counter('http_stream_sent_bytes_total', 'Bytes written to /stream subscribers')
+    registry.counter('http_stream_disconnects_total', 'Ended /stream connections by reason (closed by the client or too slow)')
+
+def define_udp_metrics(registry):
+    registry.counter('udp_datagrams_received_total', 'UDP datagrams received')
+    registry.counter('udp_datagrams_sent_total', 'UDP datagrams sent')
+    registry.counter('udp_datagrams_truncated_total', 'UDP datagrams larger than the receive buffer')
+    registry.counter('udp_kernel_drops_total', 'UDP datagrams dropped by the kernel because the receive buffer was full')
+    registry.counter('udp_received_bytes_total', 'Bytes received in UDP datagrams')
+    registry.counter('udp_sent_bytes_total', 'Bytes sent in UDP datagrams')
+    registry.counter('udp_send_errors_total', 'UDP replies the socket refused to send, e.g. larger than 65507 bytes')
+
+def define_reply_cache_metrics(registry, entries):
+    registry.counter('udp_reply_cache_hits_total', 'Repeated UDP requests answered with a cached reply')
+    registry.counter('udp_reply_cache_misses_total', 'UDP requests whose reply had to be built')
+    registry.counter('udp_reply_cache_evictions_total', 'Cached UDP replies dropped, by reason (size or ttl)')
+    registry.gauge('udp_reply_cache_entries', 'UDP replies currently cached', entries)
+
+def wants_json(path, accept):
+    """True when a /metrics request asks for JSON instead of the Prometheus format"""
+    return 'format=json' in path or 'application/json' in (accept or '')
+
+def start_metrics_server(port, registry):
+    """Serve /metrics on a background thread (used by servers without their own HTTP endpoint)"""
+    # Imported here: http.server is a large import the UDP server otherwise never needs
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            if wants_json(self.path, self.headers.get('Accept')):
+                body, content_type = registry.to_json().encode('utf-8'), 'application/json'
+            else:
+                body, content_type = registry.to_prometheus().encode('utf-8'), PROMETHEUS_CONTENT_TYPE
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
@@ -0,0 +1,66 @@
+"""
+Command line options shared by the HTTP and UDP servers
+
+Each server pops its own options and uses these helpers for the rest, so
+python http/http_server.py, python udp/udp_server.py and
+python simple-server.py http|udp|both accept the same flags. Parsed options
+are returned as run_server() keyword arguments.
+"""
+
+from common.capture import pop_record_args
+from common.cli import fail, pop_flag, pop_value
+from common.logger import pop_logger_args
+
+def pop_common_args(args):
+    """Parse the options every server accepts, returning (options, remaining_args)"""
+    options = {}
+    # Logging options (--log-level, --log-sample-rate, --log-no-body, --log-file)
+    options['logger'], args = pop_logger_args(args)
+    options['metrics'], args = pop_flag(args, '--metrics')
+    options['reuse_port'], args = pop_flag(args, '--reuse-port')
+    options['delay_ms'], args = pop_value(args, '--delay', int, 0)
+    if options['delay_ms'] < 0:
+        fail("Delay must be non-negative!")
+    # Traffic capture (--record FILE), shared by both servers in both mode
+    options['recorder'], args = pop_record_args(args)
+    return options, args
+
+def pop_engine(args, engines, default, flag='--engine', sized=()):
+    """Parse `flag name [N]`, returning (engine, N or None, remaining_args)
+
+    N is only accepted after the engines listed in sized, e.g. --engine threads 8.
+    """
+    if flag not in args:
+        return default, None, args
+    index = args.index(flag)
+    if index + 1 >= len(args) or args[index + 1].lower() not in engines:
+        fail(f"{flag} must be one of: {', '.join(engines)}")
+    engine = args[index + 1].lower()
+    remove = [index, index + 1]
+    size = None
+    if engine in sized and index + 2 < len(args) and args[index + 2].isdigit():
+        size = int(args[index + 2])
+        remove.append(index + 2)
+        if size < 1:
+            fail("Thread count must be at least 1!")
+    return engine, size, [arg for i, arg in enumerate(args) if i not in remove]
+
+def pop_ports(args, defaults):
+    """Parse the positional port numbers left after all options; anything else is an error"""
+    for arg in args:
+        if arg.startswith('-'):
+            fail(f"Unknown option '{arg}'")
+    if len(args) > len(defaults):
+        fail(f"Unexpected arguments: {' '.join(args[len(defaults):])}")
+    ports = list(defaults)
+    for i, arg in enumerate(args):
+        try:
+            ports[i] = int(arg)
+        except ValueError:
+            fail("Port number must be an integer!")
+        if not 1 <= ports[i] <= 65535:
+            fail("Port number must be between 1-65535!")
+    return ports
+
+def wants_help(args):
+    return '-h' in args or '--help' in args
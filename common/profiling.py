@@ -0,0 +1,303 @@
+"""
+Profiling a running server
+
+With --profile the HTTP server answers two debug endpoints:
+
+  /debug/profile?seconds=N  CPU profile of the next N seconds. mode=sample
+                            (default) samples the stacks of every thread;
+                            mode=cprofile runs cProfile in each handler
+                            thread for every request in the window and
+                            merges the results.
+  /debug/heap?seconds=N     tracemalloc snapshot of the allocations made in
+                            the next N seconds that are still alive.
+
+Sampling is a wall-clock view of what every thread is doing, including
+blocking socket calls (threads holding the GIL are mostly caught as they
+release it); cProfile attributes the CPU time of the requests themselves.
+Results are text by default; format=collapsed gives collapsed stacks for
+flamegraph.pl or speedscope and format=pstats (cprofile mode) a file for
+pstats/snakeviz. Without --profile none of this is installed: the handlers
+are the plain classes and no request pays for a check.
+"""
+
+import cProfile
+import io
+import linecache
+import marshal
+import os
+import pstats
+import re
+import sys
+import threading
+import tracemalloc
+
+DEFAULT_SECONDS = 10.0
+MAX_SECONDS = 300.0
+DEFAULT_TOP = 40
+SAMPLE_INTERVAL_MS = 5.0
+HEAP_FRAMES = 16  # Stack depth kept for every traced allocation
+# Leaf frames of threads that are waiting rather than working; their samples are dropped unless idle=1.
+# The log and capture writer loops block in SimpleQueue.get(); their formatting work runs in deeper frames.
+IDLE_FRAMES = {('socket.py', 'readinto'), ('selectors.py', 'select'), ('threading.py', 'wait'),
+               ('queue.py', 'get'), ('socketserver.py', 'serve_forever'), ('logger.py', '_run'),
+               ('capture.py', '_run')}
+PROFILE_FORMATS = {'sample': ('text', 'collapsed'), 'cprofile': ('text', 'pstats')}
+HEAP_FORMATS = ('text', 'collapsed')
+
+class ProfileError(Exception):
+    """A debug request that cannot be served, with the HTTP status to answer it with"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+def _param(query, name, convert=str, default=None):
+    values = query.get(name)
+    if not values:
+        return default
+    try:
+        return convert(values[-1])
+    except ValueError:
+        raise ProfileError(f"Invalid value for {name}: {values[-1]}")
+
+def _frame_label(code, labels):
+    """'function (file.py:line)' for a code object, cached since the same code is seen in every sample"""
+    label = labels.get(code)
+    if label is None:
+        label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        label = labels[code] = label.replace(';', ':')
+    return label
+
+def _thread_role(name):
+    """Group per-connection threads: 'Thread-12 (process_request_thread)' -> 'Thread (process_request_thread)'"""
+    return re.sub(r'-\d+', '', name)
+
+def _top_functions(counts, total, top):
+    """Text table of the functions with the most samples, on the stack (total) and at the top (self)"""
+    inclusive = {}
+    exclusive = {}
+    for stack, count in counts.items():
+        exclusive[stack[-1]] = exclusive.get(stack[-1], 0) + count
+        for frame in set(stack[1:]):
+            inclusive[frame] = inclusive.get(frame, 0) + count
+    lines = [f"{'Self %':>8}{'Total %':>9}  Function"]
+    for frame, count in sorted(exclusive.items(), key=lambda item: -item[1])[:top]:
+        lines.append(f"{count * 100.0 / total:>8.1f}{inclusive.get(frame, count) * 100.0 / total:>9.1f}  {frame}")
+    return lines
+
+class SampleSession:
+    """Sample the Python stack of every thread at a fixed interval"""
+    endpoint = 'profile'
+
+    def __init__(self, seconds, fmt, top, interval, idle, waiter):
+        self.seconds = seconds
+        self.format = fmt
+        self.top = top
+        self.interval = interval
+        self.idle = idle
+        self.waiter = waiter  # Thread waiting for the result, left out of the samples
+        self.counts = {}  # (thread role, outermost frame, ..., innermost frame) -> samples
+        self.samples = 0
+        self.idle_samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        labels = {}
+        names = {}
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me or ident == self.waiter:
+                    continue
+                code = frame.f_code
+                if not self.idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    self.idle_samples += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code, labels))
+                    frame = frame.f_back
+                name = names.get(ident)
+                if name is None:
+                    names.update((thread.ident, _thread_role(thread.name)) for thread in threading.enumerate())
+                    name = names.get(ident, 'thread')
+                stack.append(name)
+                key = tuple(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+                self.samples += 1
+
+    def finish(self):
+        self._stop.set()
+        self._thread.join()
+        if self.format == 'collapsed':
+            ordered = sorted(self.counts.items(), key=lambda item: -item[1])
+            lines = [f"{';'.join(stack)} {count}" for stack, count in ordered]
+            return '\n'.join(lines) + '\n', 'text/plain; charset=utf-8', 'profile.collapsed'
+        lines = [f"Stack samples over {self.seconds:g}s every {self.interval * 1000:g}ms: {self.samples} "
+                 f"({self.idle_samples} idle samples left out{'' if self.idle else ', idle=1 keeps them'})"]
+        if self.samples:
+            threads = {}
+            for stack, count in self.counts.items():
+                threads[stack[0]] = threads.get(stack[0], 0) + count
+            lines.append('')
+            lines.append('Samples by thread:')
+            for name, count in sorted(threads.items(), key=lambda item: -item[1]):
+                lines.append(f"{count * 100.0 / self.samples:>8.1f}%  {name}")
+            lines.append('')
+            lines.extend(_top_functions(self.counts, self.samples, self.top))
+        return '\n'.join(lines) + '\n', 'text/plain; charset=utf-8', None
+
+class CProfileSession:
+    """cProfile every request handled in the window, one Profile per handler thread, merged at the end"""
+    endpoint = 'profile'
+
+    def __init__(self, seconds, fmt, top):
+        self.seconds = seconds
+        self.format = fmt
+        self.top = top
+        self.profiles = {}  # thread ident -> Profile, enabled only while that thread handles a request
+        self.requests = 0
+        self.skipped = 0
+        self.in_flight = 0
+        self._done = threading.Condition()
+
+    def request_started(self):
+        """Called by a handler thread before it parses a request; returns the enabled Profile or None"""
+        profile = self.profiles.get(threading.get_ident())
+        if profile is None:
+            profile = self.profiles[threading.get_ident()] = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ runs one profiler per process; another thread's request holds it
+            with self._done:
+                self.skipped += 1
+            return None
+        with self._done:
+            self.in_flight += 1
+        return profile
+
+    def request_finished(self, profile):
+        profile.disable()
+        with self._done:
+            self.requests += 1
+            self.in_flight -= 1
+            self._done.notify_all()
+
+    def finish(self):
+        with self._done:
+            # Requests still running get a moment to finish so their profiles can be merged
+            self._done.wait_for(lambda: self.in_flight == 0, timeout=1.0)
+            profiles = list(self.profiles.values())
+        profiles = [profile for profile in profiles if profile.getstats()]
+        if not profiles:
+            return (f"No requests were profiled in {self.seconds:g}s ({self.skipped} skipped)\n",
+                    'text/plain; charset=utf-8', None)
+        stream = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=stream)
+        if self.format == 'pstats':
+            return marshal.dumps(stats.stats), 'application/octet-stream', 'profile.pstats'
+        stream.write(f"cProfile of {self.requests} requests in {len(profiles)} threads over {self.seconds:g}s"
+                     + (f" ({self.skipped} skipped: another request held the profiler)" if self.skipped else '')
+                     + '\n')
+        stats.sort_stats('cumulative').print_stats(self.top)
+        return stream.getvalue(), 'text/plain; charset=utf-8', None
+
+class HeapSession:
+    """Trace allocations for the window and report those still alive at the end"""
+    endpoint = 'heap'
+
+    def __init__(self, seconds, fmt, top):
+        self.seconds = seconds
+        self.format = fmt
+        self.top = top
+        # Tracing slows every allocation down, so it only runs while a snapshot is being collected
+        self.started_here = not tracemalloc.is_tracing()
+        if self.started_here:
+            tracemalloc.start(HEAP_FRAMES)
+
+    def finish(self):
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if self.started_here:
+            tracemalloc.stop()
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+        ])
+        if self.format == 'collapsed':
+            lines = []
+            for stat in snapshot.statistics('traceback'):
+                stack = ';'.join(f"{os.path.basename(frame.filename)}:{frame.lineno}" for frame in stat.traceback)
+                lines.append(f"{stack} {stat.size}")
+            return '\n'.join(lines) + '\n', 'text/plain; charset=utf-8', 'heap.collapsed'
+        stats = snapshot.statistics('lineno')
+        lines = [f"Allocations made in {self.seconds:g}s and still alive: {sum(s.size for s in stats)} bytes "
+                 f"in {sum(s.count for s in stats)} blocks (traced peak {peak} bytes, now {current})",
+                 '']
+        for stat in stats[:self.top]:
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size:>12} bytes {stat.count:>8} blocks  {frame.filename}:{frame.lineno}")
+            source = linecache.getline(frame.filename, frame.lineno).strip()
+            if source:
+                lines.append(f"{'':>37}{source}")
+        return '\n'.join(lines) + '\n', 'text/plain; charset=utf-8', None
+
+class Profiler:
+    """Start and finish debug sessions, one CPU profile and one heap snapshot at a time"""
+
+    def __init__(self):
+        self.cprofile = None  # CProfileSession the handler threads report to while it runs
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def start(self, endpoint, query, waiter=None):
+        """Start a session for /debug/profile or /debug/heap with the parsed query string
+
+        waiter is the thread that will sleep until the result is ready,
+        which stack sampling leaves out.
+        """
+        seconds = _param(query, 'seconds', float, DEFAULT_SECONDS)
+        if not 0 < seconds <= MAX_SECONDS:
+            raise ProfileError(f"seconds must be between 0 and {MAX_SECONDS:g}")
+        top = _param(query, 'top', int, DEFAULT_TOP)
+        if top < 1:
+            raise ProfileError("top must be at least 1")
+        if endpoint == 'heap':
+            fmt = _param(query, 'format', str.lower, 'text')
+            if fmt not in HEAP_FORMATS:
+                raise ProfileError(f"format must be one of: {', '.join(HEAP_FORMATS)}")
+        else:
+            mode = _param(query, 'mode', str.lower, 'sample')
+            if mode not in PROFILE_FORMATS:
+                raise ProfileError(f"mode must be one of: {', '.join(PROFILE_FORMATS)}")
+            fmt = _param(query, 'format', str.lower, 'text')
+            if fmt not in PROFILE_FORMATS[mode]:
+                raise ProfileError(f"format for mode={mode} must be one of: {', '.join(PROFILE_FORMATS[mode])}")
+            interval = _param(query, 'interval_ms', float, SAMPLE_INTERVAL_MS)
+            if not 0.1 <= interval <= 1000:
+                raise ProfileError("interval_ms must be between 0.1 and 1000")
+            idle = _param(query, 'idle', str, '0') not in ('0', 'false', '')
+
+        with self._lock:
+            if endpoint in self._running:
+                raise ProfileError(f"A /debug/{endpoint} session is already running", 409)
+            self._running.add(endpoint)
+        if endpoint == 'heap':
+            return HeapSession(seconds, fmt, top)
+        if mode == 'sample':
+            return SampleSession(seconds, fmt, top, interval / 1000.0, idle, waiter)
+        self.cprofile = CProfileSession(seconds, fmt, top)
+        return self.cprofile
+
+    def finish(self, session):
+        """Stop a session and return (body, content_type, download filename or None)"""
+        if session is self.cprofile:
+            self.cprofile = None
+        try:
+            return session.finish()
+        finally:
+            with self._lock:
+                self._running.discard(session.endpoint)
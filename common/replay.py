@@ -0,0 +1,263 @@
+"""
+Replay of traffic captured with --record
+
+The capture is memory-mapped and its records are sent again with the
+original spacing scaled by --speed (1 = real time, 2 = twice as fast, max =
+as fast as the server answers). HTTP requests go out over a pool of
+keep-alive connections with their recorded method, path, headers and body;
+UDP payloads are sent from one socket. The report shows how far actual send
+times strayed from the schedule, so a replay that could not keep up is
+visible instead of silently stretching the traffic.
+"""
+
+import asyncio
+import mmap
+import os
+import socket
+import time
+
+from common.bench import Results, read_http_response
+from common.capture import HTTP, MAGIC, CaptureError, iter_records
+from common.cli import fail, pop_value
+from common.histogram import LatencyHistogram
+
+# Replaced with values for the replay connection; Content-Length is recomputed from the recorded body
+SKIP_HEADERS = {b'host', b'content-length', b'transfer-encoding', b'connection', b'keep-alive', b'expect'}
+YIELD_EVERY = 16  # At max speed, let the event loop read replies after this many sends
+# Event loop timers wake up to a millisecond late, so the last stretch before a send is spent yielding
+SPIN_MARGIN = 0.002
+UDP_RCVBUF = 4 * 1024 * 1024  # Room for replies that arrive while the replay is busy sending
+
+def build_http_request(method, path, headers, body, host):
+    """Raw HTTP/1.1 keep-alive request bytes for one recorded request"""
+    method = bytes(method)
+    lines = [b'%s %s HTTP/1.1' % (method, path), b'Host: ' + host]
+    for line in bytes(headers).split(b'\r\n'):
+        name = line.partition(b':')[0].strip().lower()
+        if name and name not in SKIP_HEADERS:
+            lines.append(line)
+    if body or method in (b'POST', b'PUT', b'PATCH'):
+        lines.append(b'Content-Length: %d' % len(body))
+    return b'\r\n'.join(lines) + b'\r\n\r\n' + body
+
+async def _wait_until(planned):
+    delay = planned - time.perf_counter() - SPIN_MARGIN
+    if delay > 0:
+        await asyncio.sleep(delay)
+    while time.perf_counter() < planned:
+        await asyncio.sleep(0)
+
+def _udp_socket(host, port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+    except OSError:
+        pass
+    s.connect((host, port))
+    return s
+
+class _ReplyCounter(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.replies = 0
+        self.errors = 0
+
+    def datagram_received(self, data, addr):
+        self.replies += 1
+
+    def error_received(self, exc):
+        self.errors += 1
+
+class Replay:
+    """Send the records of one capture and collect timing and response statistics"""
+
+    def __init__(self, options):
+        self.options = options
+        self.speed = options['speed']
+        self.schedule_error = LatencyHistogram()  # Microseconds between planned and actual send time
+        self.http = Results()
+        self.http_sent = 0
+        self.udp_sent = 0
+        self.udp = None
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.started = self.finished = None
+        self._idle = []  # Keep-alive connections waiting for the next request
+        self._slots = None
+
+    async def run(self, records):
+        options = self.options
+        loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(options['connections'])
+        host = ('%s:%d' % (options['host'], options['http_port'])).encode('ascii')
+        transport = None
+        tasks = set()
+        self.started = time.perf_counter()
+        try:
+            for index, (timestamp, kind, fields) in enumerate(records):
+                if self.first_timestamp is None:
+                    self.first_timestamp = timestamp
+                self.last_timestamp = max(timestamp, self.last_timestamp or timestamp)
+                planned = None
+                if self.speed:
+                    planned = self.started + max(timestamp - self.first_timestamp, 0.0) / self.speed
+                    await _wait_until(planned)
+                elif index % YIELD_EVERY == 0:
+                    await asyncio.sleep(0)
+
+                if kind == HTTP:
+                    # Waits here when every connection is busy; the lateness then shows in the schedule error
+                    await self._slots.acquire()
+                    task = asyncio.create_task(self._send_http(build_http_request(*fields, host), planned))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    self.http_sent += 1
+                else:
+                    if transport is None:
+                        transport, self.udp = await loop.create_datagram_endpoint(
+                            _ReplyCounter, sock=_udp_socket(options['host'], options['udp_port']))
+                    if planned is not None:
+                        self.schedule_error.record((time.perf_counter() - planned) * 1e6)
+                    transport.sendto(fields[2])
+                    self.udp_sent += 1
+            if tasks:
+                await asyncio.gather(*tasks)
+            self.finished = time.perf_counter()
+            # Give the last datagrams' replies a chance to arrive
+            deadline = time.perf_counter() + options['timeout']
+            while self.udp is not None and self.udp.replies < self.udp_sent and time.perf_counter() < deadline:
+                await asyncio.sleep(0.01)
+        finally:
+            self.finished = self.finished or time.perf_counter()
+            for _, writer in self._idle:
+                writer.close()
+            if transport is not None:
+                transport.close()
+
+    async def _send_http(self, request, planned):
+        options = self.options
+        connection = self._idle.pop() if self._idle else None
+        try:
+            if connection is None:
+                connection = await asyncio.wait_for(
+                    asyncio.open_connection(options['host'], options['http_port']), options['timeout'])
+            reader, writer = connection
+            sent = time.perf_counter()
+            if planned is not None:
+                self.schedule_error.record((sent - planned) * 1e6)
+            writer.write(request)
+            status, keep_alive = await asyncio.wait_for(read_http_response(reader), options['timeout'])
+        except asyncio.TimeoutError:
+            self.http.error('timeout')
+            keep_alive = False
+        except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+            self.http.error(type(e).__name__)
+            keep_alive = False
+        else:
+            self.http.success(sent, status)
+        finally:
+            self._slots.release()
+        if connection is not None:
+            if keep_alive:
+                self._idle.append(connection)
+            else:
+                connection[1].close()
+
+    def report(self, path):
+        options = self.options
+        records = self.http_sent + self.udp_sent
+        span = (self.last_timestamp - self.first_timestamp) if records else 0.0
+        elapsed = (self.finished or time.perf_counter()) - self.started if self.started else 0.0
+        speed = f"{self.speed:g}x" if self.speed else 'max speed'
+        print('=' * 60)
+        print(f"Replay of {path} at {speed} to {options['host']} "
+              f"(HTTP port {options['http_port']}, UDP port {options['udp_port']})")
+        print('-' * 60)
+        print(f"Records: {records} (HTTP {self.http_sent}, UDP {self.udp_sent}) spanning {span:.3f}s as recorded")
+        line = f"Elapsed: {elapsed:.3f}s"
+        if self.speed:
+            line += f" (schedule: {span / self.speed:.3f}s)"
+        if span > 0 and elapsed > 0:
+            line += f"; rate {records / elapsed:.1f}/s, recorded {records / span:.1f}/s"
+        print(line)
+        if self.schedule_error.count:
+            error = self.schedule_error.summary()
+            print(f"Send time behind schedule: mean {_ms(error['mean'])}, p50 {_ms(error['p50'])}, "
+                  f"p99 {_ms(error['p99'])}, p99.9 {_ms(error['p999'])}, max {_ms(error['max'])}")
+        if self.http_sent:
+            latency = self.http.histogram.summary()
+            print(f"HTTP: {self.http.histogram.count} answered, errors: {self.http.errors}, "
+                  f"status codes: {dict(sorted(self.http.status_codes.items(), key=str))}")
+            print(f"  Latency: p50 {_ms(latency['p50'])}  p99 {_ms(latency['p99'])}  max {_ms(latency['max'])}")
+        if self.udp_sent:
+            replies = self.udp.replies if self.udp is not None else 0
+            errors = f", {self.udp.errors} socket errors" if self.udp is not None and self.udp.errors else ''
+            print(f"UDP: {self.udp_sent} sent, {replies} replies{errors}")
+        print('=' * 60)
+
+def _ms(us):
+    return f"{us / 1000.0:.2f}ms"
+
+def _speed(value):
+    if value.lower() == 'max':
+        return 0.0
+    speed = float(value)
+    if speed <= 0:
+        raise ValueError("must be positive or max")
+    return speed
+
+def show_help():
+    print("Replay - Send traffic captured with --record to a server again")
+    print()
+    print("Usage: python simple-server.py replay FILE [options]")
+    print()
+    print("Options:")
+    print("  --host host       Server address (default: 127.0.0.1)")
+    print("  --http-port port  Port for recorded HTTP requests (default: 8000)")
+    print("  --udp-port port   Port for recorded UDP datagrams (default: 9000)")
+    print("  --speed X         Replay speed: 1 = recorded timing, 2 = twice as fast, max = no pauses (default: 1)")
+    print("  --connections N   Most HTTP requests in flight, each on its own keep-alive connection (default: 64)")
+    print("  --timeout S       Per-request timeout and wait for the last UDP replies in seconds (default: 5)")
+    print()
+    print("Examples:")
+    print("  python simple-server.py http --record traffic.bin          # Capture while clients run")
+    print("  python simple-server.py replay traffic.bin                 # Same traffic, same timing")
+    print("  python simple-server.py replay traffic.bin --speed 10      # Ten times the recorded rate")
+    print("  python simple-server.py replay traffic.bin --speed max --http-port 8080")
+    print()
+    print("Streamed POST /echo and /discard bodies are not captured and are replayed as empty bodies.")
+
+def main(args):
+    if not args or args[0] in ['-h', '--help']:
+        show_help()
+        return
+    path, args = args[0], args[1:]
+    options = {}
+    options['host'], args = pop_value(args, '--host', str, '127.0.0.1')
+    options['http_port'], args = pop_value(args, '--http-port', int, 8000)
+    options['udp_port'], args = pop_value(args, '--udp-port', int, 9000)
+    options['speed'], args = pop_value(args, '--speed', _speed, 1.0)
+    options['connections'], args = pop_value(args, '--connections', int, 64)
+    options['timeout'], args = pop_value(args, '--timeout', float, 5.0)
+    if args:
+        fail(f"Unknown arguments: {' '.join(args)}")
+    if options['connections'] < 1:
+        fail("--connections must be at least 1!")
+
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < len(MAGIC):
+                fail(f"'{path}' is not a capture file (too short)")
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError as e:
+        fail(f"Cannot open '{path}': {e}")
+    if data[:len(MAGIC)] != MAGIC:
+        fail(f"'{path}' is not a capture file written by --record")
+
+    replay = Replay(options)
+    try:
+        asyncio.run(replay.run(iter_records(data)))
+    except KeyboardInterrupt:
+        print("\nReplay interrupted")
+    except CaptureError as e:
+        print(f"Error: capture file is damaged: {e}")
+    replay.report(path)
@@ -0,0 +1,141 @@
+"""
+Idempotent reply cache for the UDP server
+
+UDP clients resend a request when its reply does not arrive in time, and
+under packet loss these retries multiply the work the server does. With
+--reply-cache the encoded reply to each request is kept for --reply-cache-ttl
+seconds, keyed by the peer address and a request ID. A duplicate within the
+TTL gets the cached bytes back without being decoded or serialized again.
+
+The request ID is the value of a JSON field of the payload with
+--reply-cache-field NAME, otherwise (and for payloads without that field) a
+128 bit BLAKE2 digest of the payload. The cache holds at most
+--reply-cache-size replies; the least recently used one is evicted first.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from common.cli import fail, pop_flag, pop_value
+
+DEFAULT_TTL = 5.0
+DEFAULT_SIZE = 10000
+
+class ReplyCache:
+    """Encoded replies by (peer, request ID), bounded by count (LRU) and age (TTL)"""
+
+    def __init__(self, ttl=DEFAULT_TTL, size=DEFAULT_SIZE, field=None):
+        self.ttl = ttl
+        self.size = size
+        self.field = field
+        self._marker = None if field is None else json.dumps(field).encode('utf-8')
+        self._entries = OrderedDict()  # key -> (expires, reply), least recently used first
+        self._lock = threading.Lock()
+        self.metrics = None  # MetricsRegistry with --metrics, set by the server
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0  # Dropped to stay within size
+        self.expired = 0  # Dropped because their TTL passed
+        self.bytes = 0  # Reply bytes currently cached
+
+    def key(self, data, addr):
+        """Cache key for a datagram: the peer and its request ID field or payload digest"""
+        if self._marker is not None:
+            # The engines pass memoryviews, which have no substring search
+            payload = bytes(data)
+        # Only parse payloads that mention the field, so the miss path stays cheap for everything else
+        if self._marker is not None and self._marker in payload:
+            try:
+                request_id = json.loads(payload).get(self.field)
+            except (ValueError, AttributeError):
+                request_id = None
+            if isinstance(request_id, (str, int)) and not isinstance(request_id, bool):
+                return addr, request_id
+        return addr, hashlib.blake2b(data, digest_size=16).digest()
+
+    def get(self, key):
+        """The cached reply for key, or None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                hit = True
+            else:
+                if entry is not None:
+                    del self._entries[key]
+                    self.bytes -= len(entry[1])
+                    self.expired += 1
+                self.misses += 1
+                hit = False
+        if self.metrics is not None:
+            self.metrics.inc('udp_reply_cache_hits_total' if hit else 'udp_reply_cache_misses_total')
+            if entry is not None and not hit:
+                self.metrics.inc('udp_reply_cache_evictions_total', (('reason', 'ttl'),))
+        return entry[1] if hit else None
+
+    def put(self, key, reply):
+        now = time.monotonic()
+        evicted = expired = 0
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= len(previous[1])
+            self._entries[key] = (now + self.ttl, reply)
+            self.bytes += len(reply)
+            # Entries are mostly in insertion order, so expired ones collect at the front
+            while self._entries:
+                oldest_key, (expires, oldest) = next(iter(self._entries.items()))
+                if len(self._entries) > self.size:
+                    evicted += 1
+                elif expires <= now:
+                    expired += 1
+                else:
+                    break
+                del self._entries[oldest_key]
+                self.bytes -= len(oldest)
+            self.evicted += evicted
+            self.expired += expired
+        if self.metrics is not None and (evicted or expired):
+            if evicted:
+                self.metrics.inc('udp_reply_cache_evictions_total', (('reason', 'size'),), evicted)
+            if expired:
+                self.metrics.inc('udp_reply_cache_evictions_total', (('reason', 'ttl'),), expired)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        print(f"Reply cache: {len(self._entries)} replies ({self.bytes} bytes) cached, "
+              f"key: {f'JSON field {self.field!r}' if self.field else 'payload digest'}, TTL {self.ttl:g}s")
+        print(f"  Lookups: {self.hits} hits, {self.misses} misses"
+              f"{f' ({self.hits * 100.0 / lookups:.1f}% duplicates answered from cache)' if lookups else ''}; "
+              f"evicted: {self.evicted} (size), {self.expired} (TTL)")
+
+def pop_reply_cache_args(args):
+    """Parse the reply cache options, returning (ReplyCache or None, remaining_args)"""
+    enabled, args = pop_flag(args, '--reply-cache')
+    ttl, args = pop_value(args, '--reply-cache-ttl', float)
+    size, args = pop_value(args, '--reply-cache-size', int)
+    field, args = pop_value(args, '--reply-cache-field')
+    if not enabled and ttl is None and size is None and field is None:
+        return None, args
+    ttl = DEFAULT_TTL if ttl is None else ttl
+    size = DEFAULT_SIZE if size is None else size
+    if ttl <= 0:
+        fail("--reply-cache-ttl must be positive!")
+    if size < 1:
+        fail("--reply-cache-size must be at least 1!")
+    return ReplyCache(ttl, size, field), args
+
+REPLY_CACHE_HELP = [
+    "  --reply-cache     Answer a peer's retried requests with the reply already sent (implied by the options below)",
+    f"  --reply-cache-ttl s  Seconds a reply is reused for (default: {DEFAULT_TTL:g})",
+    f"  --reply-cache-size N  Replies kept, least recently used evicted first (default: {DEFAULT_SIZE})",
+    "  --reply-cache-field name  Request ID from this JSON field instead of a payload digest",
+]
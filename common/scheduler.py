@@ -0,0 +1,70 @@
+"""
+Timer scheduler for delayed responses
+
+Servers hand delayed replies to a DelayScheduler instead of sleeping in the
+request path. A single timer thread keeps the pending callbacks in a heap
+ordered by deadline and runs each one as soon as it is due, so the number of
+delayed replies in flight is bounded by memory rather than by threads.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+class DelayScheduler:
+    """Run callbacks after a delay from one background timer thread"""
+
+    def __init__(self, logger, name='delay-scheduler'):
+        self.logger = logger  # The server's RequestLogger, for callbacks that raise
+        self._heap = []
+        self._counter = itertools.count()  # Tie-breaker keeps equal deadlines FIFO
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) on the timer thread after delay seconds"""
+        entry = (time.monotonic() + delay, next(self._counter), callback, args)
+        with self._condition:
+            heapq.heappush(self._heap, entry)
+            # Only wake the timer thread when the earliest deadline changed
+            if self._heap[0] is entry:
+                self._condition.notify()
+
+    def pending(self):
+        """Return the number of callbacks waiting for their deadline"""
+        with self._condition:
+            return len(self._heap)
+
+    def stop(self):
+        """Stop the timer thread, dropping callbacks that are not due yet"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def _next_due(self):
+        """Block until at least one callback is due, then pop all due callbacks"""
+        with self._condition:
+            while self._running:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    due = []
+                    while self._heap and self._heap[0][0] <= now:
+                        due.append(heapq.heappop(self._heap))
+                    return due
+                self._condition.wait(self._heap[0][0] - now if self._heap else None)
+            return None
+
+    def _run(self):
+        while True:
+            due = self._next_due()
+            if due is None:
+                return
+            for _, _, callback, args in due:
+                try:
+                    callback(*args)
+                except Exception as e:
+                    self.logger.error("Error in delayed callback: %s", e)
@@ -0,0 +1,251 @@
+"""
+Broadcast event streams for many mostly-idle long connections
+
+GET /stream answers with a never-ending response and pushes a JSON event to
+every subscriber each --stream-interval milliseconds: Server-Sent Events by
+default, newline-delimited JSON with ?format=ndjson, both in chunked
+framing for HTTP/1.1 clients.
+
+The handler thread only sends the response head and then hands the socket to
+a single broadcaster thread, so held streams cost no threads: the
+broadcaster encodes each event once per framing and writes it to every
+subscriber with non-blocking sends, watching all the sockets with one
+selector for clients that go away. A subscriber that cannot keep up may
+have at most MAX_PENDING bytes waiting; beyond that it is disconnected, so
+memory per held connection stays bounded whatever the clients do.
+"""
+
+import json
+import os
+import selectors
+import ssl
+import threading
+import time
+
+from common.cli import fail, pop_value
+
+STREAM_PATH = '/stream'
+DEFAULT_INTERVAL_MS = 1000
+DEFAULT_PAYLOAD = 64  # Bytes of filler in each event
+MAX_PENDING = 64 * 1024  # Unsent bytes a slow subscriber may hold before it is disconnected
+FORMATS = {'sse': 'text/event-stream', 'ndjson': 'application/x-ndjson'}
+
+def _rss_bytes():
+    """Current resident set size of this process (0 if unknown)"""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+class StreamEvent:
+    """One event, encoded at most once for each (format, chunked) variant"""
+    __slots__ = ('id', 'data', '_encoded')
+
+    def __init__(self, event_id, data):
+        self.id = event_id
+        self.data = data
+        self._encoded = {}
+
+    def encoded(self, variant):
+        body = self._encoded.get(variant)
+        if body is None:
+            stream_format, chunked = variant
+            if stream_format == 'sse':
+                body = b'id: %d\nevent: tick\ndata: %s\n\n' % (self.id, self.data)
+            else:
+                body = self.data + b'\n'
+            if chunked:
+                body = b'%x\r\n%s\r\n' % (len(body), body)
+            self._encoded[variant] = body
+        return body
+
+class _Subscriber:
+    __slots__ = ('sock', 'variant', 'on_close', 'pending')
+
+    def __init__(self, sock, variant, on_close):
+        self.sock = sock
+        self.variant = variant
+        self.on_close = on_close
+        self.pending = b''
+
+class StreamBroadcaster:
+    """One thread generating events and writing them to every subscriber
+
+    Sockets handed over with subscribe() are written by the broadcaster
+    itself; an event loop registers a group with add_group() and receives
+    each event through group.deliver(event) to write from its own thread.
+    """
+
+    def __init__(self, interval_ms=DEFAULT_INTERVAL_MS, payload_size=DEFAULT_PAYLOAD):
+        self.interval = interval_ms / 1000.0
+        self.payload_size = payload_size
+        self.metrics = None  # MetricsRegistry with --metrics, set by the server
+        self._payload = 'x' * payload_size
+        self._subscribers = {}  # socket -> _Subscriber
+        self._joining = []
+        self._groups = []
+        self._lock = threading.Lock()
+        self._selector = None
+        self._thread = None
+        self.events = 0
+        self.bytes_sent = 0
+        self.closed = 0  # Subscribers that went away
+        self.dropped = 0  # Subscribers disconnected for falling MAX_PENDING behind
+        self.peak = 0
+        self.baseline_rss = _rss_bytes()  # Before any stream, so growth at the peak is what the streams cost
+        self.peak_rss = 0
+
+    @property
+    def subscribers(self):
+        return len(self._subscribers) + len(self._joining) + sum(len(group) for group in self._groups)
+
+    def subscribe(self, sock, variant, on_close):
+        """Take over a connection whose response head was sent; on_close() runs once it ends"""
+        sock.setblocking(False)
+        with self._lock:
+            self._joining.append(_Subscriber(sock, variant, on_close))
+        self._start()
+
+    def add_group(self, group):
+        with self._lock:
+            self._groups.append(group)
+        self._start()
+
+    def account(self, sent_bytes=0, closed=0, dropped=0):
+        """Count deliveries and departures made outside the broadcaster thread"""
+        with self._lock:
+            self.bytes_sent += sent_bytes
+            self.closed += closed
+            self.dropped += dropped
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.inc('http_stream_sent_bytes_total', amount=sent_bytes)
+            if closed:
+                metrics.inc('http_stream_disconnects_total', (('reason', 'closed'),), closed)
+            if dropped:
+                metrics.inc('http_stream_disconnects_total', (('reason', 'slow'),), dropped)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._selector = selectors.DefaultSelector()
+            self._thread = threading.Thread(target=self._run, name='stream-broadcaster', daemon=True)
+        self._thread.start()
+
+    def _event(self):
+        self.events += 1
+        data = json.dumps({
+            "event": self.events,
+            "time": time.time(),
+            "subscribers": self.subscribers,
+            "payload": self._payload,
+        }, separators=(',', ':')).encode('utf-8')
+        if self.metrics is not None:
+            self.metrics.inc('http_stream_events_total')
+        return StreamEvent(self.events, data)
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while True:
+            timeout = next_tick - time.monotonic()
+            if timeout > 0:
+                for key, mask in self._selector.select(timeout):
+                    if mask & selectors.EVENT_READ:
+                        self._read(key.data)
+                    elif key.data.sock in self._subscribers:
+                        self._write(key.data, b'')
+                continue
+            with self._lock:
+                joining, self._joining = self._joining, []
+                groups = list(self._groups)
+            for subscriber in joining:
+                self._subscribers[subscriber.sock] = subscriber
+                self._selector.register(subscriber.sock, selectors.EVENT_READ, subscriber)
+            event = self._event()
+            sent = 0
+            for subscriber in list(self._subscribers.values()):
+                sent += self._write(subscriber, event.encoded(subscriber.variant))
+            self.account(sent)
+            for group in groups:
+                group.deliver(event)
+            self._track_memory()
+            # Skip ticks missed while busy rather than bursting to catch up
+            next_tick = max(next_tick + self.interval, time.monotonic())
+
+    def _read(self, subscriber):
+        """A stream client sends nothing; readable means it closed the connection (or sent junk)"""
+        try:
+            data = subscriber.sock.recv(4096)
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._remove(subscriber, slow=False)
+
+    def _write(self, subscriber, data):
+        """Send data after anything still pending; returns the bytes sent"""
+        had_pending = bool(subscriber.pending)
+        if had_pending:
+            data = subscriber.pending + data
+        try:
+            sent = subscriber.sock.send(data)
+        except (BlockingIOError, ssl.SSLWantWriteError):
+            sent = 0
+        except OSError:
+            self._remove(subscriber, slow=False)
+            return 0
+        if len(data) - sent > MAX_PENDING:
+            self._remove(subscriber, slow=True)
+            return sent
+        subscriber.pending = data[sent:]
+        if bool(subscriber.pending) != had_pending:
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if subscriber.pending else 0)
+            self._selector.modify(subscriber.sock, events, subscriber)
+        return sent
+
+    def _remove(self, subscriber, slow):
+        del self._subscribers[subscriber.sock]
+        self._selector.unregister(subscriber.sock)
+        subscriber.pending = b''
+        if slow:
+            self.account(dropped=1)
+        else:
+            self.account(closed=1)
+        subscriber.on_close()
+
+    def _track_memory(self):
+        count = self.subscribers
+        if count > self.peak:
+            self.peak = count
+            self.peak_rss = _rss_bytes()
+
+    def report(self):
+        """Print events sent, subscriber churn and memory per held stream"""
+        if self._thread is None:
+            return
+        print(f'Streams: {self.events} events every {self.interval * 1000:g}ms ({self.payload_size} byte payload), '
+              f'{self.bytes_sent} bytes sent')
+        print(f'  Subscribers: {self.subscribers} open, {self.peak} peak, {self.closed} closed by clients, '
+              f'{self.dropped} dropped as too slow')
+        if self.peak and self.peak_rss and self.baseline_rss:
+            growth = max(self.peak_rss - self.baseline_rss, 0)
+            print(f'  Memory: +{growth / 1048576:.1f}MB RSS at {self.peak} streams '
+                  f'({growth / self.peak / 1024:.1f}KB per stream, kernel socket buffers not included)')
+
+def pop_stream_args(args):
+    """Parse --stream-interval and --stream-payload, returning (StreamBroadcaster, remaining_args)"""
+    interval_ms, args = pop_value(args, '--stream-interval', int, DEFAULT_INTERVAL_MS)
+    payload_size, args = pop_value(args, '--stream-payload', int, DEFAULT_PAYLOAD)
+    if interval_ms < 1:
+        fail("--stream-interval must be at least 1ms!")
+    if payload_size < 0:
+        fail("--stream-payload must be non-negative!")
+    return StreamBroadcaster(interval_ms, payload_size), args
+
+STREAM_HELP = [
+    f"  --stream-interval ms  Time between events pushed to GET /stream subscribers (default: {DEFAULT_INTERVAL_MS})",
+    f"  --stream-payload bytes  Filler bytes in each /stream event (default: {DEFAULT_PAYLOAD})",
+]
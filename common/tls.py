@@ -0,0 +1,124 @@
+"""
+HTTPS for the threaded HTTP server
+
+--tls-cert/--tls-key wrap accepted connections in TLS. The accept loop only
+attaches the TLS state to the socket; the handshake itself runs on the
+thread that serves the connection, so a slow or stalled client handshake
+never holds up accepting other connections.
+
+Session resumption is on: TLS 1.3 clients get session tickets after the
+handshake, TLS 1.2 clients can resume from tickets or the session cache. The
+context is created once and shared by every connection (and inherited by
+forked --workers, which then accept each other's tickets). Every handshake
+is timed and counted as full or resumed, so the cost of connection setup
+that plain HTTP hides shows up in /metrics and the shutdown report.
+"""
+
+import ssl
+import threading
+import time
+
+from common.cli import fail, pop_value
+from common.histogram import LatencyHistogram
+
+# A client has this long to complete its handshake before the connection is dropped
+HANDSHAKE_TIMEOUT = 10.0
+_contexts = {}  # (certfile, keyfile) -> SSLContext, reused so forked workers share ticket keys
+
+def server_context(certfile, keyfile=None):
+    """Return the server SSLContext for a certificate and key, creating it on first use"""
+    key = (certfile, keyfile)
+    context = _contexts.get(key)
+    if context is None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        context.set_alpn_protocols(['http/1.1'])
+        # Tickets are on by default; make resumption independent of the local OpenSSL configuration
+        context.options &= ~ssl.OP_NO_TICKET
+        _contexts[key] = context
+    return context
+
+class TLSServer:
+    """Wrap accepted sockets and account for every handshake performed on them"""
+
+    def __init__(self, certfile, keyfile=None):
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.context = server_context(certfile, keyfile)
+        self.metrics = None  # MetricsRegistry with --metrics, set by the server
+        self.full = LatencyHistogram()  # Microseconds per full handshake
+        self.resumed = LatencyHistogram()  # Microseconds per resumed handshake
+        self.failures = 0
+        self.versions = {}  # Protocol version -> handshakes
+        self._lock = threading.Lock()
+
+    def wrap(self, sock):
+        """Attach TLS to an accepted socket without any I/O (called from the accept loop)"""
+        return self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+
+    def handshake(self, sock):
+        """Complete the handshake on the connection's own thread; the error, or None on success"""
+        timeout = sock.gettimeout()
+        sock.settimeout(HANDSHAKE_TIMEOUT)
+        started = time.perf_counter()
+        try:
+            sock.do_handshake()
+        except (OSError, ValueError) as e:
+            with self._lock:
+                self.failures += 1
+            if self.metrics is not None:
+                self.metrics.inc('tls_handshake_failures_total')
+            return e
+        elapsed = time.perf_counter() - started
+        sock.settimeout(timeout)
+        kind = 'resumed' if sock.session_reused else 'full'
+        version = sock.version()
+        with self._lock:
+            (self.resumed if kind == 'resumed' else self.full).record(elapsed * 1e6)
+            self.versions[version] = self.versions.get(version, 0) + 1
+        if self.metrics is not None:
+            self.metrics.inc('tls_handshakes_total', (('type', kind), ('version', version)))
+            self.metrics.observe('tls_handshake_duration_seconds', (('type', kind),), elapsed)
+        return None
+
+    def report(self):
+        """Print full versus resumed handshakes and their latency"""
+        total = self.full.count + self.resumed.count
+        versions = ', '.join(f'{version} {count}' for version, count in sorted(self.versions.items()))
+        print(f'TLS: {self.certfile}')
+        print(f'  Handshakes: {total} ({self.full.count} full, {self.resumed.count} resumed'
+              f'{f", {self.resumed.count * 100.0 / total:.1f}% resumed" if total else ""}), '
+              f'{self.failures} failed{f"; {versions}" if versions else ""}')
+        for name, histogram in (('Full', self.full), ('Resumed', self.resumed)):
+            if histogram.count:
+                latency = histogram.summary()
+                print(f'  {name} handshake: mean {latency["mean"] / 1000:.2f}ms, p50 {latency["p50"] / 1000:.2f}ms, '
+                      f'p99 {latency["p99"] / 1000:.2f}ms, max {latency["max"] / 1000:.2f}ms')
+
+def _load(certfile, keyfile):
+    try:
+        return server_context(certfile, keyfile)
+    except (OSError, ssl.SSLError) as e:
+        fail(f"cannot load --tls-cert '{certfile}'{f' / --tls-key {keyfile!r}' if keyfile else ''}: {e}")
+
+def pop_tls_args(args):
+    """Parse --tls-cert FILE and --tls-key FILE, returning (TLSServer or None, remaining_args)"""
+    certfile, args = pop_value(args, '--tls-cert')
+    keyfile, args = pop_value(args, '--tls-key')
+    if certfile is None:
+        if keyfile is not None:
+            fail("--tls-key requires --tls-cert!")
+        return None, args
+    _load(certfile, keyfile)
+    return TLSServer(certfile, keyfile), args
+
+def preload_context(args):
+    """Create the context for --tls-cert/--tls-key before forking workers, so they share its ticket keys"""
+    certfile, _ = pop_value(args, '--tls-cert')
+    if certfile is not None:
+        _load(certfile, pop_value(args, '--tls-key')[0])
+
+TLS_HELP = [
+    "  --tls-cert FILE   Serve HTTPS with this PEM certificate chain (threads engine)",
+    "  --tls-key FILE    Private key for --tls-cert (default: read from the certificate file)",
+]
@@ -0,0 +1,447 @@
+"""
+Asyncio engine for the HTTP server
+
+Serves the same GET/POST behavior as the threaded engine from a single event
+loop instead of one OS thread per connection. Every request read from the
+stream is run through LongConnectionHandler against in-memory buffers, so the
+bytes written back are identical to what ThreadedHTTPServer would send.
+Bodies of POST /echo and /discard are not buffered: the engine reads them
+from the connection piece by piece and feeds them through the handler.
+"""
+
+import asyncio
+import io
+
+from http_server import (BODY_CHUNK_SIZE, DISCARD_PATH, ECHO_PATH, MAX_CHUNK_LINE, BodyTooLarge,
+                         LongConnectionHandler, MalformedBody, ProfilingMixin, RequestLogger, ServerStats,
+                         print_banner)
+from common.metrics import define_compression_metrics, define_http_metrics, define_stream_metrics, get_registry
+from common.streaming import MAX_PENDING, StreamBroadcaster
+
+# Same limits BaseHTTPRequestHandler applies when reading from a socket
+MAX_REQUEST_HEAD = 65536 + 100 * 8192
+CONTINUE_RESPONSE = b'HTTP/1.1 100 Continue\r\n\r\n'
+
+class BufferedExchangeHandler(LongConnectionHandler):
+    """Handle exactly one buffered request, collecting the response in memory"""
+
+    def setup(self):
+        self.connection = None
+        self.rfile = io.BytesIO(self.request)
+        self.wfile = io.BytesIO()
+        self.file_region = None
+        self.debug_session = None
+        self.body_stream = None  # ECHO_PATH or DISCARD_PATH while the engine feeds the body in
+
+    def handle(self):
+        self.handle_one_request()
+
+    def handle_expect_100(self):
+        # The engine already answered 100 Continue before reading the body
+        return True
+    
+    def finish(self):
+        # Keep wfile open so the engine can collect the response bytes
+        pass
+
+    def _stream_body(self, path, thread_id):
+        # The engine reads the body from the connection and passes it to feed_body() and end_body()
+        self._log_post(thread_id)
+        self._begin_body_stream(path)
+        self.body_stream = path
+    
+    def feed_body(self, data):
+        """Count one piece of a streamed body, returning the bytes to write back (the echo)"""
+        self._body_bytes += len(data)
+        return self._echo_piece(data) if self.body_stream == ECHO_PATH else b''
+    
+    def end_body(self, error=None):
+        """Finish a streamed body, returning the rest of the response"""
+        self.wfile = io.BytesIO()
+        if error is None:
+            self._end_body_stream(self.body_stream)
+        else:
+            self._body_stream_failed(self.body_stream, error)
+        return self.wfile.getvalue()
+
+    def _send_fixture_body(self, head, fixture, offset, count):
+        self.wfile.write(head)
+        if fixture.data is not None:
+            self.wfile.write(memoryview(fixture.data)[offset:offset + count])
+        elif count:
+            # Sent by the engine with loop.sendfile() once the head is written
+            self.file_region = (fixture.path, offset, count)
+
+class ProfilingExchangeHandler(ProfilingMixin, BufferedExchangeHandler):
+    """BufferedExchangeHandler with --profile; the engine waits out /debug sessions on the loop"""
+
+    def _debug_waiter(self):
+        # The loop thread keeps serving every other connection, so it stays in the samples
+        return None
+
+    def _await_debug(self, session):
+        self.debug_session = session
+
+    def finish_debug(self):
+        """Called by the engine once the session's seconds have passed"""
+        session, self.debug_session = self.debug_session, None
+        self._send_debug(session)
+
+class StreamGroup:
+    """The engine's /stream subscribers, fed by the broadcaster and written from the event loop"""
+
+    def __init__(self, loop, broadcaster):
+        self.loop = loop
+        self.broadcaster = broadcaster
+        self.writers = {}  # StreamWriter -> (format, chunked)
+
+    def __len__(self):
+        return len(self.writers)
+
+    def deliver(self, event):
+        """Called on the broadcaster thread for every event"""
+        try:
+            self.loop.call_soon_threadsafe(self._write, event)
+        except RuntimeError:
+            # The loop has been closed at shutdown
+            pass
+
+    def _write(self, event):
+        sent = dropped = 0
+        for writer, variant in list(self.writers.items()):
+            if writer.transport.get_write_buffer_size() > MAX_PENDING:
+                # Too far behind: disconnect, the connection's task then ends the stream
+                del self.writers[writer]
+                writer.transport.abort()
+                dropped += 1
+                continue
+            data = event.encoded(variant)
+            writer.write(data)
+            sent += len(data)
+        self.broadcaster.account(sent, dropped=dropped)
+
+def _headers(head, wanted):
+    """Return every value of a header in a raw request head"""
+    values = []
+    for line in head.split(b'\r\n')[1:]:
+        name, sep, value = line.partition(b':')
+        if sep and name.strip().lower() == wanted:
+            values.append(value.strip())
+    return values
+
+def _header(head, wanted):
+    """Return the value of a header in a raw request head (None if absent)"""
+    values = _headers(head, wanted)
+    return values[0] if values else None
+
+def _content_length(head):
+    """Return the Content-Length announced in a raw request head (0 if none, None if invalid or repeated)"""
+    values = _headers(head, b'content-length')
+    if not values:
+        return 0
+    if len(values) > 1 or not values[0].isdigit():
+        return None
+    return int(values[0])
+
+async def _read_line(reader):
+    """readline() of a chunked body, reporting a line over the stream limit as malformed"""
+    try:
+        return await reader.readline()
+    except ValueError:
+        raise MalformedBody("line too long")
+
+def _streams_body(head):
+    """True for POST /echo and /discard, whose bodies the engine streams instead of buffering"""
+    method, _, rest = head[:head.find(b'\r\n')].partition(b' ')
+    path = rest.partition(b' ')[0].partition(b'?')[0]
+    return method == b'POST' and path in (ECHO_PATH.encode(), DISCARD_PATH.encode())
+
+def _expects_continue(head):
+    """True for an HTTP/1.1 request with Expect: 100-continue (answered like BaseHTTPRequestHandler does)"""
+    request_line = head[:head.find(b'\r\n')]
+    return (request_line.endswith(b' HTTP/1.1')
+            and (_header(head, b'expect') or b'').lower() == b'100-continue')
+
+class AsyncioHTTPServer:
+    """Single event loop HTTP server compatible with LongConnectionHandler"""
+
+    def __init__(self, port, validate_json=True, delay_ms=0, reuse_port=False, logger=None, pretty_json=False,
+                 metrics=False, max_body=0, compressor=None, keepalive_timeout=0, max_requests=0, codec=None,
+                 validate_only=False, fixtures=None, recorder=None, profiler=None, stream=None):
+        self.port = port
+        self.logger = logger or RequestLogger()
+        self.reuse_port = reuse_port
+        self.validate_json = validate_json
+        self.delay_ms = delay_ms
+        self.pretty_json = pretty_json
+        self.max_body = max_body
+        self.keepalive_timeout = keepalive_timeout
+        self.max_requests = max_requests
+        self.codec = codec
+        self.validate_only = validate_only
+        self.stats = ServerStats('asyncio')
+        self.metrics = get_registry() if metrics else None
+        if self.metrics is not None:
+            define_http_metrics(self.metrics, lambda: self.stats.active_connections)
+        self.compressor = compressor
+        if compressor is not None and self.metrics is not None:
+            define_compression_metrics(self.metrics)
+        self.fixtures = fixtures
+        self.recorder = recorder
+        self.profiler = profiler
+        self.handler_class = ProfilingExchangeHandler if profiler is not None else BufferedExchangeHandler
+        self.stream = stream or StreamBroadcaster()
+        if self.metrics is not None:
+            define_stream_metrics(self.metrics, lambda: self.stream.subscribers)
+            self.stream.metrics = self.metrics
+        self._stream_group = None
+
+    async def _read_request(self, reader, writer):
+        """Read one raw request (head and body) from the stream, b'' on EOF"""
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+        except asyncio.LimitOverrunError as e:
+            # Let the handler reject the oversized head with the usual error
+            return await reader.read(e.consumed)
+
+        chunked = b'chunked' in (_header(head, b'transfer-encoding') or b'').lower()
+        content_length = _content_length(head)
+        if content_length is None or chunked and _header(head, b'content-length') is not None:
+            # Pass only the head; the handler answers 400 and closes the connection
+            return head
+        if content_length > self.max_body > 0:
+            # Pass only the head; the handler answers 413 and closes the connection
+            return head
+        if _expects_continue(head):
+            # Same interim response the threaded engine sends before reading the body
+            writer.write(CONTINUE_RESPONSE)
+        if _streams_body(head):
+            # The body is read later, piece by piece, by _stream_body()
+            return head
+        if chunked:
+            return head + await self._read_chunked(reader)
+        if content_length == 0:
+            return head
+        try:
+            body = await reader.readexactly(content_length)
+        except asyncio.IncompleteReadError as e:
+            body = e.partial
+        return head + body
+
+    async def _read_chunked(self, reader):
+        """Read a chunked body with its framing intact, for the handler to decode
+
+        Reading stops early on a malformed size line or once --max-body is
+        exceeded; the handler then sees the same error it would on a socket.
+        """
+        raw = bytearray()
+        decoded = 0
+        while True:
+            line = await reader.readline()
+            raw += line
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                return raw
+            if size <= 0:
+                break
+            decoded += size
+            if decoded > self.max_body > 0:
+                return raw
+            try:
+                raw += await reader.readexactly(size + 2)
+            except asyncio.IncompleteReadError as e:
+                return raw + e.partial
+        # Trailer section up to the blank line
+        while True:
+            line = await reader.readline()
+            raw += line
+            if line in (b'\r\n', b'\n', b''):
+                return raw
+    
+    async def handle_connection(self, reader, writer):
+        """Serve requests on one connection until either side closes it"""
+        client_address = writer.get_extra_info('peername')[:2]
+        self.stats.connection_opened()
+        requests_served = 0
+        try:
+            while True:
+                try:
+                    # An idle connection is closed once --keepalive-timeout passes without a request
+                    raw_request = await asyncio.wait_for(self._read_request(reader, writer),
+                                                         self.keepalive_timeout or None)
+                except asyncio.TimeoutError:
+                    break
+                if not raw_request:
+                    break
+
+                # Delay on the event loop instead of blocking a thread
+                if self.delay_ms > 0:
+                    await asyncio.sleep(self.delay_ms / 1000.0)
+
+                exchange = self.handler_class(raw_request, client_address, self,
+                                                   validate_json=self.validate_json, delay_ms=0,
+                                                   pretty_json=self.pretty_json, max_body=self.max_body,
+                                                   keepalive_timeout=self.keepalive_timeout,
+                                                   max_requests=self.max_requests, requests_served=requests_served,
+                                                   codec=self.codec, validate_only=self.validate_only)
+                if exchange.debug_session is not None:
+                    # /debug/profile or /debug/heap: collect on the loop, then let the handler answer
+                    await asyncio.sleep(exchange.debug_session.seconds)
+                    exchange.finish_debug()
+                requests_served = exchange.requests_served
+                response = exchange.wfile.getvalue()
+                if response:
+                    writer.write(response)
+                    await writer.drain()
+                if exchange.file_region is not None and not await self._send_file_region(writer, exchange):
+                    break
+                if exchange.body_stream is not None:
+                    await self._stream_body(reader, writer, exchange)
+                elif _streams_body(raw_request):
+                    # Rejected before its body was read (e.g. 413), so the body is still in the stream
+                    break
+                if exchange.stream_variant is not None:
+                    await self._hold_stream(reader, writer, exchange.stream_variant)
+                    break
+                if exchange.close_connection:
+                    break
+        except (BrokenPipeError, ConnectionResetError) as e:
+            self.logger.warning("Client disconnected: %s", e)
+        finally:
+            self.stats.connection_closed()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    async def _hold_stream(self, reader, writer, variant):
+        """Keep a /stream connection subscribed until the client closes it"""
+        if self._stream_group is None:
+            self._stream_group = StreamGroup(asyncio.get_running_loop(), self.stream)
+            self.stream.add_group(self._stream_group)
+        group = self._stream_group
+        group.writers[writer] = variant
+        try:
+            # Stream clients send nothing more; EOF or a reset means they left
+            while await reader.read(4096):
+                pass
+        except OSError:
+            pass
+        finally:
+            if group.writers.pop(writer, None) is not None:
+                self.stream.account(closed=1)
+
+    async def _stream_body(self, reader, writer, exchange):
+        """Read a POST /echo or /discard body piece by piece, writing the echo back as it arrives"""
+        error = None
+        try:
+            async for data in self._iter_body(reader, exchange):
+                echo = exchange.feed_body(data)
+                if echo:
+                    writer.write(echo)
+                    await writer.drain()
+        except (BodyTooLarge, MalformedBody) as e:
+            error = e
+        response = exchange.end_body(error)
+        if response:
+            writer.write(response)
+            await writer.drain()
+
+    async def _iter_body(self, reader, exchange):
+        """Yield a request body in pieces of at most BODY_CHUNK_SIZE bytes, like LongConnectionHandler._iter_body"""
+        if not exchange._is_chunked():
+            remaining = exchange._body_length()
+            while remaining > 0:
+                data = await reader.read(min(remaining, BODY_CHUNK_SIZE))
+                if not data:
+                    return
+                remaining -= len(data)
+                yield data
+            return
+
+        decoded = 0
+        while True:
+            line = await _read_line(reader)
+            if not line:
+                raise ConnectionResetError("connection closed inside a chunked body")
+            if len(line) > MAX_CHUNK_LINE:
+                raise MalformedBody("invalid chunk size")
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise MalformedBody("invalid chunk size")
+            if size < 0:
+                raise MalformedBody("negative chunk size")
+            if size == 0:
+                break
+            if decoded + size > self.max_body > 0:
+                raise BodyTooLarge()
+            decoded += size
+            while size > 0:
+                data = await reader.read(min(size, BODY_CHUNK_SIZE))
+                if not data:
+                    raise ConnectionResetError("connection closed inside a chunk")
+                size -= len(data)
+                yield data
+            if (await _read_line(reader)).strip():
+                raise MalformedBody("chunk data longer than its size")
+        # Skip the trailer section
+        while True:
+            line = await _read_line(reader)
+            if line in (b'\r\n', b'\n', b''):
+                return
+
+    async def _send_file_region(self, writer, exchange):
+        """Send a fixture file region with sendfile; False if it could not be sent in full"""
+        path, offset, count = exchange.file_region
+        try:
+            with open(path, 'rb') as f:
+                sent = await asyncio.get_running_loop().sendfile(writer.transport, f, offset, count)
+        except OSError as e:
+            self.logger.error("Error sending fixture %s: %s", path, e)
+            return False
+        return sent == count
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self.handle_connection, '0.0.0.0', self.port,
+                                            limit=MAX_REQUEST_HEAD, reuse_port=self.reuse_port or None)
+        async with server:
+            await server.serve_forever()
+
+def run_asyncio_server(port, validate_json=True, delay_ms=0, reuse_port=False, logger=None, pretty_json=False,
+                       metrics=False, max_body=0, compressor=None, keepalive_timeout=0, max_requests=0, codec=None,
+                       validate_only=False, fixtures=None, recorder=None, profiler=None, stream=None):
+    """Start the asyncio engine and serve until Ctrl+C"""
+    server = AsyncioHTTPServer(port, validate_json, delay_ms, reuse_port, logger, pretty_json, metrics, max_body,
+                               compressor, keepalive_timeout, max_requests, codec, validate_only, fixtures, recorder,
+                               profiler, stream)
+    print_banner(port, validate_json, delay_ms, 'asyncio', keepalive_timeout, max_requests, codec, validate_only)
+    if compressor is not None:
+        print(f'Compression: gzip/deflate level {compressor.level} for bodies of {compressor.min_size} bytes or more')
+    if fixtures is not None:
+        print(f'Fixtures: GET requests served from {fixtures.root}')
+    if recorder is not None:
+        print(f'Recording requests to {recorder.path}')
+    if profiler is not None:
+        print(f'Profiling: http://localhost:{port}/debug/profile?seconds=10 and /debug/heap?seconds=10')
+
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        print('\nServer is shutting down...')
+        server.logger.close()
+        if recorder is not None:
+            recorder.close()
+        print('Server has been closed')
+        server.stats.report()
+        if compressor is not None:
+            compressor.report()
+        if fixtures is not None:
+            fixtures.report()
+        if recorder is not None:
+            recorder.report()
+        server.stream.report()
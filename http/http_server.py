@@ -1,59 +1,743 @@
+from email.utils import formatdate
+from functools import partial
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+import mmap
+import os
+import queue
+import socket
 import time
 import json
 import threading
-from datetime import datetime
+import sys
+
+# Make the shared modules in the repository root importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.capture import RECORD_HELP
+from common.cli import fail, pop_flag, pop_value
+from common.codec import CODECS, COMPACT_SEPARATORS, get_codec, is_spliceable
+from common.compression import COMPRESSION_HELP, negotiate, pop_compression_args
+from common.fixtures import FIXTURES_HELP, RangeNotSatisfiable, byte_range, not_modified, pop_fixture_args
+from common.logger import LOGGER_HELP, PrettyJSON, RawText, RequestLogger
+from common.metrics import (PROMETHEUS_CONTENT_TYPE, define_compression_metrics, define_http_metrics,
+                            define_stream_metrics, define_tls_metrics, get_registry, wants_json)
+from common.options import pop_common_args, pop_engine, pop_ports, wants_help
+from common.scheduler import DelayScheduler
+from common.streaming import FORMATS as STREAM_FORMATS, STREAM_HELP, STREAM_PATH, StreamBroadcaster, pop_stream_args
+from common.tls import TLS_HELP, pop_tls_args
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+ENGINES = ('threads', 'asyncio')
+DEFAULT_PORT = 8000
+
+# Constant response parts, built once instead of per request
+SERVER_HEADER = ('Server: %s %s\r\n' % (BaseHTTPRequestHandler.server_version,
+                                         BaseHTTPRequestHandler.sys_version)).encode('latin-1')
+STATIC_HEADERS = b'Connection: keep-alive\r\nAccess-Control-Allow-Origin: *\r\n'
+CLOSE_HEADERS = b'Connection: close\r\nAccess-Control-Allow-Origin: *\r\n'
+_status_lines = {}
+_date_header = (0, b'')
+
+def _status_line(protocol_version, code):
+    """Return the cached status line for a response code"""
+    line = _status_lines.get((protocol_version, code))
+    if line is None:
+        phrase = BaseHTTPRequestHandler.responses.get(code, ('',))[0]
+        line = ('%s %d %s\r\n' % (protocol_version, code, phrase)).encode('latin-1')
+        _status_lines[(protocol_version, code)] = line
+    return line
+
+def _date_header_line():
+    """Return the Date header, formatted at most once per second"""
+    global _date_header
+    now = int(time.time())
+    second, line = _date_header
+    if second != now:
+        line = ('Date: %s\r\n' % formatdate(now, usegmt=True)).encode('latin-1')
+        _date_header = (now, line)
+    return line
+
+def _is_decimal(value):
+    """True for a Content-Length value of ASCII digits only (no sign, spaces inside or Unicode digits)"""
+    value = value.strip()
+    return value.isascii() and value.isdigit()
+
+def _json_prefix(fields):
+    """Compact JSON for the constant leading fields of an object, left open for more fields"""
+    return json.dumps(fields, ensure_ascii=False, separators=COMPACT_SEPARATORS)[:-1] + ','
+
+WELCOME_PREFIX = _json_prefix({
+    "status": "success",
+    "message": "Welcome to the long connection server"
+})
+GET_PREFIX = _json_prefix({
+    "status": "success",
+    "message": "GET request processed successfully"
+})
+# --validate-only copies the request body in after this prefix
+POST_SPLICE_PREFIX = (_json_prefix({
+    "status": "success",
+    "message": "POST request processed successfully"
+}) + '"received_data":').encode('utf-8')
+
+# Idle timeout in seconds with --max-threads when --keepalive-timeout is not given: an idle
+# keep-alive connection holds a pool thread, so it must not be kept forever
+POOL_KEEPALIVE_TIMEOUT = 5
+
+# Request bodies are read and echoed in pieces of this size
+BODY_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_LINE = 1024
+# POST paths that stream the body instead of buffering it
+ECHO_PATH = '/echo'
+DISCARD_PATH = '/discard'
+# Sent with /stream responses so proxies pass each event on as soon as it is written
+STREAM_HEADERS = b'Cache-Control: no-cache\r\nX-Accel-Buffering: no\r\n'
+# GET paths answered with --profile, mapped to the Profiler endpoint name
+DEBUG_PATHS = {'/debug/profile': 'profile', '/debug/heap': 'heap'}
+
+# Fixture files above the cache size go out with sendfile; MSG_MORE (Linux) holds the
+# response head back so it shares a packet with the start of the file
+HAS_SENDFILE = hasattr(os, 'sendfile')
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+class BodyTooLarge(Exception):
+    """The request body exceeds --max-body"""
+
+class MalformedBody(Exception):
+    """The chunked request body could not be decoded"""
+
+# Sent straight from the accept loop when --max-threads/--max-queue are exhausted
+RETRY_AFTER_SECONDS = 1
+_OVERLOAD_BODY = json.dumps({
+    "status": "error",
+    "message": "Server overloaded, please retry later"
+}).encode('utf-8')
+OVERLOAD_RESPONSE = (
+    'HTTP/1.1 503 Service Unavailable\r\n'
+    'Content-Type: application/json\r\n'
+    f'Retry-After: {RETRY_AFTER_SECONDS}\r\n'
+    f'Content-Length: {len(_OVERLOAD_BODY)}\r\n'
+    'Connection: close\r\n'
+    'Access-Control-Allow-Origin: *\r\n'
+    '\r\n'
+).encode('latin-1') + _OVERLOAD_BODY
+
+def _send_buffers(sock, *buffers):
+    """sendall() for several buffers, gathered into one sendmsg() call where supported"""
+    views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    if not hasattr(sock, 'sendmsg'):
+        for view in views:
+            sock.sendall(view)
+        return
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if views and sent:
+            views[0] = views[0][sent:]
+
+def _peak_rss_mb():
+    """Return the peak resident set size of this process in MB (0 if unknown)"""
+    if resource is None:
+        return 0.0
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+class ServerStats:
+    """Connection and request counters used to compare server engines"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.started = time.time()
+        self.baseline_rss_mb = _peak_rss_mb()
+        self.requests = 0
+        self.rejected = 0
+        self.connections = 0
+        self.active_connections = 0
+        self.peak_connections = 0
+        self._lock = threading.Lock()
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections += 1
+            self.active_connections += 1
+            if self.active_connections > self.peak_connections:
+                self.peak_connections = self.active_connections
+
+    def connection_closed(self):
+        with self._lock:
+            self.active_connections -= 1
+
+    def request_handled(self):
+        with self._lock:
+            self.requests += 1
+
+    def connection_rejected(self):
+        with self._lock:
+            self.rejected += 1
+
+    def report(self):
+        """Print requests/sec and connections-per-MB for this run"""
+        elapsed = max(time.time() - self.started, 1e-6)
+        peak_rss_mb = _peak_rss_mb()
+        # Memory attributable to connections is the growth over the idle baseline
+        growth_mb = peak_rss_mb - self.baseline_rss_mb
+        if growth_mb < 0.1:
+            growth_mb = peak_rss_mb
+        print(f'Engine: {self.engine}')
+        print(f'  Requests: {self.requests} in {elapsed:.1f}s ({self.requests / elapsed:.1f} req/s)')
+        print(f'  Connections: {self.connections} total, {self.peak_connections} peak concurrent')
+        if self.rejected:
+            print(f'  Rejected with 503 (overloaded): {self.rejected}')
+        if peak_rss_mb > 0:
+            print(f'  Peak RSS: {peak_rss_mb:.1f}MB (+{peak_rss_mb - self.baseline_rss_mb:.1f}MB over idle)')
+            print(f'  Connections per MB: {self.peak_connections / growth_mb:.1f}')
 
 # Multi-threaded processing class
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """Allow each request to be handled by a separate thread"""
+    """Allow each request to be handled by a separate thread
+
+    With max_threads set, connections are served by a fixed pool of threads
+    instead; at most max_queue connections wait for a free thread and any
+    connection beyond that is answered with 503 and Retry-After right away.
+    A connection holds its slot until it is closed, including while it waits
+    for a --delay response, so the work it queues again later (the delayed
+    send, the next keep-alive request) stays within the same bound.
+    """
     daemon_threads = True  # Automatically close child threads when main thread exits
     allow_reuse_address = True  # Allow address reuse
+    allow_reuse_port = False  # Share the port with other worker processes (SO_REUSEPORT)
+    request_queue_size = 1024  # Listen backlog; the default of 5 drops SYNs under connection bursts
+
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True, reuse_port=False,
+                 scheduler=None, logger=None, max_threads=0, max_queue=0, metrics=None, compressor=None,
+                 fixtures=None, recorder=None, profiler=None, tls=None, stream=None):
+        self.stats = ServerStats('threads')
+        self.logger = logger or RequestLogger()
+        self.allow_reuse_port = reuse_port
+        self.scheduler = scheduler  # DelayScheduler for --delay, None when responses are immediate
+        self._handoff_lock = threading.Lock()
+        self._handed_off = {}  # socket -> pending shutdown_request calls to skip
+        self._resumed_rfiles = {}  # socket -> (buffered reader, requests served) carried over to the next handler
+        self.metrics = metrics  # MetricsRegistry with --metrics, otherwise None
+        if metrics is not None:
+            define_http_metrics(metrics, lambda: self.stats.active_connections)
+        self.compressor = compressor  # ResponseCompressor with --compress, otherwise None
+        if compressor is not None and metrics is not None:
+            define_compression_metrics(metrics)
+        self.fixtures = fixtures  # FixtureStore with --fixtures, otherwise None
+        self.recorder = recorder  # TrafficRecorder with --record, otherwise None
+        self.profiler = profiler  # Profiler with --profile, otherwise None
+        self.tls = tls  # TLSServer with --tls-cert, otherwise None
+        if tls is not None and metrics is not None:
+            define_tls_metrics(metrics)
+            tls.metrics = metrics
+        self.stream = stream or StreamBroadcaster()  # Writes GET /stream events to every subscriber
+        if metrics is not None:
+            define_stream_metrics(metrics, lambda: self.stream.subscribers)
+            self.stream.metrics = metrics
+        self.max_threads = max_threads
+        self.max_queue = max_queue
+        self._pool_queue = None
+        self._slot_holders = set()  # Sockets counted against max_threads + max_queue
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+        if max_threads > 0:
+            self._start_pool()
+
+    def _start_pool(self):
+        # One slot per pool thread plus one per queue entry; no free slot means overload
+        self._slots = threading.BoundedSemaphore(self.max_threads + self.max_queue)
+        self._pool_queue = queue.SimpleQueue()
+        for i in range(self.max_threads):
+            threading.Thread(target=self._pool_worker, name=f'http-worker-{i}', daemon=True).start()
+
+    def _pool_worker(self):
+        while True:
+            function, args = self._pool_queue.get()
+            function(*args)
+
+    def get_request(self):
+        request, client_address = super().get_request()
+        if self.tls is not None:
+            request = self.tls.wrap(request)
+        return request, client_address
+
+    def finish_request(self, request, client_address):
+        # A new TLS connection is handshaken here, on its own thread, rather than in the accept loop;
+        # connections resumed after a delayed response have a protocol version already
+        if self.tls is not None and request.version() is None:
+            error = self.tls.handshake(request)
+            if error is not None:
+                self.logger.warning("TLS handshake with %s:%s failed: %s", client_address[0], client_address[1],
+                                    error)
+                return
+        super().finish_request(request, client_address)
+
+    def process_request(self, request, client_address):
+        if self._pool_queue is None:
+            super().process_request(request, client_address)
+            return
+        if not self._slots.acquire(blocking=False):
+            self._reject_overloaded(request)
+            return
+        with self._handoff_lock:
+            self._slot_holders.add(request)
+        self._pool_queue.put((self.process_request_thread, (request, client_address)))
+
+    def release_slot(self, request):
+        """Stop counting a connection against the pool bound (it is closing or needs no thread)"""
+        with self._handoff_lock:
+            if request not in self._slot_holders:
+                return
+            self._slot_holders.discard(request)
+        self._slots.release()
+
+    def _reject_overloaded(self, request):
+        """Answer 503 from the accept loop without reading the request or blocking"""
+        self.stats.connection_rejected()
+        if self.tls is not None:
+            # No handshake in the accept loop, so the connection can only be closed
+            super().shutdown_request(request)
+            return
+        try:
+            request.setblocking(False)
+            # Drain whatever request bytes already arrived so closing does not reset the connection
+            try:
+                request.recv(65536)
+            except OSError:
+                pass
+            request.send(OVERLOAD_RESPONSE)
+        except OSError:
+            pass
+        super().shutdown_request(request)
+
+    def server_bind(self):
+        if self.allow_reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def hand_off_request(self, request):
+        """Keep the socket open when its handler thread exits (delayed response pending)"""
+        with self._handoff_lock:
+            self._handed_off[request] = self._handed_off.get(request, 0) + 1
+
+    def shutdown_request(self, request):
+        with self._handoff_lock:
+            pending = self._handed_off.get(request, 0)
+            if pending:
+                if pending == 1:
+                    del self._handed_off[request]
+                else:
+                    self._handed_off[request] = pending - 1
+                return
+        self.release_slot(request)
+        super().shutdown_request(request)
+
+    def close_handed_off_request(self, request):
+        """Close a connection after its delayed response has been sent"""
+        self.release_slot(request)
+        super().shutdown_request(request)
+
+    def resume_request(self, request, client_address, rfile, requests_served):
+        """Serve the next request on a kept-alive connection after a delayed response"""
+        with self._handoff_lock:
+            self._resumed_rfiles[request] = (rfile, requests_served)
+        if self._pool_queue is not None:
+            # Already accepted and still holding its slot: never shed a connection in the middle of its session
+            self._pool_queue.put((self.process_request_thread, (request, client_address)))
+        else:
+            self.process_request(request, client_address)
+
+    def send_delayed(self, send):
+        """Called on the scheduler thread when a delay is up: run send() on a connection thread
+
+        The scheduler thread only keeps time. A client that does not read its
+        response then blocks the thread writing to it, never the replies
+        due to everyone else. With a pool the connection still holds its slot,
+        so queueing the send cannot grow the queue past max_queue.
+        """
+        if self._pool_queue is not None:
+            self._pool_queue.put((send, ()))
+        else:
+            threading.Thread(target=send, name='http-delayed-send', daemon=self.daemon_threads).start()
+
+    def end_stream(self, request):
+        """Close a /stream connection the broadcaster has finished with"""
+        self.stats.connection_closed()
+        super().shutdown_request(request)
+
+    def take_resumed_state(self, request):
+        """(buffered reader, requests served) of a connection resumed after a delayed response, or None"""
+        with self._handoff_lock:
+            return self._resumed_rfiles.pop(request, None)
 
 class LongConnectionHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1: connections persist unless the client sends Connection: close (or is an
+    # HTTP/1.0 client without Connection: keep-alive), and pipelined requests are read
+    # from the same buffered reader in order
+    protocol_version = 'HTTP/1.1'
+    
     def __init__(self, *args, **kwargs):
         self.validate_json = kwargs.pop('validate_json', True)
         self.delay_ms = kwargs.pop('delay_ms', 0)
+        self.pretty_json = kwargs.pop('pretty_json', False)
+        self.codec = kwargs.pop('codec', None) or get_codec()
+        self.validate_only = kwargs.pop('validate_only', False)
+        self.max_body = kwargs.pop('max_body', 0)
+        # Idle connections are closed after keepalive_timeout seconds (socket timeout, 0 = never)
+        self.keepalive_timeout = kwargs.pop('keepalive_timeout', 0)
+        self.timeout = self.keepalive_timeout or None
+        self.max_requests = kwargs.pop('max_requests', 0)
+        self.requests_served = kwargs.pop('requests_served', 0)
+        self._body_bytes = 0
+        self._delayed_response = None
+        self._resumed = False
+        self.stream_variant = None  # (format, chunked) once a /stream response head has been sent
         super().__init__(*args, **kwargs)
     
-    def _send_response(self, content, content_type='text/plain', status_code=200):
-        """Send HTTP response"""
+    def setup(self):
+        super().setup()
+        # A connection coming back from the delay scheduler keeps its buffered reader,
+        # which may already hold the next pipelined request
+        resumed = self.server.take_resumed_state(self.request)
+        if resumed is not None:
+            self.rfile.close()
+            self.rfile, self.requests_served = resumed
+            self._resumed = True
+        else:
+            self.server.stats.connection_opened()
+    
+    def finish(self):
+        if self.stream_variant is not None:
+            # The broadcaster writes the events from here on and this thread exits; the handler
+            # is not kept alive, only the socket
+            super().finish()
+            self.server.hand_off_request(self.request)
+            # Subscribers need no pool thread, so they are not limited by --max-threads/--max-queue
+            self.server.release_slot(self.request)
+            self.server.stream.subscribe(self.request, self.stream_variant,
+                                         partial(self.server.end_stream, self.request))
+            return
+        if self._delayed_response is not None:
+            # The connection stays open until the scheduler has sent the reply
+            self.server.hand_off_request(self.request)
+            self.server.scheduler.call_later(self.delay_ms / 1000.0, self.server.send_delayed,
+                                             self._send_delayed_response)
+            return
+        try:
+            super().finish()
+        finally:
+            self.server.stats.connection_closed()
+    
+    @property
+    def log(self):
+        return self.server.logger
+    
+    def _respond(self, respond, *args):
+        """Call respond(*args) now, or after --delay without holding this thread"""
+        if self.delay_ms <= 0 or getattr(self.server, 'scheduler', None) is None:
+            respond(*args)
+            return
+        self._delayed_response = (respond, args, self.close_connection)
+        # Leave the keep-alive loop; finish() passes the connection to the scheduler
+        self.close_connection = True
+    
+    def _send_delayed_response(self):
+        """Runs on a connection thread (see send_delayed) once the delay has elapsed"""
+        respond, args, self.close_connection = self._delayed_response
+        self._delayed_response = None
         try:
-            self.send_response(status_code)
-            self.send_header('Content-Type', content_type)
-            self.send_header('Connection', 'keep-alive')  # Support long connections
-            self.send_header('Content-Length', str(len(content.encode('utf-8'))))
-            self.send_header('Access-Control-Allow-Origin', '*')  # Support CORS
-            self.end_headers()
-            self.wfile.write(content.encode('utf-8'))
+            respond(*args)
+            self.wfile.flush()
+        except Exception as e:
+            self.log.error("Error sending delayed response: %s", e)
+            self.close_connection = True
+        if self.close_connection:
+            self.server.stats.connection_closed()
+            self.server.close_handed_off_request(self.request)
+        else:
+            self.server.resume_request(self.request, self.client_address, self.rfile, self.requests_served)
+    
+    def _response_head(self, status_code, content_type, length=None, chunked=False, close=False, extra=b''):
+        """Status line and headers; without a length or chunking the body ends when the connection closes"""
+        if length is not None:
+            framing = b'Content-Length: ' + str(length).encode('latin-1') + b'\r\n'
+        elif chunked:
+            framing = b'Transfer-Encoding: chunked\r\n'
+        else:
+            framing = b''
+            close = True
+        # Keep the connection unless the client asked to close it (parse_request decides),
+        # this response must end it, or it has served --max-requests-per-conn requests
+        self.requests_served += 1
+        close = close or self.close_connection or 0 < self.max_requests <= self.requests_served
+        self.close_connection = close
+        if not close and (self.keepalive_timeout or self.max_requests):
+            extra += self._keep_alive_header()
+        return b''.join((
+            _status_line(self.protocol_version, status_code),
+            SERVER_HEADER,
+            _date_header_line(),
+            b'Content-Type: ', content_type.encode('latin-1'), b'\r\n',
+            framing,
+            extra,
+            CLOSE_HEADERS if close else STATIC_HEADERS,  # Connection, CORS
+            b'\r\n',
+        ))
+    
+    def _keep_alive_header(self):
+        """Advertise the idle timeout and remaining request budget of this connection"""
+        params = []
+        if self.keepalive_timeout:
+            params.append('timeout=%d' % self.keepalive_timeout)
+        if self.max_requests:
+            params.append('max=%d' % (self.max_requests - self.requests_served))
+        return ('Keep-Alive: %s\r\n' % ', '.join(params)).encode('latin-1')
+    
+    def handle_expect_100(self):
+        """Skip 100 Continue for a body that will be rejected with 413 anyway"""
+        try:
+            if self._body_length() > self.max_body > 0:
+                return True
+        except ValueError:
+            pass
+        return super().handle_expect_100()
+    
+    def _send_response(self, content, content_type='text/plain', status_code=200, close=False, extra=b''):
+        """Send HTTP response with a single write of status line, headers and body"""
+        try:
+            body = content.encode('utf-8') if isinstance(content, str) else content
+            if self.request_version == 'HTTP/0.9':
+                self.wfile.write(body)
+                return
+            compressor = self.server.compressor
+            if compressor is not None and len(body) >= compressor.min_size:
+                body, compression_headers = self._compress(compressor, body)
+                extra += compression_headers
+            response = self._response_head(status_code, content_type, len(body), close=close, extra=extra) + body
+            self.wfile.write(response)
+            if self.server.metrics is not None:
+                self._record_metrics(status_code, len(response))
         except (BrokenPipeError, ConnectionResetError) as e:
             # Client disconnected before response was sent
-            print(f"Client disconnected: {e}")
+            self.log.warning("Client disconnected: %s", e)
         except Exception as e:
-            print(f"Error sending response: {e}")
+            self.log.error("Error sending response: %s", e)
+    
+    def _compress(self, compressor, body):
+        """Compress body if the client accepts it and it pays off, returning (body, extra_headers)"""
+        # Vary on every response large enough to be compressed, so caches keep the variants apart
+        extra = b'Vary: Accept-Encoding\r\n'
+        encoding = negotiate(self.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return body, extra
+        compressed, cpu_seconds = compressor.compress(body, encoding)
+        metrics = self.server.metrics
+        if compressed is None:
+            if metrics is not None:
+                metrics.inc('http_compression_skipped_total')
+            return body, extra
+        
+        self.log.debug("Compressed %d -> %d bytes (%.1f%%) with %s in %.1fus", len(body), len(compressed),
+                       len(compressed) * 100.0 / len(body), encoding, cpu_seconds * 1e6)
+        if metrics is not None:
+            metrics.inc('http_compressed_responses_total', (('encoding', encoding),))
+            metrics.inc('http_compression_input_bytes_total', amount=len(body))
+            metrics.inc('http_compression_output_bytes_total', amount=len(compressed))
+            metrics.observe('http_compression_cpu_seconds', (), cpu_seconds)
+        # Per-response cost, visible in browser dev tools and to curl -v
+        extra += b'Content-Encoding: %s\r\nServer-Timing: compress;dur=%.3f;desc="%d/%d bytes"\r\n' % (
+            encoding.encode('latin-1'), cpu_seconds * 1000, len(compressed), len(body))
+        return compressed, extra
+    
+    def _record_metrics(self, status_code, sent_bytes):
+        """Count one finished request (only called with --metrics)"""
+        metrics = self.server.metrics
+        path = metrics.label('path', self.path.split('?', 1)[0])
+        metrics.inc('http_requests_total', (('method', self.command), ('path', path), ('status', status_code)))
+        metrics.observe('http_request_duration_seconds', (('method', self.command), ('path', path)),
+                        time.perf_counter() - self._request_started)
+        received = len(self.raw_requestline) + 2 + self._body_bytes
+        for name, value in self.headers.items():
+            received += len(name) + len(value) + 4
+        metrics.inc('http_received_bytes_total', amount=received)
+        metrics.inc('http_sent_bytes_total', amount=sent_bytes)
     
-    def _send_json_response(self, data, status_code=200):
-        """Send JSON response"""
-        json_str = json.dumps(data, ensure_ascii=False, indent=2)
-        self._send_response(json_str, 'application/json', status_code)
+    def _send_metrics(self):
+        """Serve /metrics in the Prometheus text format, or JSON when asked for"""
+        metrics = self.server.metrics
+        if wants_json(self.path, self.headers.get('Accept')):
+            self._send_response(metrics.to_json(), 'application/json')
+        else:
+            self._send_response(metrics.to_prometheus(), PROMETHEUS_CONTENT_TYPE)
+    
+    def _send_json_response(self, data, status_code=200, close=False):
+        """Send JSON response, compact unless --pretty was given"""
+        self._send_response(self.codec.dumps(data, self.pretty_json), 'application/json', status_code, close)
     
     def do_GET(self):
         """Handle GET requests"""
         client_ip = self.client_address[0]
         client_port = self.client_address[1]
-        thread_id = threading.current_thread().ident
-        request_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         
-        print(f"[{request_time}] GET request - Thread ID: {thread_id}, Client: {client_ip}:{client_port}, Path: {self.path}")
+        self.server.stats.request_handled()
+        self._body_bytes = 0
+        self._record_request()
+        self.log.request("GET request - Thread ID: %s, Client: %s:%s, Path: %s",
+                         threading.get_ident(), client_ip, client_port, self.path)
+        
+        if self.server.metrics is not None:
+            self._request_started = time.perf_counter()
+            if self.path.split('?', 1)[0] == '/metrics':
+                self._send_metrics()
+                return
+        
+        if self.path.split('?', 1)[0] == STREAM_PATH:
+            self._start_stream()
+            return
         
+        fixtures = self.server.fixtures
+        if fixtures is not None:
+            fixture = fixtures.lookup(self.path)
+            if fixture is None:
+                self._respond(self._send_json_response, {
+                    "status": "error",
+                    "message": "No fixture for this path",
+                    "path": self.path
+                }, 404)
+            else:
+                self._respond(self._send_fixture, fixture)
+            return
+        
+        self._respond(self._handle_get)
+    
+    def _start_stream(self):
+        """Send the head of a /stream response; finish() then hands the connection to the broadcaster"""
+        stream_format = parse_qs(urlsplit(self.path).query).get('format', ['sse'])[0]
+        if stream_format not in STREAM_FORMATS:
+            self._send_json_response({
+                "status": "error",
+                "message": f"format must be one of: {', '.join(STREAM_FORMATS)}"
+            }, 400)
+            return
+        # Chunked for HTTP/1.1 clients, otherwise the stream ends when the connection closes
+        chunked = self.request_version >= 'HTTP/1.1'
         try:
-            # Add delay if specified
-            if self.delay_ms > 0:
-                time.sleep(self.delay_ms / 1000.0)
+            head = self._response_head(200, STREAM_FORMATS[stream_format], chunked=chunked, extra=STREAM_HEADERS)
+            self.wfile.write(head)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            self.log.warning("Client disconnected: %s", e)
+            self.close_connection = True
+            return
+        if self.server.metrics is not None:
+            self._record_metrics(200, len(head))
+        self.stream_variant = (stream_format, chunked)
+        self.close_connection = True
+    
+    def _send_fixture(self, fixture):
+        """Send a fixture file, answering conditional requests with 304 and byte ranges with 206"""
+        start, end = 0, 0
+        extra = fixture.headers
+        if not_modified(fixture, self.headers):
+            # No body; Content-Length still describes the full file
+            status, length = 304, fixture.size
+        else:
+            try:
+                selected = byte_range(fixture, self.headers)
+            except RangeNotSatisfiable:
+                status, length = 416, 0
+                extra += b'Content-Range: bytes */%d\r\n' % fixture.size
+            else:
+                if selected is None:
+                    status, (start, end) = 200, (0, fixture.size)
+                else:
+                    status, (start, end) = 206, selected
+                    extra += b'Content-Range: bytes %d-%d/%d\r\n' % (start, end - 1, fixture.size)
+                length = end - start
+        try:
+            head = self._response_head(status, fixture.content_type, length, extra=extra)
+            self._send_fixture_body(head, fixture, start, end - start)
+            self.server.fixtures.count(fixture, status, end - start)
+            if self.server.metrics is not None:
+                self._record_metrics(status, len(head) + end - start)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            self.log.warning("Client disconnected: %s", e)
+            self.close_connection = True
+        except Exception as e:
+            # Part of the body may have been sent, so the connection cannot be reused
+            self.log.error("Error sending fixture %s: %s", fixture.path, e)
+            self.close_connection = True
+    
+    def _send_fixture_body(self, head, fixture, offset, count):
+        """Write the head and count bytes of the file from offset, without copying them in Python"""
+        sock = self.connection
+        if self.server.tls is not None:
+            self._send_fixture_tls(sock, head, fixture, offset, count)
+            return
+        if fixture.data is not None:
+            _send_buffers(sock, head, memoryview(fixture.data)[offset:offset + count])
+            return
+        if count == 0:
+            sock.sendall(head)
+            return
+        with open(fixture.path, 'rb') as f:
+            if HAS_SENDFILE:
+                sock.sendall(head, MSG_MORE)
+                sent = sock.sendfile(f, offset, count)
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                    region = view[offset:offset + count]
+                    _send_buffers(sock, head, region)
+                    sent = len(region)
+                    region.release()
+        if sent < count:
+            # The file shrank after it was stat()ed; the promised length was not delivered
+            self.close_connection = True
+    
+    def _send_fixture_tls(self, sock, head, fixture, offset, count):
+        """Write the head and a file region over TLS
+
+        An SSLSocket has neither sendmsg() nor sendall() flags and encrypts
+        every byte in Python's buffers anyway, so the head goes out in one
+        write with the start of the body and the rest follows in pieces.
+        """
+        if fixture.data is not None:
+            sock.sendall(head + fixture.data[offset:offset + count])
+            return
+        with open(fixture.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(min(count, BODY_CHUNK_SIZE))
+            sock.sendall(head + data)
+            sent = len(data)
+            while data and sent < count:
+                data = f.read(min(count - sent, BODY_CHUNK_SIZE))
+                sock.sendall(data)
+                sent += len(data)
+        if sent < count:
+            self.close_connection = True
+    
+    def _handle_get(self):
+        """Build and send the GET response"""
+        client_ip = self.client_address[0]
+        client_port = self.client_address[1]
         
+        try:
             # Return different content based on path
-            if self.path == '/':
+            if not self.pretty_json:
+                # Fast path: splice the per-request fields onto the prebuilt constant prefix
+                tail = '"client_ip":"%s","client_port":%d,"time":"%s"}' % (client_ip, client_port, time.ctime())
+                if self.path == '/':
+                    self._send_response(WELCOME_PREFIX + tail, 'application/json')
+                else:
+                    path = json.dumps(self.path, ensure_ascii=False)
+                    self._send_response(GET_PREFIX + '"path":' + path + ',' + tail, 'application/json')
+            elif self.path == '/':
                 response_data = {
                     "status": "success",
                     "message": "Welcome to the long connection server",
@@ -73,43 +757,262 @@ class LongConnectionHandler(BaseHTTPRequestHandler):
                 }
                 self._send_json_response(response_data)
         except (BrokenPipeError, ConnectionResetError):
-            print(f"[{request_time}] Client {client_ip}:{client_port} disconnected during request processing")
+            self.log.warning("Client %s:%s disconnected during request processing", client_ip, client_port)
         except Exception as e:
-            print(f"[{request_time}] Error processing GET request: {e}")
+            self.log.error("Error processing GET request: %s", e)
     
     def do_POST(self):
         """Handle POST requests"""
         client_ip = self.client_address[0]
         client_port = self.client_address[1]
-        thread_id = threading.current_thread().ident
-        request_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        thread_id = threading.get_ident()
         
-        print(f"[{request_time}] POST request - Thread ID: {thread_id}, Client: {client_ip}:{client_port}, Path: {self.path}")
+        self.server.stats.request_handled()
+        self._body_bytes = 0
+        if self.server.metrics is not None:
+            self._request_started = time.perf_counter()
         
-        # Add delay if specified
-        if self.delay_ms > 0:
-            time.sleep(self.delay_ms / 1000.0)
+        # Read the body before any delay so the connection is ready for the next request
+        post_data = b''
+        error = None
+        try:
+            if self._body_length() > self.max_body > 0:
+                raise BodyTooLarge()
+            path = self.path.split('?', 1)[0]
+            if path == ECHO_PATH or path == DISCARD_PATH:
+                # Streamed bodies are never held in memory, so they are recorded without one
+                self._record_request()
+                self._stream_body(path, thread_id)
+                return
+            post_data = self._read_body()
+        except (BrokenPipeError, ConnectionResetError):
+            self.log.warning("Client %s:%s disconnected during request processing", client_ip, client_port)
+            self.close_connection = True
+            return
+        except (BodyTooLarge, MalformedBody) as e:
+            self._record_request()
+            self._log_post(thread_id)
+            self._reject_body(e)
+            return
+        except Exception as e:
+            error = e
+        
+        self._record_request(post_data)
+        self._respond(self._handle_post, post_data, error, thread_id)
+    
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        # A body whose length is unclear would be left in the stream and read as the next request
+        lengths = self.headers.get_all('Content-Length') or []
+        chunked = self._is_chunked()
+        if lengths and (len(lengths) > 1 or chunked or not _is_decimal(lengths[0])):
+            self.server.stats.request_handled()
+            self._request_started = time.perf_counter()
+            self._send_json_response({
+                "status": "error",
+                "message": "Invalid Content-Length" if not chunked else "Content-Length with chunked Transfer-Encoding"
+            }, 400, close=True)
+            return False
+        if self.command != 'POST' and (chunked or lengths and int(lengths[0]) > 0):
+            # Only POST reads a body; close rather than parse this one as a request
+            self.close_connection = True
+        return True
+    
+    def _reject_body(self, error):
+        """413 or 400 for a body that cannot be read; the rest of it is never read, so the connection closes"""
+        if isinstance(error, BodyTooLarge):
+            self._send_json_response({
+                "status": "error",
+                "message": f"Request body exceeds {self.max_body} bytes"
+            }, 413, close=True)
+        else:
+            self._send_json_response({
+                "status": "error",
+                "message": f"Malformed chunked body: {error}"
+            }, 400, close=True)
+    
+    def _record_request(self, body=b''):
+        """Append this request to the --record capture"""
+        if self.server.recorder is not None:
+            self.server.recorder.http(self.command, self.path, self.headers, body)
+    
+    def _is_chunked(self):
+        return 'chunked' in self.headers.get('Transfer-Encoding', '').lower()
+    
+    def _body_length(self):
+        """Announced Content-Length (0 for chunked bodies, whose size is only known once read)"""
+        if self._is_chunked():
+            return 0
+        return int(self.headers.get('Content-Length', 0))  # Validated by parse_request
+    
+    def _iter_body(self):
+        """Yield the request body in pieces of at most BODY_CHUNK_SIZE bytes
+
+        Decodes Transfer-Encoding: chunked and enforces --max-body on the
+        decoded size, so no more than one piece is held in memory.
+        """
+        if not self._is_chunked():
+            remaining = self._body_length()
+            while remaining > 0:
+                data = self.rfile.read(min(remaining, BODY_CHUNK_SIZE))
+                if not data:
+                    return
+                self._body_bytes += len(data)
+                remaining -= len(data)
+                yield data
+            return
         
+        while True:
+            line = self.rfile.readline(MAX_CHUNK_LINE + 1)
+            if not line:
+                raise ConnectionResetError("connection closed inside a chunked body")
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise MalformedBody("invalid chunk size")
+            if size < 0:
+                raise MalformedBody("negative chunk size")
+            if size == 0:
+                break
+            if self._body_bytes + size > self.max_body > 0:
+                raise BodyTooLarge()
+            while size > 0:
+                data = self.rfile.read(min(size, BODY_CHUNK_SIZE))
+                if not data:
+                    raise ConnectionResetError("connection closed inside a chunk")
+                self._body_bytes += len(data)
+                size -= len(data)
+                yield data
+            if self.rfile.readline(MAX_CHUNK_LINE + 1).strip():
+                raise MalformedBody("chunk data longer than its size")
+        # Skip the trailer section
+        while True:
+            line = self.rfile.readline(MAX_CHUNK_LINE + 1)
+            if line in (b'\r\n', b'\n', b''):
+                break
+    
+    def _read_body(self):
+        """Read the whole request body (for the JSON and raw responses that need all of it)"""
+        if not self._is_chunked():
+            content_length = self._body_length()
+            if content_length <= 0:
+                return b''
+            post_data = self.rfile.read(content_length)
+            self._body_bytes = len(post_data)
+            return post_data
+        body = bytearray()
+        for data in self._iter_body():
+            body += data
+        return body
+    
+    def _stream_body(self, path, thread_id):
+        """POST /echo writes the body back as it arrives, POST /discard only counts it
+
+        Neither path buffers the body, so memory stays flat for any upload size.
+        """
+        self._log_post(thread_id)
+        self._begin_body_stream(path)
         try:
-            # Get request content length
-            content_length = int(self.headers.get('Content-Length', 0))
+            for data in self._iter_body():
+                if path == ECHO_PATH:
+                    self.wfile.write(self._echo_piece(data))
+        except (BodyTooLarge, MalformedBody) as e:
+            self._body_stream_failed(path, e)
+            return
+        self._end_body_stream(path)
+    
+    def _begin_body_stream(self, path):
+        """Send the /echo response head; the body follows piece by piece through _echo_piece()"""
+        self._echo_chunked = False
+        self._echo_sent = 0
+        if path != ECHO_PATH or self.request_version == 'HTTP/0.9':
+            return
+        # Echo: reuse the request framing where possible; chunked responses need HTTP/1.1 on both
+        # ends, otherwise the body is delimited by closing the connection
+        content_type = self.headers.get('Content-Type', 'application/octet-stream')
+        chunked = self._is_chunked()
+        self._echo_chunked = chunked and self.protocol_version >= 'HTTP/1.1' and self.request_version >= 'HTTP/1.1'
+        head = self._response_head(200, content_type, None if chunked else self._body_length(),
+                                   chunked=self._echo_chunked)
+        self.wfile.write(head)
+        self._echo_sent = len(head)
+    
+    def _echo_piece(self, data):
+        """One piece of the echoed body, framed for the response"""
+        if self._echo_chunked:
+            data = b'%x\r\n%s\r\n' % (len(data), data)
+        self._echo_sent += len(data)
+        return data
+    
+    def _end_body_stream(self, path):
+        """Finish the echo, or answer /discard once the whole body has been counted"""
+        if path == DISCARD_PATH:
+            self._respond(self._send_json_response, {
+                "status": "success",
+                "message": "POST request body discarded",
+                "received_bytes": self._body_bytes,
+                "client_ip": self.client_address[0],
+                "client_port": self.client_address[1],
+                "time": time.ctime()
+            })
+            return
+        if self._echo_chunked:
+            self.wfile.write(b'0\r\n\r\n')
+            self._echo_sent += 5
+        if self.server.metrics is not None:
+            self._record_metrics(200, self._echo_sent)
+    
+    def _body_stream_failed(self, path, error):
+        if path == DISCARD_PATH:
+            self._reject_body(error)
+            return
+        # Too late for an error status; cut the echo short
+        self.log.warning("Echo aborted for %s:%s: %s", self.client_address[0], self.client_address[1],
+                         type(error).__name__)
+        self.close_connection = True
+    
+    def _log_post(self, thread_id, body_label=None, body=None):
+        """Queue the single log record for a POST request, including its body if enabled"""
+        message = "POST request - Thread ID: %s, Client: %s:%s, Path: %s"
+        args = (thread_id, self.client_address[0], self.client_address[1], self.path)
+        if body_label is not None and self.log.log_body:
+            message += "\n%s\n%s"
+            args += (body_label, body)
+        self.log.request(message, *args)
+    
+    def _handle_post(self, post_data, error, thread_id):
+        """Build and send the POST response for an already received body"""
+        client_ip = self.client_address[0]
+        client_port = self.client_address[1]
+        
+        try:
+            if error is not None:
+                raise error
             
-            if content_length == 0:
+            if not post_data:
+                self._log_post(thread_id)
                 self._send_json_response({
                     "status": "error",
                     "message": "Request body is empty"
                 }, 400)
                 return
             
-            # Read request body
-            post_data = self.rfile.read(content_length)
-            
             if self.validate_json:
                 # Parse JSON data
                 try:
-                    json_data = json.loads(post_data.decode('utf-8'))
-                    print(f"[{request_time}] Received JSON data:")
-                    print(f"{json.dumps(json_data, ensure_ascii=False, indent=2)}")
+                    if self.validate_only and is_spliceable(post_data):
+                        # Check the body parses, then echo its original bytes instead of re-serializing
+                        self.codec.loads(post_data)
+                        self._log_post(thread_id, "Received JSON data:", RawText(post_data))
+                        tail = ',"client_ip":"%s","client_port":%d,"time":"%s"}' % (client_ip, client_port, time.ctime())
+                        self._send_response(b''.join((POST_SPLICE_PREFIX, post_data.strip(), tail.encode('utf-8'))),
+                                            'application/json')
+                        return
+                    
+                    # The codec decodes bytes itself, saving a str copy of the body
+                    json_data = self.codec.loads(post_data)
+                    self._log_post(thread_id, "Received JSON data:", PrettyJSON(json_data))
                     # Return success response
                     response_data = {
                         "status": "success",
@@ -121,9 +1024,9 @@ class LongConnectionHandler(BaseHTTPRequestHandler):
                     }
                     self._send_json_response(response_data)
                     
-                except json.JSONDecodeError as e:
+                except self.codec.errors as e:
                     raw_content = post_data.decode('utf-8', errors='ignore')
-                    print(f"[{request_time}] Non-JSON data: {raw_content}")
+                    self._log_post(thread_id, "Non-JSON data:", raw_content)
                     self._send_json_response({
                         "status": "error",
                         "message": f"JSON parsing failed: {str(e)}"
@@ -131,7 +1034,7 @@ class LongConnectionHandler(BaseHTTPRequestHandler):
             else:
                 # No JSON validation, just return raw data
                 raw_content = post_data.decode('utf-8', errors='ignore')
-                print(f"[{request_time}] Received raw data: {raw_content}")
+                self._log_post(thread_id, "Received raw data:", raw_content)
                 response_data = {
                     "status": "success",
                     "message": "POST request processed successfully",
@@ -143,126 +1046,334 @@ class LongConnectionHandler(BaseHTTPRequestHandler):
                 self._send_json_response(response_data)
                 
         except (BrokenPipeError, ConnectionResetError):
-            print(f"[{request_time}] Client {client_ip}:{client_port} disconnected during request processing")
+            self.log.warning("Client %s:%s disconnected during request processing", client_ip, client_port)
         except Exception as e:
-            print(f"[{request_time}] Error processing POST request: {e}")
+            self._log_post(thread_id)
+            self.log.error("Error processing POST request: %s", e)
             try:
                 self._send_json_response({
                     "status": "error",
                     "message": f"Internal server error: {str(e)}"
                 }, 500)
             except (BrokenPipeError, ConnectionResetError):
-                print(f"[{request_time}] Client {client_ip}:{client_port} disconnected before error response could be sent")
+                self.log.warning("Client %s:%s disconnected before error response could be sent", client_ip, client_port)
     
     def log_message(self, format, *args):
         """Override log method to avoid duplicate output"""
         # We already manually print logs in do_GET and do_POST
         pass
 
-if __name__ == '__main__':
-    import sys
-    
-    # Default settings
-    port = 8000
-    validate_json = True
-    delay_ms = 0
-    
-    # Parse command line arguments
-    if len(sys.argv) > 1:
-        # Check for help flags
-        if sys.argv[1] in ['-h', '--help']:
-            print("HTTP Server - Multi-threaded server with JSON support")
-            print()
-            print("Usage: python http_server.py [port] [--no-json] [--delay milliseconds]")
-            print()
-            print("Arguments:")
-            print("  port              Port number (default: 8000)")
-            print("  --no-json         Disable JSON validation for POST requests")
-            print("  --delay ms        Response delay in milliseconds (default: 0)")
-            print("  -h, --help        Show this help message")
-            print()
-            print("Examples:")
-            print("  python http_server.py                    # Start on port 8000 with JSON validation")
-            print("  python http_server.py 8080               # Start on port 8080 with JSON validation")
-            print("  python http_server.py --no-json          # Start on port 8000 without JSON validation")
-            print("  python http_server.py 8080 --no-json     # Start on port 8080 without JSON validation")
-            print("  python http_server.py --delay 1000       # Start on port 8000 with 1 second delay")
-            print("  python http_server.py 8080 --delay 500   # Start on port 8080 with 500ms delay")
-            sys.exit(0)
-        
-        # Parse arguments
-        args = sys.argv[1:]
-        
-        # Check for --no-json flag
-        if '--no-json' in args:
-            validate_json = False
-            args = [arg for arg in args if arg != '--no-json']
-        
-        # Check for --delay parameter
-        if '--delay' in args:
-            delay_index = args.index('--delay')
-            if delay_index + 1 < len(args):
-                try:
-                    delay_ms = int(args[delay_index + 1])
-                    if delay_ms < 0:
-                        print("Error: Delay must be non-negative!")
-                        sys.exit(1)
-                    # Remove delay arguments for port parsing
-                    args = [arg for i, arg in enumerate(args) if i not in [delay_index, delay_index + 1]]
-                except ValueError:
-                    print("Error: Delay must be an integer!")
-                    print("Use -h or --help for usage information")
-                    sys.exit(1)
-            else:
-                print("Error: --delay requires a value!")
-                print("Use -h or --help for usage information")
-                sys.exit(1)
-        
-        # Parse port if provided
-        if args:
-            try:
-                port = int(args[0])
-                if port < 1 or port > 65535:
-                    print("Error: Port number must be in range 1-65535")
-                    sys.exit(1)
-            except ValueError:
-                print("Error: Port number must be a number")
-                print("Use -h or --help for usage information")
-                sys.exit(1)
-    
-    server_address = ('', port)
-    
-    # Create handler with JSON validation and delay settings
-    def handler(*args, **kwargs):
-        return LongConnectionHandler(*args, validate_json=validate_json, delay_ms=delay_ms, **kwargs)
-    
-    httpd = ThreadedHTTPServer(server_address, handler)
-    
+class ProfilingMixin:
+    """--profile additions to a handler: the /debug endpoints, and cProfile of each request while asked for
+
+    Mixed in only when the server runs with --profile, so the plain handlers
+    carry no profiling code at all.
+    """
+    _profile = None  # (CProfileSession, Profile) while this request is being profiled
+
+    def parse_request(self):
+        session = self.server.profiler.cprofile
+        if session is not None:
+            profile = session.request_started()
+            if profile is not None:
+                self._profile = (session, profile)
+        return super().parse_request()
+
+    def handle_one_request(self):
+        try:
+            super().handle_one_request()
+        finally:
+            if self._profile is not None:
+                session, profile = self._profile
+                self._profile = None
+                session.request_finished(profile)
+
+    def do_GET(self):
+        endpoint = DEBUG_PATHS.get(self.path.split('?', 1)[0])
+        if endpoint is None:
+            super().do_GET()
+            return
+        self.server.stats.request_handled()
+        self._body_bytes = 0
+        self._request_started = time.perf_counter()
+        self.log.request("GET request - Thread ID: %s, Client: %s:%s, Path: %s",
+                         threading.get_ident(), self.client_address[0], self.client_address[1], self.path)
+        from common.profiling import ProfileError  # Already loaded: --profile created the Profiler
+        try:
+            session = self.server.profiler.start(endpoint, parse_qs(urlsplit(self.path).query), self._debug_waiter())
+        except ProfileError as e:
+            self._send_json_response({"status": "error", "message": str(e)}, e.status_code)
+            return
+        self._await_debug(session)
+
+    def _debug_waiter(self):
+        """The thread that waits for the result, left out of stack samples"""
+        return threading.get_ident()
+
+    def _await_debug(self, session):
+        # Only this thread waits; every other thread keeps serving and is profiled
+        time.sleep(session.seconds)
+        self._send_debug(session)
+
+    def _send_debug(self, session):
+        body, content_type, filename = self.server.profiler.finish(session)
+        extra = b''
+        if filename is not None:
+            extra = b'Content-Disposition: attachment; filename="%s"\r\n' % filename.encode('ascii')
+        self._send_response(body, content_type, extra=extra)
+
+class ProfilingHandler(ProfilingMixin, LongConnectionHandler):
+    """LongConnectionHandler with --profile"""
+
+def print_banner(port, validate_json, delay_ms, engine, keepalive_timeout=0, max_requests=0, codec=None,
+                 validate_only=False, tls=None):
+    """Print the startup banner"""
     print('=' * 60)
-    print('Multi-threaded long connection server started successfully!')
-    print(f'Listening address: http://localhost:{port}')
+    if engine == 'asyncio':
+        print('Asyncio long connection server started successfully!')
+    else:
+        print('Multi-threaded long connection server started successfully!')
+    print(f'Listening address: {"https" if tls is not None else "http"}://localhost:{port}')
     print('Supported features:')
     print('  - GET requests: Return JSON formatted responses')
-    if validate_json:
+    if validate_json and validate_only:
+        print('  - POST requests: Validate JSON data and echo the original bytes')
+    elif validate_json:
         print('  - POST requests: Receive and validate JSON data')
     else:
         print('  - POST requests: Receive raw data (no JSON validation)')
-    print('  - Long connections: Support HTTP Keep-Alive')
-    print('  - Parallel processing: Each request handled in independent thread')
+    print('  - Long connections: HTTP/1.1 persistent connections with pipelining')
+    if keepalive_timeout or max_requests:
+        print(f'    idle timeout: {f"{keepalive_timeout}s" if keepalive_timeout else "none"}, '
+              f'max requests per connection: {max_requests or "unlimited"}')
+    print('  - Event streams: GET /stream pushes events to every subscriber from one broadcaster thread')
+    if engine == 'asyncio':
+        print('  - Event loop: All connections served by a single asyncio loop')
+    else:
+        print('  - Parallel processing: Each request handled in independent thread')
     if delay_ms > 0:
         print(f'  - Response delay: {delay_ms}ms')
     print('=' * 60)
-    print(f'Usage: python http_server.py [port] [--no-json] [--delay ms]')
+    print(f'Usage: python http_server.py [port] [--no-json] [--delay ms] [--engine {"|".join(ENGINES)}]')
     print(f'Current port: {port}')
-    print(f'JSON validation: {"Enabled" if validate_json else "Disabled"}')
+    print(f'Engine: {engine} (pid {os.getpid()})')
+    print(f'JSON validation: {"Enabled" if validate_json else "Disabled"}'
+          f'{f" (codec: {codec.name})" if validate_json and codec is not None else ""}')
     print(f'Response delay: {delay_ms}ms')
     print('Press Ctrl+C to stop the server')
     print('=' * 60)
+
+def run_server(port, validate_json=True, delay_ms=0, engine='threads', reuse_port=False, logger=None,
+               max_threads=0, max_queue=0, pretty_json=False, metrics=False, max_body=0, compressor=None,
+               keepalive_timeout=0, max_requests=0, codec=None, validate_only=False, fixtures=None, recorder=None,
+               profiler=None, tls=None, stream=None):
+    """Start the HTTP server with the selected engine and serve until Ctrl+C"""
+    logger = logger or RequestLogger()
+    codec = codec or get_codec()
+    stream = stream or StreamBroadcaster()
+    if engine == 'asyncio':
+        from asyncio_server import run_asyncio_server
+        run_asyncio_server(port, validate_json, delay_ms, reuse_port, logger, pretty_json, metrics, max_body,
+                           compressor, keepalive_timeout, max_requests, codec, validate_only, fixtures, recorder,
+                           profiler, stream)
+        return
+    
+    server_address = ('', port)
+    
+    # Create handler with JSON validation and delay settings
+    handler_class = ProfilingHandler if profiler is not None else LongConnectionHandler
+    def handler(*args, **kwargs):
+        return handler_class(*args, validate_json=validate_json, delay_ms=delay_ms,
+                                     pretty_json=pretty_json, max_body=max_body,
+                                     keepalive_timeout=keepalive_timeout, max_requests=max_requests,
+                                     codec=codec, validate_only=validate_only, **kwargs)
+    
+    scheduler = DelayScheduler(logger) if delay_ms > 0 else None
+    httpd = ThreadedHTTPServer(server_address, handler, reuse_port=reuse_port, scheduler=scheduler,
+                               logger=logger, max_threads=max_threads, max_queue=max_queue,
+                               metrics=get_registry() if metrics else None, compressor=compressor,
+                               fixtures=fixtures, recorder=recorder, profiler=profiler, tls=tls, stream=stream)
+    print_banner(port, validate_json, delay_ms, engine, keepalive_timeout, max_requests, codec, validate_only, tls)
+    if max_body > 0:
+        print(f'Max request body: {max_body} bytes (413 beyond that)')
+    if compressor is not None:
+        print(f'Compression: gzip/deflate level {compressor.level} for bodies of {compressor.min_size} bytes or more')
+    if fixtures is not None:
+        print(f'Fixtures: GET requests served from {fixtures.root}')
+    if recorder is not None:
+        print(f'Recording requests to {recorder.path}')
+    if profiler is not None:
+        print(f'Profiling: {"https" if tls is not None else "http"}://localhost:{port}/debug/profile?seconds=10 '
+              f'and /debug/heap?seconds=10')
+    if tls is not None:
+        print(f'TLS: certificate {tls.certfile}, handshakes on connection threads, session resumption enabled')
+    if max_threads > 0:
+        print(f'Thread pool: {max_threads} threads, {max_queue} queued connections, 503 beyond that')
+        print('=' * 60)
     
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         print('\nServer is shutting down...')
         httpd.server_close()
+        logger.close()
+        if recorder is not None:
+            recorder.close()
         print('Server has been closed')
+        httpd.stats.report()
+        if compressor is not None:
+            compressor.report()
+        if fixtures is not None:
+            fixtures.report()
+        if recorder is not None:
+            recorder.report()
+        if tls is not None:
+            tls.report()
+        stream.report()
 
+def show_help(program='python http_server.py'):
+    """Print the HTTP server's command line help"""
+    print("HTTP Server - Multi-threaded server with JSON support")
+    print()
+    print(f"Usage: {program} [port] [--no-json] [--delay milliseconds] [--engine threads|asyncio] [--reuse-port]")
+    print()
+    print("Arguments:")
+    print(f"  port              Port number (default: {DEFAULT_PORT})")
+    print("  --no-json         Disable JSON validation for POST requests")
+    print(f"  --json-codec name JSON library: {', '.join(CODECS)} (default: stdlib; auto = fastest installed)")
+    print("  --validate-only   Check POST bodies are JSON and echo the original bytes without re-serializing")
+    print("  --delay ms        Response delay in milliseconds (default: 0)")
+    print("  --pretty          Indent JSON responses (default: compact)")
+    print("  --metrics         Collect metrics and serve them at /metrics (Prometheus text or ?format=json)")
+    print("  --engine name     Server engine: threads or asyncio (default: threads)")
+    print("  --reuse-port      Set SO_REUSEPORT so several processes can share the port")
+    print("  --max-threads N   Serve connections from a fixed pool of N threads (default: one thread per connection)")
+    print("  --max-queue N     Connections allowed to wait for a pool thread before 503 (default: 0)")
+    print("  --max-body bytes  Reject larger request bodies with 413 (default: no limit)")
+    print(f"  --keepalive-timeout s  Close connections idle for s seconds (default: never, {POOL_KEEPALIVE_TIMEOUT} with --max-threads)")
+    print("  --max-requests-per-conn N  Close a connection after N requests (default: unlimited)")
+    for line in COMPRESSION_HELP:
+        print(line)
+    for line in FIXTURES_HELP:
+        print(line)
+    print(RECORD_HELP)
+    print("  --profile         Serve /debug/profile?seconds=N (mode=sample|cprofile) and /debug/heap?seconds=N")
+    for line in TLS_HELP:
+        print(line)
+    for line in STREAM_HELP:
+        print(line)
+    for line in LOGGER_HELP:
+        print(line)
+    print("  -h, --help        Show this help message")
+    print()
+    print("Examples:")
+    print(f"  {program}                    # Start on port 8000 with JSON validation")
+    print(f"  {program} 8080               # Start on port 8080 with JSON validation")
+    print(f"  {program} --no-json          # Start on port 8000 without JSON validation")
+    print(f"  {program} 8080 --no-json     # Start on port 8080 without JSON validation")
+    print(f"  {program} --delay 1000       # Start on port 8000 with 1 second delay")
+    print(f"  {program} 8080 --delay 500   # Start on port 8080 with 500ms delay")
+    print(f"  {program} --engine asyncio   # Serve all connections from one event loop")
+    print(f"  {program} --log-sample-rate 0.01 --log-no-body  # Log 1% of requests, no bodies")
+    print(f"  {program} --max-threads 64 --max-queue 256       # Bounded pool, 503 on overload")
+    print(f"  {program} --max-body 10485760                    # Limit request bodies to 10 MB")
+    print(f"  {program} --compress --compress-min-size 512     # gzip/deflate bodies of 512+ bytes")
+    print(f"  {program} --keepalive-timeout 30 --max-requests-per-conn 10000")
+    print(f"  {program} --json-codec orjson --validate-only  # Cheapest JSON POST handling")
+    print(f"  {program} --fixtures ./mocks                     # Mock backend serving canned files")
+    print(f"  {program} --profile                              # Enable the /debug profiling endpoints")
+    print(f"  {program} 8443 --tls-cert cert.pem --tls-key key.pem  # HTTPS")
+    print(f"  {program} --stream-interval 5000 --stream-payload 512  # /stream event every 5s, 512 byte filler")
+    print()
+    print("POST /echo streams the request body back and POST /discard only counts it; neither buffers")
+    print("the body. Chunked request bodies (Transfer-Encoding: chunked) are accepted on every path.")
+    print("GET /stream holds the connection open and pushes a JSON event every --stream-interval ms as")
+    print("Server-Sent Events (?format=ndjson for one JSON object per line) to all subscribers at once.")
+    print()
+    print("With --profile, GET /debug/profile?seconds=N profiles the next N seconds: mode=sample (default)")
+    print("samples every thread's stack, format=collapsed gives flamegraph input; mode=cprofile runs")
+    print("cProfile for each request, format=pstats gives a file for pstats or snakeviz. GET")
+    print("/debug/heap?seconds=N lists the allocations made in that time that are still alive.")
+    print()
+    print("A self-signed certificate for --tls-cert/--tls-key (clients need -k / verify=False):")
+    print("  openssl req -x509 -newkey rsa:2048 -nodes -keyout key.pem -out cert.pem -days 365 -subj /CN=localhost")
+
+def pop_http_args(args):
+    """Parse the HTTP-only options, returning (run_server keyword arguments, remaining_args)"""
+    options = {}
+    no_json, args = pop_flag(args, '--no-json')
+    options['validate_json'] = not no_json
+    
+    # JSON codec and validate-only echo
+    codec_name, args = pop_value(args, '--json-codec', str.lower, 'stdlib')
+    if codec_name not in CODECS:
+        fail(f"Unknown JSON codec '{codec_name}'! Valid codecs: {', '.join(CODECS)}")
+    try:
+        options['codec'] = get_codec(codec_name)
+    except ImportError:
+        fail(f"JSON codec '{codec_name}' is not installed (pip install {codec_name})")
+    options['validate_only'], args = pop_flag(args, '--validate-only')
+    if options['validate_only'] and no_json:
+        fail("--validate-only cannot be combined with --no-json!")
+    
+    options['pretty_json'], args = pop_flag(args, '--pretty')
+    options['engine'], _, args = pop_engine(args, ENGINES, 'threads')
+    
+    # Bounded thread pool options
+    options['max_threads'], args = pop_value(args, '--max-threads', int, 0)
+    options['max_queue'], args = pop_value(args, '--max-queue', int, 0)
+    if options['max_threads'] < 0 or options['max_queue'] < 0:
+        fail("--max-threads and --max-queue must be non-negative!")
+    if options['max_queue'] and not options['max_threads']:
+        fail("--max-queue requires --max-threads!")
+    
+    # Compression options (--compress, --compress-level, --compress-min-size)
+    options['compressor'], args = pop_compression_args(args)
+    
+    # Static fixture files (--fixtures, --fixture-cache, --fixture-cache-file)
+    options['fixtures'], args = pop_fixture_args(args)
+    
+    # Persistent connection limits
+    options['keepalive_timeout'], args = pop_value(args, '--keepalive-timeout', int)
+    options['max_requests'], args = pop_value(args, '--max-requests-per-conn', int, 0)
+    if options['keepalive_timeout'] is None:
+        options['keepalive_timeout'] = POOL_KEEPALIVE_TIMEOUT if options['max_threads'] else 0
+    if options['keepalive_timeout'] < 0 or options['max_requests'] < 0:
+        fail("--keepalive-timeout and --max-requests-per-conn must be non-negative!")
+    if options['max_threads'] and not options['keepalive_timeout']:
+        fail("--max-threads needs a --keepalive-timeout, or idle connections hold pool threads forever!")
+    
+    # Request body limit
+    options['max_body'], args = pop_value(args, '--max-body', int, 0)
+    if options['max_body'] < 0:
+        fail("--max-body must be non-negative!")
+    
+    # GET /stream event broadcasts (--stream-interval, --stream-payload)
+    options['stream'], args = pop_stream_args(args)
+    
+    # HTTPS (--tls-cert, --tls-key)
+    options['tls'], args = pop_tls_args(args)
+    if options['tls'] is not None and options['engine'] == 'asyncio':
+        fail("--tls-cert is only supported by the threads engine!")
+    
+    # Debug endpoints; the profiling modules are only imported when asked for
+    profile, args = pop_flag(args, '--profile')
+    options['profiler'] = None
+    if profile:
+        from common.profiling import Profiler
+        options['profiler'] = Profiler()
+    return options, args
+
+def parse_args(args, program='python http_server.py'):
+    """Parse the HTTP server's command line into run_server() keyword arguments"""
+    if wants_help(args):
+        show_help(program)
+        sys.exit(0)
+    options, args = pop_common_args(args)
+    http_options, args = pop_http_args(args)
+    options.update(http_options)
+    options['port'], = pop_ports(args, [DEFAULT_PORT])
+    return options
+
+if __name__ == '__main__':
+    run_server(**parse_args(sys.argv[1:]))
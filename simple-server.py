@@ -1,26 +1,75 @@
 #!/usr/bin/env python3
 """
 Simple Server - Unified entry point for HTTP and UDP servers
+
+Servers run inside this process: the server modules are imported only for
+the server type being started, so a launch costs one interpreter startup.
+Worker pools are forked from it after the imports.
 """
 
 import sys
 import os
-import subprocess
+
+from common.cli import fail, pop_value
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PROGRAM = 'python simple-server.py'
+
+# Workers that die sooner than this after starting are restarted with a pause,
+# so a server that cannot start (e.g. bad arguments) does not spin the CPU
+MIN_WORKER_UPTIME = 1.0
+RESTART_BACKOFF = 1.0
 
 def show_help():
     """Show help information"""
     print("Simple Server - Unified server launcher")
     print()
     print("Usage: python simple-server.py <server_type> [options]")
+    print("       python simple-server.py both [http_port] [udp_port] [options]")
+    print("       python simple-server.py bench <http|udp|compare|codec|startup> [options]")
+    print("       python simple-server.py replay FILE [--speed X|max] [options]")
     print()
     print("Server Types:")
     print("  http              Start HTTP server")
     print("  udp               Start UDP server")
+    print("  both              Start HTTP and UDP servers in one process (ports default to 8000 and 9000)")
+    print()
+    print("Commands:")
+    print("  bench             Benchmark a running server (see: python simple-server.py bench -h)")
+    print("  replay            Send traffic captured with --record again (see: python simple-server.py replay -h)")
     print()
     print("Options:")
     print("  port              Port number (default: 8000 for HTTP, 9000 for UDP)")
     print("  --no-json         Disable JSON validation for HTTP POST requests")
+    print("  --pretty          Indent HTTP JSON responses (default: compact)")
+    print("  --json-codec name HTTP: stdlib, orjson, ujson or auto (default: stdlib)")
+    print("  --validate-only   HTTP: validate POST JSON and echo the original bytes")
+    print("  --metrics         Collect metrics (HTTP: served at /metrics)")
+    print("  --metrics-port N  UDP: serve metrics at http://localhost:N/metrics")
     print("  --delay ms        Response delay in milliseconds (both servers)")
+    print("  --max-datagram N  UDP: largest datagram accepted in bytes (default: 1024)")
+    print("  --rcvbuf bytes    UDP: socket receive buffer size")
+    print("  --sndbuf bytes    UDP: socket send buffer size")
+    print("  --reply-cache     UDP: answer retried requests from cache (--reply-cache-ttl, -size, -field)")
+    print("  --engine name     HTTP server engine: threads or asyncio (default: threads)")
+    print("                    UDP server engine: loop, threads [N] or asyncio (default: loop)")
+    print("  --udp-engine name both: UDP server engine, --engine then selects the HTTP engine")
+    print("  --workers N       Fork N worker processes sharing the port via SO_REUSEPORT")
+    print("  --max-threads N   HTTP: serve connections from a fixed pool of N threads")
+    print("  --max-queue N     HTTP: connections waiting for a pool thread before 503 (default: 0)")
+    print("  --max-body bytes  HTTP: reject larger request bodies with 413 (default: no limit)")
+    print("  --keepalive-timeout s  HTTP: close connections idle for s seconds (default: never, 5 with --max-threads)")
+    print("  --max-requests-per-conn N  HTTP: close a connection after N requests (default: unlimited)")
+    print("  --compress        HTTP: gzip/deflate responses the client accepts (--compress-level, --compress-min-size)")
+    print("  --fixtures DIR    HTTP: serve GET requests from files in DIR (--fixture-cache, --fixture-cache-file)")
+    print("  --record FILE     Append every request to a binary capture for replay (both servers)")
+    print("  --profile         HTTP: serve /debug/profile (sampling or cProfile) and /debug/heap (tracemalloc)")
+    print("  --tls-cert FILE   HTTP: serve HTTPS (with --tls-key FILE); workers share session tickets")
+    print("  --stream-interval ms  HTTP: time between GET /stream events (--stream-payload bytes of filler)")
+    print("  --log-level name  Log level: debug, info, warning or error (both servers)")
+    print("  --log-sample-rate r  Fraction of requests to log, 0-1 (both servers)")
+    print("  --log-no-body     Do not log request bodies (both servers)")
+    print("  --log-file path   Append logs to a file instead of stdout (both servers)")
     print("  -h, --help        Show this help message")
     print()
     print("Examples:")
@@ -28,47 +77,198 @@ def show_help():
     print("  python simple-server.py http 8080               # Start HTTP server on port 8080")
     print("  python simple-server.py http 8080 --no-json     # Start HTTP server without JSON validation")
     print("  python simple-server.py http --delay 1000       # Start HTTP server with 1 second delay")
+    print("  python simple-server.py http --engine asyncio   # Start HTTP server on a single event loop")
     print("  python simple-server.py udp                     # Start UDP server on port 9000")
     print("  python simple-server.py udp 9999                # Start UDP server on port 9999")
     print("  python simple-server.py udp --delay 1000        # Start UDP server with 1 second delay")
     print("  python simple-server.py udp 9999 --delay 500    # Start UDP server on port 9999 with 500ms delay")
+    print("  python simple-server.py udp 9999 --engine threads 8  # Answer datagrams from 8 worker threads")
+    print("  python simple-server.py http --workers 4        # Start 4 HTTP worker processes on port 8000")
+    print("  python simple-server.py http 8443 --tls-cert cert.pem --tls-key key.pem --workers 4  # HTTPS")
+    print("  python simple-server.py udp --workers 4         # Start 4 UDP worker processes on port 9000")
+    print("  python simple-server.py udp --reply-cache-field id  # Answer retries of the same request ID from cache")
+    print("  python simple-server.py both                    # HTTP on 8000 and UDP on 9000 in one process")
+    print("  python simple-server.py both 8080 9999 --metrics --udp-engine threads 8  # UDP counters on HTTP /metrics")
+    print("  python simple-server.py both --record traffic.bin  # Capture HTTP and UDP traffic to one file")
+    print("  python simple-server.py replay traffic.bin --speed 2  # Send it again at twice the recorded rate")
+    print()
+    print("Shared options (--delay, --metrics, --reuse-port, --record, --log-*) apply to both servers in both mode.")
+    print("Help for one server: python simple-server.py http -h, python simple-server.py udp -h")
     print()
     print("Direct server access:")
-    print("  python http/http_server.py [port] [--no-json] [--delay ms]")
-    print("  python udp/udp_server.py [port] [--delay ms]")
+    print("  python http/http_server.py [port] [--no-json] [--delay ms] [--engine threads|asyncio] [--reuse-port]")
+    print("  python udp/udp_server.py [port] [--delay ms] [--engine loop|threads [N]|asyncio] [--max-datagram N] [--rcvbuf bytes] [--reuse-port]")
+
+def parse_workers(args):
+    """Extract the --workers option, returning (workers, remaining_args)"""
+    if '--workers' not in args:
+        return 0, args
+    workers, args = pop_value(args, '--workers', int)
+    if workers < 1:
+        fail("Number of workers must be at least 1!")
+    import socket
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        fail("--workers requires SO_REUSEPORT, which this platform does not support")
+    return workers, args
+
+def import_server(name):
+    """Import http_server or udp_server from its directory (http/ or udp/)"""
+    directory = os.path.join(ROOT, name.split('_')[0])
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    return __import__(name)
+
+def run_http(args):
+    http_server = import_server('http_server')
+    http_server.run_server(**http_server.parse_args(args, f'{PROGRAM} http'))
+
+def run_udp(args):
+    udp_server = import_server('udp_server')
+    udp_server.run_server(**udp_server.parse_args(args, f'{PROGRAM} udp'))
+
+def parse_both_args(args, http_server, udp_server):
+    """Split a `both` command line into HTTP and UDP run_server() keyword arguments
+
+    Shared options (--delay, --metrics, --reuse-port, --record, logging) apply
+    to both servers and they share one logger and capture file; --engine
+    selects the HTTP engine and --udp-engine the UDP one.
+    """
+    from common.options import pop_common_args, pop_ports, wants_help
+    if wants_help(args):
+        show_help()
+        sys.exit(0)
+    common, args = pop_common_args(args)
+    http_options, args = http_server.pop_http_args(args)
+    udp_options, args = udp_server.pop_udp_args(args, engine_flag='--udp-engine')
+    http_port, udp_port = pop_ports(args, [http_server.DEFAULT_PORT, udp_server.DEFAULT_PORT])
+    return dict(common, port=http_port, **http_options), dict(common, port=udp_port, **udp_options)
 
-def start_http_server(args):
-    """Start HTTP server with given arguments"""
-    script_path = os.path.join(os.path.dirname(__file__), 'http', 'http_server.py')
-    cmd = [sys.executable, script_path] + args
+def run_both(args):
+    """Serve HTTP from the main thread and UDP from a background thread of the same process"""
+    import threading
+    http_server = import_server('http_server')
+    udp_server = import_server('udp_server')
+    http_options, udp_options = parse_both_args(args, http_server, udp_server)
+    
+    # Bind UDP first so a busy port is reported before the HTTP server starts
+    udp = udp_server.UDPServer(**udp_options)
+    udp.print_banner()
+    threading.Thread(target=udp.serve_forever, name='udp-server', daemon=True).start()
+    try:
+        http_server.run_server(**http_options)
+    finally:
+        udp.report()
+
+def serve_in_process(name, serve, args):
+    """Run a server in this process until Ctrl+C"""
     try:
-        subprocess.run(cmd, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"HTTP server failed to start: {e}")
+        serve(args)
+    except OSError as e:
+        print(f"{name} server failed to start: {e}")
         sys.exit(1)
     except KeyboardInterrupt:
-        print("\nHTTP server stopped by user")
-        sys.exit(0)
+        print(f"\n{name} server stopped by user")
+
+def run_workers(name, serve, args, workers):
+    """Fork `workers` processes running serve(args), restarting crashed ones until Ctrl+C"""
+    import signal
+    import time
+    import traceback
+
+    def spawn(worker_id):
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            # Own session: Ctrl+C reaches only the supervisor, which then stops each worker once
+            os.setsid()
+            code = 0
+            try:
+                serve_in_process(name, serve, args + ['--reuse-port'])
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        print(f"[supervisor] {name} worker {worker_id} started (pid {pid})")
+        return pid, time.monotonic()
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
 
-def start_udp_server(args):
-    """Start UDP server with given arguments"""
-    script_path = os.path.join(os.path.dirname(__file__), 'udp', 'udp_server.py')
-    cmd = [sys.executable, script_path] + args
+    # Treat SIGTERM like Ctrl+C so the workers are always shut down with us
+    signal.signal(signal.SIGTERM, terminate)
+
+    processes = {}
     try:
-        subprocess.run(cmd, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"UDP server failed to start: {e}")
-        sys.exit(1)
+        for worker_id in range(workers):
+            processes[worker_id] = spawn(worker_id)
+        while processes:
+            time.sleep(0.2)
+            for worker_id, (pid, started) in list(processes.items()):
+                exited, status = os.waitpid(pid, os.WNOHANG)
+                if not exited:
+                    continue
+                # Negative signal number when killed by a signal (os.waitstatus_to_exitcode is 3.9+)
+                code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+                if code == 0:
+                    # Worker exited on its own (e.g. printed help), nothing to restart
+                    print(f"[supervisor] {name} worker {worker_id} exited")
+                    del processes[worker_id]
+                    continue
+                print(f"[supervisor] {name} worker {worker_id} (pid {pid}) died with code {code}, restarting")
+                if time.monotonic() - started < MIN_WORKER_UPTIME:
+                    time.sleep(RESTART_BACKOFF)
+                processes[worker_id] = spawn(worker_id)
     except KeyboardInterrupt:
-        print("\nUDP server stopped by user")
-        sys.exit(0)
+        print(f"\n[supervisor] Stopping {len(processes)} {name} workers...")
+    finally:
+        for pid, _ in processes.values():
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + 5
+        running = {pid for pid, _ in processes.values()}
+        while running and time.monotonic() < deadline:
+            running = {pid for pid in running if os.waitpid(pid, os.WNOHANG)[0] == 0}
+            time.sleep(0.05)
+        for pid in running:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        if processes:
+            print(f"[supervisor] All {name} workers stopped")
+
+# server type -> (name, run function, server modules it imports)
+SERVERS = {
+    'http': ('HTTP', run_http, ('http_server',)),
+    'udp': ('UDP', run_udp, ('udp_server',)),
+    'both': ('HTTP+UDP', run_both, ('http_server', 'udp_server')),
+}
+
+def start_server(server_type, args):
+    """Run a server in this process, or as a pool of forked workers with --workers N"""
+    name, serve, modules = SERVERS[server_type]
+    workers, args = parse_workers(args)
+    if not workers:
+        serve_in_process(name, serve, args)
+        return
+    # Import before forking so every worker starts with the modules already loaded
+    for module in modules:
+        import_server(module)
+    if '--tls-cert' in args:
+        # One TLS context for all workers: a session ticket issued by one is accepted by the others
+        from common.tls import preload_context
+        preload_context(args)
+    run_workers(name, serve, args, workers)
 
 def main():
     """Main entry point"""
     if len(sys.argv) < 2:
-        print("Error: Server type is required!")
-        print("Use -h or --help for usage information")
-        sys.exit(1)
+        fail("Server type is required!")
     
     # Check for help flags
     if sys.argv[1] in ['-h', '--help']:
@@ -78,13 +278,17 @@ def main():
     server_type = sys.argv[1].lower()
     remaining_args = sys.argv[2:]
     
-    if server_type == 'http':
-        start_http_server(remaining_args)
-    elif server_type == 'udp':
-        start_udp_server(remaining_args)
+    if server_type in SERVERS:
+        start_server(server_type, remaining_args)
+    elif server_type == 'bench':
+        from common.bench import main as bench_main
+        bench_main(remaining_args)
+    elif server_type == 'replay':
+        from common.replay import main as replay_main
+        replay_main(remaining_args)
     else:
         print(f"Error: Unknown server type '{server_type}'")
-        print("Valid server types: http, udp")
+        print("Valid server types: http, udp, both (or the bench and replay commands)")
         print("Use -h or --help for usage information")
         sys.exit(1)
 
@@ -0,0 +1,49 @@
+"""
+Asyncio engine for the UDP server
+
+Kept out of udp_server.py so the loop and threads engines start without
+importing asyncio; UDPServer imports this module only for --engine asyncio.
+"""
+
+import asyncio
+
+class UDPServerProtocol(asyncio.DatagramProtocol):
+    """Asyncio engine: datagrams are answered from the event loop"""
+
+    def __init__(self, handler, max_datagram):
+        self.handler = handler
+        self.max_datagram = max_datagram
+        self.transport = None
+        self.call_later = None
+        self.received = 0
+        self.truncated = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # Delayed replies use the loop's timers; the transport is not thread-safe
+        self.call_later = asyncio.get_running_loop().call_later
+
+    def datagram_received(self, data, addr):
+        # The event loop reads up to 256 KB, so apply --max-datagram here
+        truncated = len(data) > self.max_datagram
+        if truncated:
+            data = data[:self.max_datagram]
+            self.truncated += 1
+        self.received += 1
+        self.handler.handle(self.transport, data, addr, truncated, self.call_later)
+
+    def error_received(self, exc):
+        # The transport reports failed sends (such as an oversized reply) here instead of raising
+        self.handler.send_failed(exc)
+
+def serve_asyncio(s, protocol):
+    """Answer datagrams on s with protocol until cancelled by Ctrl+C"""
+    async def serve():
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: protocol, sock=s)
+        try:
+            await asyncio.Future()
+        finally:
+            transport.close()
+
+    asyncio.run(serve())
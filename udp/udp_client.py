@@ -1,5 +1,19 @@
+import json
+import os
+import selectors
 import socket
 import sys
+import time
+
+# Make the shared modules in the repository root importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.cli import fail, pop_value
+from common.histogram import LatencyHistogram
+
+DEFAULT_INFLIGHT = 64
+DEFAULT_TIMEOUT = 1.0
+RECV_BUFFER = 65535
 
 def send_udp_request(message, host, port):
     # Create UDP socket
@@ -34,9 +48,165 @@ def send_udp_request(message, host, port):
             print(f"Error occurred: {e}")
             return None
 
-if __name__ == "__main__":
-    import json
+class LoadStats:
+    """Sequence bookkeeping for a pipelined run"""
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.expired = 0      # No reply within the timeout
+        self.late = 0         # Reply arrived after its sequence number expired
+        self.duplicates = 0
+        self.reordered = 0    # Reply for a lower sequence number than one already seen
+        self.invalid = 0      # Reply without a recognizable sequence number
+        self.refused = 0      # ICMP port unreachable reported by the socket
+        self.highest = -1
+        self.rtt = LatencyHistogram()  # Microseconds
+
+def _reply_sequence(data):
+    """Sequence number echoed back in received_data, or None"""
+    try:
+        echoed = json.loads(data)['received_data']
+        return int(echoed.partition(' ')[0])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+def run_load(message, host, port, rate=0.0, count=0, duration=0.0, inflight=DEFAULT_INFLIGHT,
+             timeout=DEFAULT_TIMEOUT):
+    """Send sequence-tagged datagrams without waiting for each reply
+
+    Up to `inflight` datagrams are outstanding at once; replies are matched
+    to their sequence number as they arrive. Datagrams are paced at `rate`
+    per second (0 = as fast as the window allows) until `count` datagrams
+    are sent or `duration` seconds pass.
+    """
+    stats = LoadStats()
+    outstanding = {}  # seq -> send time, oldest first
+    expired = set()
+    answered = set()
+    suffix = ' ' + message
+    
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.connect((host, port))
+    s.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(s, selectors.EVENT_READ)
+    
+    def receive_ready():
+        while True:
+            try:
+                data = s.recv(RECV_BUFFER)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                # ICMP port unreachable for an earlier datagram
+                stats.refused += 1
+                continue
+            now = time.perf_counter()
+            seq = _reply_sequence(data)
+            if seq is None:
+                stats.invalid += 1
+                continue
+            sent_at = outstanding.pop(seq, None)
+            if sent_at is None:
+                if seq in expired:
+                    expired.discard(seq)
+                    stats.late += 1
+                elif seq in answered:
+                    stats.duplicates += 1
+                else:
+                    stats.invalid += 1
+                continue
+            answered.add(seq)
+            stats.received += 1
+            stats.rtt.record((now - sent_at) * 1e6)
+            if seq < stats.highest:
+                stats.reordered += 1
+            else:
+                stats.highest = seq
     
+    def expire(now):
+        while outstanding:
+            seq, sent_at = next(iter(outstanding.items()))
+            if now - sent_at < timeout:
+                return sent_at + timeout
+            del outstanding[seq]
+            expired.add(seq)
+            stats.expired += 1
+        return None
+    
+    started = time.perf_counter()
+    deadline = started + duration if duration > 0 else None
+    try:
+        while True:
+            now = time.perf_counter()
+            if (count and stats.sent >= count) or (deadline is not None and now >= deadline):
+                break
+            wait = None
+            # Send while the window has room and the pacing schedule allows
+            while len(outstanding) < inflight and not (count and stats.sent >= count):
+                if rate > 0:
+                    due = started + stats.sent / rate
+                    if due > now:
+                        wait = due - now
+                        break
+                try:
+                    s.send((str(stats.sent) + suffix).encode('utf-8'))
+                except BlockingIOError:
+                    break
+                except ConnectionRefusedError:
+                    stats.refused += 1
+                    continue
+                outstanding[stats.sent] = now
+                stats.sent += 1
+            next_expiry = expire(now)
+            if len(outstanding) >= inflight and next_expiry is not None:
+                wait = next_expiry - now if wait is None else min(wait, next_expiry - now)
+            if deadline is not None:
+                wait = deadline - now if wait is None else min(wait, deadline - now)
+            if selector.select(max(wait, 0) if wait is not None else 0):
+                receive_ready()
+        send_elapsed = time.perf_counter() - started
+        
+        # Collect the replies still in flight
+        while outstanding:
+            next_expiry = expire(time.perf_counter())
+            if next_expiry is None:
+                break
+            if selector.select(max(next_expiry - time.perf_counter(), 0)):
+                receive_ready()
+    except KeyboardInterrupt:
+        send_elapsed = time.perf_counter() - started
+        print("\nInterrupted, reporting partial results")
+    finally:
+        lost_in_flight = len(outstanding)
+        selector.close()
+        s.close()
+    
+    stats.expired += lost_in_flight
+    print_load_report(host, port, stats, send_elapsed, rate, inflight)
+    return stats
+
+def _ms(us):
+    return f"{us / 1000.0:.2f}ms"
+
+def print_load_report(host, port, stats, elapsed, rate, inflight):
+    lost = stats.sent - stats.received
+    loss = lost * 100.0 / stats.sent if stats.sent else 0.0
+    target = f", target rate {rate:g}/s" if rate > 0 else ''
+    rtt = stats.rtt.summary()
+    print('=' * 60)
+    print(f"UDP load against {host}:{port}, inflight {inflight}{target}")
+    print('-' * 60)
+    print(f"Sent: {stats.sent} in {elapsed:.3f}s ({stats.sent / elapsed if elapsed else 0:.1f}/s)")
+    print(f"Received: {stats.received} ({stats.received / elapsed if elapsed else 0:.1f}/s)")
+    print(f"Lost: {lost} ({loss:.2f}%), late: {stats.late}, reordered: {stats.reordered}, "
+          f"duplicates: {stats.duplicates}, invalid: {stats.invalid}, refused: {stats.refused}")
+    print(f"RTT: min {_ms(rtt['min'])}, mean {_ms(rtt['mean'])}, max {_ms(rtt['max'])}")
+    print(f"  p50 {_ms(rtt['p50'])}  p90 {_ms(rtt['p90'])}  p99 {_ms(rtt['p99'])}  p99.9 {_ms(rtt['p999'])}")
+    print('=' * 60)
+
+if __name__ == "__main__":
     # Default JSON message
     default_message = json.dumps({
         "type": "test",
@@ -50,6 +220,7 @@ if __name__ == "__main__":
         print("UDP Client - Send messages to UDP server")
         print()
         print("Usage: python udp_client.py <host> <port> [message]")
+        print("       python udp_client.py <host> <port> [message] [--rate r] [--count n] [--duration s] [--inflight n]")
         print()
         print("Arguments:")
         print("  host              Server IP address")
@@ -57,21 +228,44 @@ if __name__ == "__main__":
         print("  message           Message to send (optional, default: JSON)")
         print("  -h, --help        Show this help message")
         print()
+        print("Load options (send many sequence-tagged datagrams without waiting for each reply):")
+        print("  --rate r          Datagrams per second (default: as fast as the window allows)")
+        print("  --count n         Stop after n datagrams")
+        print("  --duration s      Stop after s seconds (default: 10 if --count is not given)")
+        print(f"  --inflight n      Datagrams awaiting a reply at once (default: {DEFAULT_INFLIGHT})")
+        print(f"  --timeout s       Seconds before an unanswered datagram counts as lost (default: {DEFAULT_TIMEOUT:g})")
+        print()
+        print("  Reports the achieved rate, loss, late and reordered replies, and an RTT histogram.")
+        print()
         print("Examples:")
         print("  python udp_client.py 127.0.0.1 9000")
         print("  python udp_client.py 127.0.0.1 9000 'Hello World'")
         print("  python udp_client.py 127.0.0.1 9000 '{\"test\": \"data\"}'")
+        print("  python udp_client.py 127.0.0.1 9000 --count 100000 --inflight 256")
+        print("  python udp_client.py 127.0.0.1 9000 'ping' --rate 5000 --duration 30")
         sys.exit(0)
     
+    # Load options
+    args = sys.argv[1:]
+    load = any(flag in args for flag in ('--rate', '--count', '--duration', '--inflight', '--timeout'))
+    rate, args = pop_value(args, '--rate', float, 0.0)
+    count, args = pop_value(args, '--count', int, 0)
+    duration, args = pop_value(args, '--duration', float, 0.0)
+    inflight, args = pop_value(args, '--inflight', int, DEFAULT_INFLIGHT)
+    timeout, args = pop_value(args, '--timeout', float, DEFAULT_TIMEOUT)
+    if rate < 0 or count < 0 or duration < 0 or inflight < 1 or timeout <= 0:
+        fail("--rate, --count and --duration must be non-negative, --inflight at least 1 "
+             "and --timeout positive!")
+    
     # Check minimum required parameters
-    if len(sys.argv) < 3:
+    if len(args) < 2:
         print("Error: Missing required parameters!")
         print("Use -h or --help for usage information")
         sys.exit(1)
     
-    host = sys.argv[1]
+    host = args[0]
     try:
-        port = int(sys.argv[2])
+        port = int(args[1])
         # Check if port is within valid range
         if not (1 <= port <= 65535):
             print("Error: Port number must be between 1-65535!")
@@ -82,10 +276,15 @@ if __name__ == "__main__":
         sys.exit(1)
     
     # Use provided message or default JSON message
-    if len(sys.argv) > 3:
-        message = ' '.join(sys.argv[3:])  # Support space-separated messages
+    if len(args) > 2:
+        message = ' '.join(args[2:])  # Support space-separated messages
     else:
         message = default_message
     
-    send_udp_request(message, host, port)
+    if load:
+        if not count and not duration:
+            duration = 10.0
+        run_load(message, host, port, rate, count, duration, inflight, timeout)
+    else:
+        send_udp_request(message, host, port)
     
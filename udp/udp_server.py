@@ -1,112 +1,441 @@
+import os
 import socket
+import struct
 import sys
+import threading
 import json
 import time
 
-def run_server(port, delay_ms=0):
-    # Create UDP socket
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+# Make the shared modules in the repository root importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.capture import RECORD_HELP
+from common.cli import fail, pop_value
+from common.logger import LOGGER_HELP, RequestLogger
+from common.metrics import define_reply_cache_metrics, define_udp_metrics, get_registry, start_metrics_server
+from common.options import pop_common_args, pop_engine, pop_ports, wants_help
+from common.reply_cache import REPLY_CACHE_HELP, pop_reply_cache_args
+from common.scheduler import DelayScheduler
+
+ENGINES = ('loop', 'threads', 'asyncio')
+DEFAULT_PORT = 9000
+DEFAULT_THREADS = 4
+DEFAULT_MAX_DATAGRAM = 1024
+MAX_DATAGRAM_LIMIT = 65535
+RECV_BATCH = 64  # Datagrams drained per wakeup, one preallocated buffer each
+MSG_TRUNC = getattr(socket, 'MSG_TRUNC', 0)
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+# Linux: ask for the socket's cumulative drop count as ancillary data on each receive
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40 if sys.platform.startswith('linux') else None)
+
+class KernelDrops:
+    """Datagrams the kernel dropped on one socket, shared by all of the socket's receivers
+
+    SO_RXQ_OVFL reports a socket-wide cumulative count, so with several
+    receivers on one socket each would see the same drops; only the increase
+    over the highest count any of them has seen is new.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def update(self, count):
+        """Record a cumulative count, returning how many of its drops are new"""
+        if count <= self.total:
+            # Unchanged since the last receive (the usual case): no lock needed, total only grows
+            return 0
+        with self._lock:
+            new = max(count - self.total, 0)
+            self.total += new
+            return new
+
+class DatagramReceiver:
+    """Receive datagrams in batches into a preallocated ring of buffers
+
+    Each wakeup blocks for the first datagram and then drains the socket
+    without blocking until it is empty or the ring is full, so a burst of
+    datagrams costs one wakeup and no per-datagram buffer allocation.
+    Datagrams that did not fit and datagrams the kernel dropped because the
+    receive buffer was full are counted.
+    """
+
+    def __init__(self, sock, max_datagram=DEFAULT_MAX_DATAGRAM, batch=RECV_BATCH, drops=None):
+        self.sock = sock
+        self.max_datagram = max_datagram
+        self.views = [memoryview(bytearray(max_datagram)) for _ in range(batch if MSG_DONTWAIT else 1)]
+        self.received = 0
+        self.truncated = 0
+        self.drops = drops or KernelDrops()  # Pass the same KernelDrops to every receiver of a socket
+        self.new_drops = 0  # Drops seen since the last take_drops()
+        self._use_recvmsg = hasattr(sock, 'recvmsg_into')
+        self._ancbufsize = 0
+        if self._use_recvmsg and SO_RXQ_OVFL is not None:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+                self._ancbufsize = socket.CMSG_SPACE(4)
+            except OSError:
+                pass
+
+    def _receive_one(self, view, flags):
+        """Receive one datagram into view, returning (nbytes, addr, truncated)"""
+        if not self._use_recvmsg:
+            nbytes, addr = self.sock.recvfrom_into(view, 0, flags)
+            return nbytes, addr, False
+        nbytes, ancdata, msg_flags, addr = self.sock.recvmsg_into([view], self._ancbufsize, flags)
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(data) >= 4:
+                # Cumulative count of datagrams dropped before reaching this socket
+                self.new_drops += self.drops.update(struct.unpack('I', data[:4])[0])
+        return nbytes, addr, bool(msg_flags & MSG_TRUNC)
+
+    @property
+    def kernel_drops(self):
+        return self.drops.total
+
+    def take_drops(self):
+        """Return the drops this receiver has seen since the last call"""
+        drops, self.new_drops = self.new_drops, 0
+        return drops
+
+    def receive_batch(self):
+        """Wait for datagrams and return [(memoryview, addr, truncated), ...]"""
+        batch = []
+        flags = 0  # Block for the first datagram only
+        for view in self.views:
+            try:
+                nbytes, addr, truncated = self._receive_one(view, flags)
+            except BlockingIOError:
+                break
+            batch.append((view[:nbytes], addr, truncated))
+            flags = MSG_DONTWAIT
+        self.received += len(batch)
+        for _, _, truncated in batch:
+            if truncated:
+                self.truncated += 1
+        return batch
+
+def encode_response(message, addr):
+    """Build the encoded JSON reply for one datagram"""
+    # Create JSON response (consistent with HTTP server format)
+    response_data = {
+        "status": "success",
+        "message": "UDP request processed successfully",
+        "received_data": message,
+        "client_ip": addr[0],
+        "client_port": addr[1],
+        "time": time.ctime()
+    }
+    return json.dumps(response_data, ensure_ascii=False).encode('utf-8')
+
+def send_reply(s, response, addr, metrics=None):
+    """Send an encoded reply"""
+    s.sendto(response, addr)
+    if metrics is not None:
+        metrics.inc('udp_datagrams_sent_total')
+        metrics.inc('udp_sent_bytes_total', amount=len(response))
+
+def set_buffer_sizes(s, rcvbuf=None, sndbuf=None):
+    """Apply --rcvbuf/--sndbuf and return the sizes the kernel actually granted"""
+    if rcvbuf:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    if sndbuf:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    return (s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+            s.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))
+
+class DatagramHandler:
+    """Per-datagram work shared by every engine: count, decode, log and reply"""
+
+    def __init__(self, logger, metrics=None, delay_ms=0, recorder=None, reply_cache=None):
+        self.logger = logger
+        self.metrics = metrics
+        self.delay_ms = delay_ms
+        self.recorder = recorder  # TrafficRecorder with --record, otherwise None
+        self.reply_cache = reply_cache  # ReplyCache with --reply-cache, otherwise None
+        # Delayed replies wait on a timer so the receive loop never sleeps
+        self.scheduler = DelayScheduler(logger) if delay_ms > 0 else None
+
+    def send(self, s, response, addr):
+        """Send an encoded reply; a send the socket refuses is logged and counted, not raised"""
         try:
-            # Bind to specified port, allow access from all network interfaces
-            s.bind(('0.0.0.0', port))
-            print(f"UDP server started, listening on port {port}...")
-            if delay_ms > 0:
-                print(f"Response delay: {delay_ms}ms")
-            print("Press Ctrl+C to stop the server")
-            
-            while True:
-                # Receive data
-                data, addr = s.recvfrom(1024)
-                message = data.decode('utf-8')
-                client_ip = addr[0]
-                client_port = addr[1]
-                print(f"Received message from {addr}: {message}")
-                
-                # Add delay if specified
-                if delay_ms > 0:
-                    time.sleep(delay_ms / 1000.0)
-                
-                # Create JSON response (consistent with HTTP server format)
-                response_data = {
-                    "status": "success",
-                    "message": "UDP request processed successfully",
-                    "received_data": message,
-                    "client_ip": client_ip,
-                    "client_port": client_port,
-                    "time": time.ctime()
-                }
-                
-                # Send JSON response
-                response = json.dumps(response_data, ensure_ascii=False)
-                s.sendto(response.encode('utf-8'), addr)
-                
-        except KeyboardInterrupt:
-            print("\nServer is shutting down...")
-        except Exception as e:
-            print(f"Server error: {e}")
+            send_reply(s, response, addr, self.metrics)
+        except OSError as e:
+            # e.g. EMSGSIZE: control characters escape to 6 bytes, so a large datagram's reply can exceed 65507 bytes
+            self.send_failed(e, addr)
 
-if __name__ == "__main__":
-    # Default settings
-    port = 9000
-    delay_ms = 0
-    
-    # Parse command line arguments
-    if len(sys.argv) > 1:
-        # Check for help flags
-        if sys.argv[1] in ['-h', '--help']:
-            print("UDP Server - JSON response server with delay support")
-            print()
-            print("Usage: python udp_server.py [port] [--delay milliseconds]")
-            print()
-            print("Arguments:")
-            print("  port              Port number (default: 9000)")
-            print("  --delay ms        Response delay in milliseconds (default: 0)")
-            print("  -h, --help        Show this help message")
-            print()
-            print("Examples:")
-            print("  python udp_server.py                    # Start on port 9000, no delay")
-            print("  python udp_server.py 9999               # Start on port 9999, no delay")
-            print("  python udp_server.py --delay 1000       # Start on port 9000, 1 second delay")
-            print("  python udp_server.py 9999 --delay 500   # Start on port 9999, 500ms delay")
-            print()
-            print("The server will send JSON responses back to clients with optional delay.")
-            sys.exit(0)
+    def respond(self, s, message, addr):
+        """Build and send the JSON reply for one datagram"""
+        self.send(s, encode_response(message, addr), addr)
+
+    def send_failed(self, error, addr=None):
+        if self.metrics is not None:
+            self.metrics.inc('udp_send_errors_total')
+        if addr is None:
+            self.logger.warning("UDP socket error: %s", error)
+        else:
+            self.logger.warning("Reply to %s not sent: %s", addr, error)
+
+    def count_drops(self, drops):
+        if self.metrics is not None and drops:
+            self.metrics.inc('udp_kernel_drops_total', amount=drops)
+
+    def handle(self, s, data, addr, truncated=False, call_later=None):
+        """Reply to one datagram; call_later overrides the delay timer (asyncio)"""
+        if self.metrics is not None:
+            self.metrics.inc('udp_datagrams_received_total')
+            self.metrics.inc('udp_received_bytes_total', amount=len(data))
+            if truncated:
+                self.metrics.inc('udp_datagrams_truncated_total')
+        if self.recorder is not None:
+            # Copy: data is a view of a receive buffer that the next batch overwrites
+            self.recorder.udp(bytes(data), addr)
+        if truncated:
+            self.logger.warning("Datagram from %s truncated to %d bytes (--max-datagram)", addr, len(data))
+        if self.reply_cache is not None:
+            self._handle_cached(s, data, addr, call_later)
+            return
         
-        # Parse arguments
-        args = sys.argv[1:]
+        message = str(data, 'utf-8', 'replace')
+        if self.logger.log_body:
+            self.logger.request("Received message from %s: %s", addr, message)
+        else:
+            self.logger.request("Received message from %s (%d bytes)", addr, len(data))
         
-        # Check for delay parameter
-        if '--delay' in args:
-            delay_index = args.index('--delay')
-            if delay_index + 1 < len(args):
-                try:
-                    delay_ms = int(args[delay_index + 1])
-                    if delay_ms < 0:
-                        print("Error: Delay must be non-negative!")
-                        sys.exit(1)
-                    # Remove delay arguments for port parsing
-                    args = [arg for i, arg in enumerate(args) if i not in [delay_index, delay_index + 1]]
-                except ValueError:
-                    print("Error: Delay must be an integer!")
-                    print("Use -h or --help for usage information")
-                    sys.exit(1)
+        if self.delay_ms <= 0:
+            self.respond(s, message, addr)
+        elif call_later is not None:
+            call_later(self.delay_ms / 1000.0, self.respond, s, message, addr)
+        else:
+            self.scheduler.call_later(self.delay_ms / 1000.0, self.respond, s, message, addr)
+
+    def _handle_cached(self, s, data, addr, call_later):
+        """Reply with --reply-cache: a retried request gets the bytes already sent for it
+
+        The reply is encoded when the request arrives rather than when it is
+        sent, so retries that come in during --delay are answered from the
+        cache too.
+        """
+        key = self.reply_cache.key(data, addr)
+        response = self.reply_cache.get(key)
+        if response is not None:
+            self.logger.request("Repeated request from %s (%d bytes), reply sent from cache", addr, len(data))
+        else:
+            message = str(data, 'utf-8', 'replace')
+            if self.logger.log_body:
+                self.logger.request("Received message from %s: %s", addr, message)
             else:
-                print("Error: --delay requires a value!")
-                print("Use -h or --help for usage information")
-                sys.exit(1)
+                self.logger.request("Received message from %s (%d bytes)", addr, len(data))
+            response = encode_response(message, addr)
+            self.reply_cache.put(key, response)
         
-        # Parse port if provided
-        if args:
-            try:
-                port = int(args[0])
-                # Check if port is within valid range
-                if not (1 <= port <= 65535):
-                    print("Error: Port number must be between 1-65535!")
-                    sys.exit(1)
-            except ValueError:
-                print("Error: Port number must be an integer!")
-                print("Use -h or --help for usage information")
-                sys.exit(1)
+        if self.delay_ms <= 0:
+            self.send(s, response, addr)
+        elif call_later is not None:
+            call_later(self.delay_ms / 1000.0, self.send, s, response, addr)
+        else:
+            self.scheduler.call_later(self.delay_ms / 1000.0, self.send, s, response, addr)
+
+def serve_loop(s, handler, receiver):
+    """Single loop engine: receive a batch, then answer each datagram in turn"""
+    while True:
+        for data, addr, truncated in receiver.receive_batch():
+            handler.handle(s, data, addr, truncated)
+        handler.count_drops(receiver.take_drops())
+
+def serve_threads(s, handler, receivers):
+    """Worker pool engine: one thread per receiver, each receiving and answering on the shared socket
+
+    Every worker owns its receive buffers, so no datagram is copied or handed
+    between threads; the kernel wakes whichever worker is idle.
+    """
+    def worker(receiver):
+        while True:
+            for data, addr, truncated in receiver.receive_batch():
+                handler.handle(s, data, addr, truncated)
+            handler.count_drops(receiver.take_drops())
     
-    run_server(port, delay_ms)
+    for i, receiver in enumerate(receivers):
+        threading.Thread(target=worker, args=(receiver,), name=f'udp-worker-{i}', daemon=True).start()
+    # Workers are daemon threads; the calling thread only waits for Ctrl+C
+    while True:
+        time.sleep(3600)
+
+class UDPServer:
+    """A bound UDP socket and the engine that answers it
+
+    Used like the HTTP servers: construct (binds the port), print_banner(),
+    serve_forever() until Ctrl+C, then report() and server_close().
+    """
+
+    def __init__(self, port, delay_ms=0, reuse_port=False, logger=None, metrics=False, metrics_port=None,
+                 max_datagram=DEFAULT_MAX_DATAGRAM, rcvbuf=None, sndbuf=None, engine='loop', threads=DEFAULT_THREADS,
+                 recorder=None, reply_cache=None):
+        self.port = port
+        self.delay_ms = delay_ms
+        self.logger = logger or RequestLogger()
+        self.metrics_port = metrics_port
+        self.max_datagram = max_datagram
+        self.engine = engine
+        self.threads = threads
+        self.recorder = recorder
+        self.reply_cache = reply_cache
+        self.receivers = []
+        self.protocol = None
+        self.metrics = get_registry() if metrics or metrics_port else None
+        if self.metrics is not None:
+            define_udp_metrics(self.metrics)
+            if reply_cache is not None:
+                define_reply_cache_metrics(self.metrics, lambda: len(reply_cache))
+                reply_cache.metrics = self.metrics
+        
+        # Create UDP socket
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.rcvbuf, self.sndbuf = set_buffer_sizes(self.socket, rcvbuf, sndbuf)
+            # Let several worker processes share the port; the kernel balances datagrams across them
+            if reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            # Bind to specified port, allow access from all network interfaces
+            self.socket.bind(('0.0.0.0', port))
+        except OSError:
+            self.socket.close()
+            raise
+        if metrics_port:
+            start_metrics_server(metrics_port, self.metrics)
+        self.handler = DatagramHandler(self.logger, self.metrics, delay_ms, recorder, reply_cache)
+
+    def print_banner(self):
+        print(f"UDP server started, listening on port {self.port}... (pid {os.getpid()})")
+        print(f"Engine: {self.engine}" + (f" ({self.threads} threads)" if self.engine == 'threads' else ''))
+        print(f"Max datagram: {self.max_datagram} bytes, socket buffers: rcvbuf {self.rcvbuf}, sndbuf {self.sndbuf}")
+        if self.delay_ms > 0:
+            print(f"Response delay: {self.delay_ms}ms")
+        if self.metrics_port:
+            print(f"Metrics: http://localhost:{self.metrics_port}/metrics")
+        if self.recorder is not None:
+            print(f"Recording datagrams to {self.recorder.path}")
+        if self.reply_cache is not None:
+            cache = self.reply_cache
+            print(f"Reply cache: up to {cache.size} replies for {cache.ttl:g}s, keyed by peer and "
+                  + (f"JSON field {cache.field!r}" if cache.field else "payload digest"))
+        print("Press Ctrl+C to stop the server")
+
+    def serve_forever(self):
+        """Answer datagrams with the configured engine until interrupted"""
+        if self.engine == 'asyncio':
+            from udp_asyncio import UDPServerProtocol, serve_asyncio
+            self.protocol = UDPServerProtocol(self.handler, self.max_datagram)
+            serve_asyncio(self.socket, self.protocol)
+        elif self.engine == 'threads':
+            drops = KernelDrops()
+            self.receivers = [DatagramReceiver(self.socket, self.max_datagram, drops=drops)
+                              for _ in range(self.threads)]
+            serve_threads(self.socket, self.handler, self.receivers)
+        else:
+            self.receivers = [DatagramReceiver(self.socket, self.max_datagram)]
+            serve_loop(self.socket, self.handler, self.receivers[0])
+
+    def report(self):
+        if self.protocol is not None:
+            print(f"Datagrams received: {self.protocol.received}, truncated: {self.protocol.truncated}")
+        elif self.receivers:
+            print(f"Datagrams received: {sum(r.received for r in self.receivers)}, "
+                  f"truncated: {sum(r.truncated for r in self.receivers)}, "
+                  f"dropped by the kernel (receive buffer full): {self.receivers[0].kernel_drops}")
+        if self.reply_cache is not None:
+            self.reply_cache.report()
+
+    def server_close(self):
+        self.socket.close()
+
+def run_server(port, delay_ms=0, reuse_port=False, logger=None, metrics=False, metrics_port=None,
+               max_datagram=DEFAULT_MAX_DATAGRAM, rcvbuf=None, sndbuf=None, engine='loop', threads=DEFAULT_THREADS,
+               recorder=None, reply_cache=None):
+    logger = logger or RequestLogger()
+    server = None
+    try:
+        server = UDPServer(port, delay_ms, reuse_port, logger, metrics, metrics_port, max_datagram, rcvbuf, sndbuf,
+                           engine, threads, recorder, reply_cache)
+        server.print_banner()
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nServer is shutting down...")
+    except Exception as e:
+        logger.error("Server error: %s", e)
+    finally:
+        if server is not None:
+            server.report()
+            server.server_close()
+        logger.close()
+        if recorder is not None:
+            recorder.close()
+            recorder.report()
+
+def show_help(program='python udp_server.py'):
+    """Print the UDP server's command line help"""
+    print("UDP Server - JSON response server with delay support")
+    print()
+    print(f"Usage: {program} [port] [--delay milliseconds] [--engine loop|threads [N]|asyncio] [--reuse-port]")
+    print()
+    print("Arguments:")
+    print(f"  port              Port number (default: {DEFAULT_PORT})")
+    print("  --delay ms        Response delay in milliseconds (default: 0)")
+    print("  --engine name     loop: one datagram at a time (default)")
+    print(f"                    threads [N]: N worker threads receive and reply concurrently (default: {DEFAULT_THREADS})")
+    print("                    asyncio: asyncio DatagramProtocol on one event loop")
+    print("  --reuse-port      Set SO_REUSEPORT so several processes can share the port")
+    print(f"  --max-datagram N  Largest datagram accepted in bytes, up to {MAX_DATAGRAM_LIMIT} (default: {DEFAULT_MAX_DATAGRAM})")
+    print("  --rcvbuf bytes    Socket receive buffer size (SO_RCVBUF)")
+    print("  --sndbuf bytes    Socket send buffer size (SO_SNDBUF)")
+    print("  --metrics         Count datagrams received, sent, truncated and dropped by the kernel")
+    print("  --metrics-port N  Serve the counters over HTTP at http://localhost:N/metrics (implies --metrics)")
+    for line in REPLY_CACHE_HELP:
+        print(line)
+    print(RECORD_HELP)
+    for line in LOGGER_HELP:
+        print(line)
+    print("  -h, --help        Show this help message")
+    print()
+    print("Examples:")
+    print(f"  {program}                    # Start on port 9000, no delay")
+    print(f"  {program} 9999               # Start on port 9999, no delay")
+    print(f"  {program} --delay 1000       # Start on port 9000, 1 second delay")
+    print(f"  {program} 9999 --delay 500   # Start on port 9999, 500ms delay")
+    print(f"  {program} --engine threads 8 # 8 worker threads")
+    print(f"  {program} --max-datagram 65535 --rcvbuf 8388608  # Large datagrams, 8 MB buffer")
+    print(f"  {program} --reply-cache-field id --reply-cache-ttl 10  # Answer retries of {{\"id\": ...}} from cache")
+    print()
+    print("The server will send JSON responses back to clients with optional delay.")
+
+def pop_udp_args(args, engine_flag='--engine'):
+    """Parse the UDP-only options, returning (run_server keyword arguments, remaining_args)"""
+    options = {}
+    # Engine: loop, asyncio, or threads optionally followed by the pool size
+    options['engine'], threads, args = pop_engine(args, ENGINES, 'loop', engine_flag, sized=('threads',))
+    options['threads'] = threads or DEFAULT_THREADS
+    
+    # Receive path options
+    options['max_datagram'], args = pop_value(args, '--max-datagram', int, DEFAULT_MAX_DATAGRAM)
+    if not 1 <= options['max_datagram'] <= MAX_DATAGRAM_LIMIT:
+        fail(f"--max-datagram must be between 1-{MAX_DATAGRAM_LIMIT}!")
+    options['rcvbuf'], args = pop_value(args, '--rcvbuf', int)
+    options['sndbuf'], args = pop_value(args, '--sndbuf', int)
     
+    options['metrics_port'], args = pop_value(args, '--metrics-port', int)
+    options['reply_cache'], args = pop_reply_cache_args(args)
+    return options, args
+
+def parse_args(args, program='python udp_server.py'):
+    """Parse the UDP server's command line into run_server() keyword arguments"""
+    if wants_help(args):
+        show_help(program)
+        sys.exit(0)
+    options, args = pop_common_args(args)
+    udp_options, args = pop_udp_args(args)
+    options.update(udp_options)
+    options['port'], = pop_ports(args, [DEFAULT_PORT])
+    return options
+
+if __name__ == "__main__":
+    run_server(**parse_args(sys.argv[1:]))